@@ -0,0 +1,281 @@
+""" Per-analyst attribution from one pass over the feed """
+import sys
+
+import numpy as np
+
+import vectorized
+from vectorized import CASH, NOTIONAL
+
+
+class Attribution(object):
+    """
+    Shadow portfolios of every analyst next to the organization's book
+
+    Attributes
+    ----------
+    equity : ndarray (analysts x bars)
+    Equity of each analyst's HoldStratA portfolio
+
+    org_equity : ndarray (bars)
+    Equity of the organization's book
+
+    contributions : ndarray (bars x analysts)
+    Each analyst's share of the organization's profit on every bar; rows
+    sum to the organization's equity change
+    """
+    def __init__(self, dates, analysts, equity, org_equity, contributions, cash):
+        self.dates = dates
+        self.analysts = analysts
+        self.equity = equity
+        self.org_equity = org_equity
+        self.contributions = contributions
+        self.cash = cash
+
+    def returns(self):
+        """Total return of each analyst's portfolio"""
+        return self.equity[:, -1] / self.cash - 1
+
+    def daily_returns(self):
+        """(analysts x bars - 1) bar-to-bar returns"""
+        return self.equity[:, 1:] / self.equity[:, :-1] - 1
+
+    def contribution(self):
+        """Each analyst's total contribution to the organization's profit"""
+        return self.contributions.sum(axis=0)
+
+    def report(self):
+        lines = ["%-24s %12s %12s %9s" % ("Analyst", "Final equity", "Contribution", "Return")]
+        contribution = self.contribution()
+        returns = self.returns()
+        for i in np.argsort(-contribution):
+            lines.append("%-24s %12.2f %12.2f %8.2f%%" % (self.analysts[i], self.equity[i, -1],
+                                                          contribution[i], 100 * returns[i]))
+        lines.append("%-24s %12.2f %12.2f %8.2f%%" % ("Organization", self.org_equity[-1],
+                                                      self.org_equity[-1] - self.cash,
+                                                      100 * (self.org_equity[-1] / self.cash - 1)))
+        return "\n".join(lines)
+
+
+def hold_fills(matrix, weights, sequence, cash = CASH):
+    """
+    Runs HoldStratA for one portfolio
+
+    The portfolio orders int(NOTIONAL * weight / close) shares of each
+    instrument that has a bar on the first bar, in sequence order. Each
+    order fills at its instrument's next bar, at the adjusted open, subject
+    to the broker's volume limit and cash check, and waits in the broker
+    while the instrument has no bar.
+
+    Returns
+    -------
+    (deltas, cash) : bars x instruments shares filled, cash after each bar
+    """
+    n_bars = len(matrix)
+    deltas = np.zeros((n_bars, len(weights)))
+    remaining = np.empty(n_bars)
+    remaining.fill(cash)
+    if n_bars < 2:
+        return deltas, remaining
+
+    with np.errstate(invalid='ignore'):
+        targets = np.nan_to_num(np.trunc(NOTIONAL * weights / matrix.close[0]))
+    sent = [col for col in sequence if targets[col] != 0]
+    pending = np.zeros(len(weights))
+    pending[sent] = targets[sent]
+    book = vectorized.OrderBook()
+    book.submit(sent)
+    for t in range(1, n_bars):
+        if not book.active:
+            break
+        traded = ~np.isnan(matrix.close[t])
+        adj_open = matrix.adj_close[t] * matrix.open[t] / matrix.close[t]
+        deltas[t], remaining[t:] = vectorized.fill_pending(book, pending, traded, adj_open,
+                                                           matrix.volume[t], remaining[t - 1])
+    return deltas, remaining
+
+
+def hold_portfolios(matrix, weights, sequences, cash = CASH):
+    """
+    Runs HoldStratA for every row of weights, see hold_fills
+
+    Parameters
+    ----------
+    matrix : vectorized.BarMatrix
+
+    weights : ndarray (portfolios x instruments)
+
+    sequences : list of lists
+    Columns of each portfolio in the order its orders are submitted
+
+    Returns
+    -------
+    (shares, equity) : portfolios x instruments, portfolios x bars
+    """
+    equity = np.empty((len(weights), len(matrix)))
+    shares = np.zeros(weights.shape)
+    prices = np.nan_to_num(matrix.forward_filled(matrix.adj_close))
+    for row in range(len(weights)):
+        deltas, equity[row] = hold_fills(matrix, weights[row], sequences[row], cash)
+        shares[row] = deltas.sum(axis=0)
+        # holdings only change on the few bars orders fill
+        for t in np.flatnonzero(deltas.any(axis=1)):
+            equity[row, t:] += np.dot(prices[t:], deltas[t])
+    return shares, equity
+
+
+def instrument_pnl(matrix, shares):
+    """
+    Profit of each held instrument on every bar, given (bars x instruments)
+    holdings after each bar's fills; fills are charged at the adjusted open
+    """
+    prices = np.nan_to_num(matrix.forward_filled(matrix.adj_close))
+    values = shares * prices
+    deltas = np.diff(shares, axis=0)
+    pnl = np.zeros(shares.shape)
+    pnl[1:] = values[1:] - values[:-1] - np.nan_to_num(deltas * matrix.adj_open()[1:])
+    return pnl
+
+
+def ownership(confidences, weights):
+    """Share of each instrument's organization weight owned by each analyst (analysts x instruments)"""
+    owned = confidences[:, None] * weights
+    total = owned.sum(axis=0)
+    return np.where(total > 0, owned / np.where(total > 0, total, 1), 0.0)
+
+
+def run(matrix, organization, book = "orgstrat", period = 10, update = "geometric", gamma = 0.5,
+        cash = CASH):
+    """
+    Attributes an organization's performance to its analysts in one pass
+
+    The feed is read once into matrix. Every analyst's buy-and-hold
+    portfolio (HoldStratA) is computed from it together, and so is the
+    organization's book: HoldStratB with book="hold", or the vectorized
+    OrgStrat otherwise. The book's profit on each instrument is split
+    between analysts by their share of the instrument's weight as of the
+    last rebalance.
+
+    Parameters
+    ----------
+    matrix : vectorized.BarMatrix
+    e.g. vectorized.load_matrix(feed)
+
+    organization : Organization
+    It is not modified.
+
+    book : String (default = "orgstrat")
+    "hold" or "orgstrat"
+
+    period, update, gamma
+    Same meaning as in OrgStrat
+    """
+    instruments = list(organization.get_weights())
+    matrix = matrix.select(instruments)
+    weights = organization.weight_matrix(instruments)
+    names = list(organization.names)
+    sequences = [[matrix.columns[instr] for instr in organization.analysts[name].weights
+                  if instr in matrix.columns] for name in names]
+    equity = hold_portfolios(matrix, weights, sequences, cash)[1]
+
+    n_bars = len(matrix)
+    if book == "hold":
+        confidence = organization.confidence_vector()
+        org_weights = np.dot(confidence, weights)
+        deltas, org_cash = hold_fills(matrix, org_weights, range(len(instruments)), cash)
+        shares = np.cumsum(deltas, axis=0)
+        prices = np.nan_to_num(matrix.forward_filled(matrix.adj_close))
+        org_equity = org_cash + (shares * prices).sum(axis=1)
+        confidences = confidence[None, :]
+        stamps = np.zeros(n_bars, dtype=int)
+    elif book == "orgstrat":
+        result = vectorized.run(matrix, organization, period, cash, update, gamma)
+        shares = result.shares
+        org_equity = result.equity
+        # holdings after bar t were ordered on the last rebalance before t
+        ordered = np.flatnonzero(vectorized.rebalance_mask(n_bars, period))
+        last = np.searchsorted(ordered, np.arange(n_bars), "left") - 1
+        stamps = np.where(last >= 0, ordered[np.maximum(last, 0)], 0)
+        confidences = result.confidences
+    else:
+        raise ValueError("Unknown book " + str(book))
+
+    # ownership is constant between rebalances, so split one segment at a time
+    pnl = instrument_pnl(matrix, shares)
+    contributions = np.zeros((n_bars, len(names)))
+    for stamp in np.unique(stamps):
+        rows = stamps == stamp
+        contributions[rows] = np.dot(pnl[rows], ownership(confidences[stamp], weights).T)
+    return Attribution(matrix.dates, names, equity, org_equity, contributions, cash)
+
+
+def differences(specs, columns):
+    """
+    Largest final equity difference between attribution and the
+    event-driven strategies for the organization built from benchmark specs
+    over benchmark columns: HoldStratA for every analyst, HoldStratB and
+    OrgStrat for the two books, and between each book's contributions and
+    its profit
+    """
+    import benchmark
+    import strats
+
+    matrix = vectorized.load_matrix(benchmark.build_feed(columns))
+    diff = 0.0
+    for book, strategy in (("hold", strats.HoldStratB), ("orgstrat", strats.OrgStrat)):
+        attribution = run(matrix, benchmark.build_organization(specs), book)
+        strat = strategy(benchmark.build_feed(columns), benchmark.build_organization(specs))
+        strat.run()
+        diff = max(diff, abs(strat.getBroker().getEquity() - attribution.org_equity[-1]),
+                   abs(attribution.contribution().sum() - (attribution.org_equity[-1] - attribution.cash)))
+    for i, analyst in enumerate(benchmark.build_analysts(specs)):
+        strat = strats.HoldStratA(benchmark.build_feed(columns), analyst)
+        strat.run()
+        diff = max(diff, abs(strat.getBroker().getEquity() - attribution.equity[i, -1]))
+    return diff
+
+
+def main():
+    """
+    Attributes the two-analyst dia example, or the organization in
+    benchmark.py's synthetic data with --analysts=N, then checks both books
+    against the event-driven strategies and exits non-zero on a mismatch
+    """
+    import time
+    import benchmark
+
+    options = dict(arg[2:].split("=", 1) for arg in sys.argv[1:] if "=" in arg)
+    if "analysts" in options:
+        count = int(options["analysts"])
+        specs = benchmark.synthetic_books(count, 500, 20)
+        organization = benchmark.build_organization(specs)
+        feed = benchmark.build_feed(benchmark.synthetic_bars(500, 2520))
+    else:
+        from players import Analyst, Organization
+        import barcache
+        al1 = Analyst('Ivy Kang')
+        al1.assign_weight('dia', 1.0)
+        al2 = Analyst('Charlie Brown', 0.3)
+        al2.assign_weight('dia', 0.6)
+        organization = Organization()
+        organization.add_analyst(al1)
+        organization.add_analyst(al2, 'given')
+        feed = barcache.Feed()
+        for year in (2009, 2010, 2011):
+            feed.addBarsFromCSV("dia", "dia-%d.csv" % year)
+
+    start = time.time()
+    attribution = run(vectorized.load_matrix(feed), organization, options.get("book", "orgstrat"))
+    seconds = time.time() - start
+    print attribution.report()
+    print "%d analysts attributed in %.2f s" % (len(attribution.analysts), seconds)
+
+    # against the event-driven strategies, with and without missing bars
+    specs = benchmark.synthetic_books(10, 40, 8)
+    for label, traded in (("dense", 1.0), ("sparse", 0.6)):
+        diff = differences(specs, benchmark.synthetic_bars(40, 250, traded = traded))
+        print "Largest difference to HoldStratA, HoldStratB and OrgStrat on a %s feed: %g" % (label, diff)
+        if diff > vectorized.TOLERANCE:
+            sys.exit("Attribution differs from the event-driven strategies")
+
+if __name__ == "__main__":
+    main()
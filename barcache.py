@@ -0,0 +1,499 @@
+""" Memory-mapped columnar cache for Yahoo! Finance CSV bar files """
+import csv
+import datetime
+import hashlib
+import json
+import os
+
+import numpy as np
+from pyalgotrade import bar
+from pyalgotrade import barfeed
+from pyalgotrade import dataseries
+from pyalgotrade.dataseries import bards
+
+CACHE_DIR = ".bar_cache"
+# column name, dtype
+COLUMNS = (
+    ("date", np.int64),
+    ("open", np.float64),
+    ("high", np.float64),
+    ("low", np.float64),
+    ("close", np.float64),
+    ("volume", np.float64),
+    ("adj_close", np.float64),
+)
+CSV_FIELDS = ("Date", "Open", "High", "Low", "Close", "Volume", "Adj Close")
+
+
+def file_hash(path):
+    """Returns sha1 hex digest of a file's contents"""
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def cache_path(path, cache_dir = CACHE_DIR):
+    """Returns the cache directory used for a CSV file"""
+    path = os.path.abspath(path)
+    key = hashlib.sha1(path.encode("utf-8")).hexdigest()[:10]
+    name = os.path.splitext(os.path.basename(path))[0]
+    return os.path.join(cache_dir, "%s-%s" % (name, key))
+
+
+class BarColumns(object):
+    """
+    Bars of one instrument as typed column arrays, sorted by date
+
+    Dates are proleptic Gregorian ordinals. When loaded from the cache the
+    columns are read-only memory maps, so processes opening the same file
+    share its pages. Pickling only sends the cache location.
+    """
+    def __init__(self, columns, location = None, window = None):
+        self.location = location
+        self.window = window
+        for name, dtype in COLUMNS:
+            column = columns[name]
+            if window is not None:
+                column = column[window[0]:window[1]]
+            setattr(self, name, column)
+
+    def __len__(self):
+        return len(self.date)
+
+    def __getstate__(self):
+        if self.location is None:
+            return dict((name, getattr(self, name)) for name, dtype in COLUMNS)
+        return {"location": self.location, "window": self.window}
+
+    def __setstate__(self, state):
+        if "location" in state:
+            self.__init__(open_columns(state["location"]), state["location"], state["window"])
+        else:
+            self.__init__(state)
+
+    def slice(self, start = None, end = None):
+        """Returns the rows dated within [start, end] (ordinals) as views"""
+        lo = 0 if start is None else int(np.searchsorted(self.date, start, "left"))
+        hi = len(self) if end is None else int(np.searchsorted(self.date, end, "right"))
+        columns = dict((name, getattr(self, name)) for name, dtype in COLUMNS)
+        ret = BarColumns(columns, self.location, (lo, hi))
+        if self.window is not None:
+            # window is relative to the files on disk
+            ret.window = (self.window[0] + lo, self.window[0] + hi)
+        return ret
+
+    def datetime(self, i):
+        return datetime.datetime.fromordinal(int(self.date[i]))
+
+    def bar(self, i, frequency = bar.Frequency.DAY):
+        """Builds the pyalgotrade bar for row i"""
+        return bar.BasicBar(self.datetime(i), float(self.open[i]), float(self.high[i]),
+                            float(self.low[i]), float(self.close[i]), float(self.volume[i]),
+                            float(self.adj_close[i]), frequency)
+
+
+class BarView(bar.Bar):
+    """
+    Bar reading row i of a BarColumns when asked for a value
+
+    Dispatching one costs a small fixed-size object instead of a
+    BasicBar and its seven floats, and values nobody reads are never
+    converted. Views are immutable except for the adjusted flag, so data
+    series can keep them. They pickle as the equivalent BasicBar.
+    """
+    __slots__ = ("columns", "row", "dateTime", "frequency", "useAdjusted")
+
+    def __init__(self, columns, row, dateTime, frequency = bar.Frequency.DAY):
+        self.columns = columns
+        self.row = row
+        self.dateTime = dateTime
+        self.frequency = frequency
+        self.useAdjusted = False
+
+    def __reduce__(self):
+        c, i = self.columns, self.row
+        values = (c.open.item(i), c.high.item(i), c.low.item(i), c.close.item(i), c.volume.item(i),
+                  c.adj_close.item(i))
+        return (bar.BasicBar, (self.dateTime,) + values + (self.frequency,),
+                (self.dateTime, values[0], values[3], values[1], values[2], values[4], values[5],
+                 self.frequency, self.useAdjusted))
+
+    def setUseAdjustedValue(self, useAdjusted):
+        self.useAdjusted = useAdjusted
+
+    def getUseAdjValue(self):
+        return self.useAdjusted
+
+    def getDateTime(self):
+        return self.dateTime
+
+    def adjusted(self, column):
+        c, i = self.columns, self.row
+        return c.adj_close.item(i) * column.item(i) / c.close.item(i)
+
+    def getOpen(self, adjusted = False):
+        if adjusted:
+            return self.adjusted(self.columns.open)
+        return self.columns.open.item(self.row)
+
+    def getHigh(self, adjusted = False):
+        if adjusted:
+            return self.adjusted(self.columns.high)
+        return self.columns.high.item(self.row)
+
+    def getLow(self, adjusted = False):
+        if adjusted:
+            return self.adjusted(self.columns.low)
+        return self.columns.low.item(self.row)
+
+    def getClose(self, adjusted = False):
+        if adjusted:
+            return self.columns.adj_close.item(self.row)
+        return self.columns.close.item(self.row)
+
+    def getVolume(self):
+        return self.columns.volume.item(self.row)
+
+    def getAdjClose(self):
+        return self.columns.adj_close.item(self.row)
+
+    def getFrequency(self):
+        return self.frequency
+
+    def getPrice(self):
+        if self.useAdjusted:
+            return self.columns.adj_close.item(self.row)
+        return self.columns.close.item(self.row)
+
+
+# bar getters behind BarDataSeries' value series, in the order it appends them
+SERIES_GETTERS = ("getOpen", "getClose", "getHigh", "getLow", "getVolume", "getAdjClose")
+
+
+class ViewSeries(bards.BarDataSeries):
+    """
+    BarDataSeries that only keeps the open, close, ... series asked for
+
+    pyalgotrade appends every bar to six value series, which costs more
+    than the rest of a backtest when strategies read one price from
+    hundreds of instruments. Here a value series is created the first time
+    it is requested, filled from the bars already held, and appended to
+    from then on; the others cost nothing.
+    """
+    def __init__(self, maxLen = dataseries.DEFAULT_MAX_LEN):
+        dataseries.SequenceDataSeries.__init__(self, maxLen)
+        self.useAdjusted = False
+        # (getter, series) of the requested value series, in SERIES_GETTERS order
+        self.values = []
+
+    def setUseAdjustedValues(self, useAdjusted):
+        self.useAdjusted = useAdjusted
+
+    def setMaxLen(self, maxLen):
+        dataseries.SequenceDataSeries.setMaxLen(self, maxLen)
+        for getter, series in self.values:
+            series.setMaxLen(maxLen)
+
+    def appendWithDateTime(self, dateTime, bar):
+        bar.setUseAdjustedValue(self.useAdjusted)
+        dataseries.SequenceDataSeries.appendWithDateTime(self, dateTime, bar)
+        for getter, series in self.values:
+            series.appendWithDateTime(dateTime, getattr(bar, getter)())
+
+    def value_series(self, getter):
+        for name, series in self.values:
+            if name == getter:
+                return series
+        ret = dataseries.SequenceDataSeries(self.getMaxLen())
+        for i, dateTime in enumerate(self.getDateTimes()):
+            ret.appendWithDateTime(dateTime, getattr(self[i], getter)())
+        self.values.append((getter, ret))
+        self.values.sort(key=lambda item: SERIES_GETTERS.index(item[0]))
+        return ret
+
+    def getOpenDataSeries(self):
+        return self.value_series("getOpen")
+
+    def getCloseDataSeries(self):
+        return self.value_series("getClose")
+
+    def getHighDataSeries(self):
+        return self.value_series("getHigh")
+
+    def getLowDataSeries(self):
+        return self.value_series("getLow")
+
+    def getVolumeDataSeries(self):
+        return self.value_series("getVolume")
+
+    def getAdjCloseDataSeries(self):
+        return self.value_series("getAdjClose")
+
+    def getPriceDataSeries(self):
+        if self.useAdjusted:
+            return self.getAdjCloseDataSeries()
+        return self.getCloseDataSeries()
+
+
+def parse_csv(path):
+    """Parses a Yahoo! Finance CSV file into sorted column arrays"""
+    rows = []
+    with open(path, "rb") as f:
+        for row in csv.DictReader(f):
+            rows.append([row[field] for field in CSV_FIELDS])
+
+    columns = dict()
+    dates = [datetime.date(int(r[0][0:4]), int(r[0][5:7]), int(r[0][8:10])).toordinal() for r in rows]
+    order = np.argsort(np.array(dates, dtype=np.int64), kind="mergesort")
+    columns["date"] = np.array(dates, dtype=np.int64)[order]
+    for i, (name, dtype) in enumerate(COLUMNS[1:]):
+        columns[name] = np.array([r[i + 1] for r in rows], dtype=dtype)[order]
+    return columns
+
+
+def open_columns(location):
+    return dict((name, np.load(os.path.join(location, name + ".npy"), mmap_mode="r"))
+                for name, dtype in COLUMNS)
+
+
+def write_columns(location, columns):
+    """Saves column arrays under location, one .npy file per column"""
+    if not os.path.isdir(location):
+        try:
+            os.makedirs(location)
+        except OSError:
+            # created concurrently by another process
+            pass
+    for name, dtype in COLUMNS:
+        tmp = os.path.join(location, "%s.%d.npy" % (name, os.getpid()))
+        np.save(tmp, np.asarray(columns[name], dtype=dtype))
+        os.rename(tmp, os.path.join(location, name + ".npy"))
+
+
+def read_meta(location):
+    try:
+        with open(os.path.join(location, "meta.json")) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+def write_meta(location, meta):
+    # rename is atomic, so a reader never sees a half written meta file
+    tmp = os.path.join(location, "meta.json.%d" % os.getpid())
+    with open(tmp, "w") as f:
+        json.dump(meta, f)
+    os.rename(tmp, os.path.join(location, "meta.json"))
+
+
+def load_csv(path, cache_dir = CACHE_DIR):
+    """
+    Returns the BarColumns of a Yahoo! Finance CSV file, converting it once
+
+    The cache is reused while the file's mtime and size are unchanged. If
+    they changed but the content hash did not, the cache is kept and its
+    recorded mtime refreshed; otherwise the CSV is parsed again.
+
+    Parameters
+    ----------
+    path : String
+    CSV file as downloaded from Yahoo! Finance
+
+    cache_dir : String (default = CACHE_DIR)
+    Directory holding the converted files
+    """
+    location = cache_path(path, cache_dir)
+    stat = os.stat(path)
+    meta = read_meta(location)
+    if meta is not None:
+        if meta["mtime"] == stat.st_mtime and meta["size"] == stat.st_size:
+            return BarColumns(open_columns(location), location)
+        digest = file_hash(path)
+        if meta["sha1"] == digest:
+            meta["mtime"] = stat.st_mtime
+            meta["size"] = stat.st_size
+            write_meta(location, meta)
+            return BarColumns(open_columns(location), location)
+    else:
+        digest = file_hash(path)
+
+    columns = parse_csv(path)
+    write_columns(location, columns)
+    write_meta(location, {"source": os.path.abspath(path), "mtime": stat.st_mtime,
+                          "size": stat.st_size, "sha1": digest, "rows": len(columns["date"])})
+    return BarColumns(open_columns(location), location)
+
+
+def timeline(streams):
+    """
+    Orders the rows of every (instrument, BarColumns) stream by date
+
+    Returns (dates, starts, stream_index, rows): the distinct dates, and
+    for date k the streams and their rows in stream_index and rows from
+    starts[k] to starts[k + 1], in the order of streams.
+    """
+    lengths = [len(columns) for instrument, columns in streams]
+    if not streams or not sum(lengths):
+        return np.zeros(0, np.int64), np.zeros(1, np.int64), np.zeros(0, np.int64), np.zeros(0, np.int64)
+    dates = np.concatenate([np.asarray(columns.date) for instrument, columns in streams])
+    stream_index = np.repeat(np.arange(len(streams)), lengths)
+    rows = np.concatenate([np.arange(n) for n in lengths])
+    order = np.lexsort((stream_index, dates))
+    unique, starts = np.unique(dates[order], return_index=True)
+    return unique, np.append(starts, len(order)), stream_index[order], rows[order]
+
+
+class Feed(barfeed.BaseBarFeed):
+    """
+    BarFeed reading bars from BarColumns instead of parsed bar objects
+
+    Drop-in for yahoofeed.Feed: addBarsFromCSV goes through the columnar
+    cache. With views, bars are dispatched as BarViews into ViewSeries, so
+    their values stay in the columns until read; otherwise a BasicBar is
+    built for every bar as yahoofeed does. Which rows fall on each date is
+    worked out once for all streams, so dispatching a date costs the same
+    however many instruments the feed holds.
+    """
+    def __init__(self, frequency = bar.Frequency.DAY, maxLen = None, cache_dir = CACHE_DIR, views = True):
+        self.views = views
+        self.use_adjusted = False
+        if maxLen is None:
+            barfeed.BaseBarFeed.__init__(self, frequency)
+        else:
+            barfeed.BaseBarFeed.__init__(self, frequency, maxLen)
+        self.cache_dir = cache_dir
+        # (instrument, BarColumns) streams, several per instrument if split by year
+        self.streams = []
+        self.timeline = None
+        # index into the timeline's dates of the next bars
+        self.next = 0
+        self.current_datetime = None
+        # the last bars skipped by seek
+        self.seek_bars = dict()
+        self.started = False
+
+    def addBarsFromCSV(self, instrument, path):
+        self.addBarsFromColumns(instrument, load_csv(path, self.cache_dir))
+
+    def addBarsFromColumns(self, instrument, columns):
+        if self.started:
+            raise Exception("Can't add more bars once you started consuming bars")
+        self.streams.append((instrument, columns))
+        self.timeline = None
+        if instrument not in self.getRegisteredInstruments():
+            self.registerInstrument(instrument)
+
+    def createDataSeries(self, key, maxLen):
+        if not self.views:
+            return barfeed.BaseBarFeed.createDataSeries(self, key, maxLen)
+        ret = ViewSeries(maxLen)
+        ret.setUseAdjustedValues(self.use_adjusted)
+        return ret
+
+    def setUseAdjustedValues(self, useAdjusted):
+        barfeed.BaseBarFeed.setUseAdjustedValues(self, useAdjusted)
+        self.use_adjusted = useAdjusted
+
+    def reset(self):
+        self.next = 0
+        self.current_datetime = None
+        self.seek_bars = dict()
+        barfeed.BaseBarFeed.reset(self)
+
+    def getCurrentDateTime(self):
+        return self.current_datetime
+
+    def dates(self):
+        if self.timeline is None:
+            self.timeline = timeline(self.streams)
+        return self.timeline[0]
+
+    def seek(self, when):
+        """
+        Skips every bar dated on or before datetime when, as if they had been
+        dispatched
+
+        getLastBar returns each instrument's last skipped bar, so the broker
+        values positions in instruments without a bar on the next date. The
+        data series are not filled.
+        """
+        if self.started:
+            raise Exception("Can't seek once you started consuming bars")
+        ordinal = when.toordinal()
+        self.next = int(np.searchsorted(self.dates(), ordinal, "right"))
+        self.current_datetime = when
+
+        last = dict()
+        for instrument, columns in self.streams:
+            # an instrument split into several streams keeps its latest bar
+            row = int(np.searchsorted(columns.date, ordinal, "right")) - 1
+            if row >= 0 and int(columns.date[row]) > last.get(instrument, (-1,))[0]:
+                last[instrument] = (int(columns.date[row]), columns, row)
+        frequency = self.getFrequency()
+        bars = self.seek_bars
+        bars.clear()
+        for instrument, (date, columns, row) in last.items():
+            if self.views:
+                last_bar = BarView(columns, row, datetime.datetime.fromordinal(date), frequency)
+            else:
+                last_bar = columns.bar(row, frequency)
+            # as the data series would have set it when appending the bar
+            last_bar.setUseAdjustedValue(self.use_adjusted)
+            bars[instrument] = last_bar
+
+    def getLastBar(self, instrument):
+        # the base feed only knows the bars it dispatched, not the skipped ones
+        ret = barfeed.BaseBarFeed.getLastBar(self, instrument)
+        if ret is None:
+            ret = self.seek_bars.get(instrument)
+        return ret
+
+    def barsHaveAdjClose(self):
+        return True
+
+    def start(self):
+        self.started = True
+
+    def stop(self):
+        pass
+
+    def join(self):
+        pass
+
+    def next_date(self):
+        dates = self.dates()
+        return dates[self.next] if self.next < len(dates) else None
+
+    def eof(self):
+        return self.next_date() is None
+
+    def peekDateTime(self):
+        date = self.next_date()
+        if date is None:
+            return None
+        return datetime.datetime.fromordinal(int(date))
+
+    def getNextBars(self):
+        date = self.next_date()
+        if date is None:
+            return None
+
+        dates, starts, stream_index, rows = self.timeline
+        lo, hi = starts[self.next], starts[self.next + 1]
+        self.next += 1
+        when = datetime.datetime.fromordinal(int(date))
+        frequency = self.getFrequency()
+        ret = dict()
+        for i, row in zip(stream_index[lo:hi].tolist(), rows[lo:hi].tolist()):
+            instrument, columns = self.streams[i]
+            if instrument in ret:
+                raise Exception("Duplicate bars found for %s on %s" % (instrument, when))
+            if self.views:
+                ret[instrument] = BarView(columns, row, when, frequency)
+            else:
+                ret[instrument] = columns.bar(row, frequency)
+
+        self.current_datetime = when
+        return bar.Bars(ret)
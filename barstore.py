@@ -0,0 +1,212 @@
+""" Offline bar store indexed by instrument and year """
+import datetime
+import json
+import os
+import sys
+
+import numpy as np
+
+import barcache
+from barcache import BarColumns, COLUMNS
+
+STORE_DIR = ".bar_store"
+
+
+def to_ordinal(when):
+    """Converts a year, date or datetime to a date ordinal"""
+    if isinstance(when, int):
+        return datetime.date(when, 1, 1).toordinal()
+    if isinstance(when, datetime.datetime):
+        when = when.date()
+    return when.toordinal()
+
+
+def years_of(ordinals):
+    """Returns the calendar year of each date ordinal"""
+    days = np.asarray(ordinals) - datetime.date(1970, 1, 1).toordinal()
+    return days.astype("datetime64[D]").astype("datetime64[Y]").astype(int) + 1970
+
+
+class BarStore(object):
+    """
+    Bars for many instruments, kept on disk as one columnar block per year
+
+    An index maps each instrument to its blocks and the date range each
+    covers, so a range read only opens (memory-maps) the blocks it
+    overlaps. New years are appended as new blocks; bars for a year that
+    is already stored are merged into its block, newer rows winning.
+
+    Parameters
+    ----------
+    root : String (default = STORE_DIR)
+    Directory of the store
+    """
+    def __init__(self, root = STORE_DIR):
+        self.root = root
+        self.index = dict()
+        path = os.path.join(root, "index.json")
+        if os.path.exists(path):
+            with open(path) as f:
+                self.index = json.load(f)
+
+    def block_path(self, instrument, year):
+        return os.path.join(self.root, instrument, str(year))
+
+    def save_index(self):
+        if not os.path.isdir(self.root):
+            os.makedirs(self.root)
+        tmp = os.path.join(self.root, "index.json.%d" % os.getpid())
+        with open(tmp, "w") as f:
+            json.dump(self.index, f, indent=1, sort_keys=True)
+        os.rename(tmp, os.path.join(self.root, "index.json"))
+
+    def instruments(self):
+        return sorted(self.index)
+
+    def date_range(self, instrument):
+        """Returns first and last stored dates of an instrument"""
+        blocks = self.index[instrument]
+        first = min(block["start"] for block in blocks.values())
+        last = max(block["end"] for block in blocks.values())
+        return datetime.date.fromordinal(first), datetime.date.fromordinal(last)
+
+    def append(self, instrument, columns):
+        """
+        Adds bars to the store
+
+        Parameters
+        ----------
+        instrument : String
+
+        columns : BarColumns or dict of column arrays
+        Bars to add, in any date order
+        """
+        if isinstance(columns, BarColumns):
+            columns = dict((name, np.asarray(getattr(columns, name))) for name, dtype in COLUMNS)
+        years = years_of(columns["date"])
+        blocks = self.index.setdefault(instrument, dict())
+        for year in np.unique(years):
+            rows = dict((name, columns[name][years == year]) for name, dtype in COLUMNS)
+            key = str(year)
+            if key in blocks:
+                old = barcache.open_columns(self.block_path(instrument, year))
+                keep = ~np.in1d(old["date"], rows["date"])
+                rows = dict((name, np.concatenate([np.asarray(old[name])[keep], rows[name]]))
+                            for name, dtype in COLUMNS)
+            order = np.argsort(rows["date"], kind="mergesort")
+            rows = dict((name, rows[name][order]) for name in rows)
+            barcache.write_columns(self.block_path(instrument, year), rows)
+            blocks[key] = {"start": int(rows["date"][0]), "end": int(rows["date"][-1]),
+                           "rows": len(rows["date"])}
+        self.save_index()
+
+    def ingest_csv(self, instrument, path):
+        """Adds the bars of a Yahoo! Finance CSV file"""
+        self.append(instrument, barcache.parse_csv(path))
+
+    def ingest_yahoo(self, instruments, from_year, to_year, storage = ".instr_data"):
+        """Downloads bars with yahoofinance.build_feed's downloader and stores them"""
+        from pyalgotrade.tools import yahoofinance
+        if not os.path.exists(storage):
+            os.makedirs(storage)
+        for year in range(from_year, to_year + 1):
+            for instrument in instruments:
+                path = os.path.join(storage, "%s-%d-yahoofinance.csv" % (instrument, year))
+                if not os.path.exists(path):
+                    yahoofinance.download_daily_bars(instrument, year, path)
+                self.ingest_csv(instrument, path)
+
+    def read(self, instrument, start = None, end = None):
+        """
+        Returns the bars of an instrument within [start, end]
+
+        Only blocks overlapping the range are opened. The result is a list
+        of BarColumns, one per block, whose columns are views into the
+        memory-mapped block files.
+
+        Parameters
+        ----------
+        start, end : int year, date or datetime (default = None)
+        Inclusive bounds; None reads from the first or to the last bar
+        """
+        if instrument not in self.index:
+            raise KeyError("No bars stored for " + instrument)
+        lo = None if start is None else to_ordinal(start)
+        if end is None:
+            hi = None
+        elif isinstance(end, int):
+            hi = datetime.date(end, 12, 31).toordinal()
+        else:
+            hi = to_ordinal(end)
+
+        ret = []
+        blocks = self.index[instrument]
+        for key in sorted(blocks, key=int):
+            block = blocks[key]
+            if (lo is not None and block["end"] < lo) or (hi is not None and block["start"] > hi):
+                continue
+            location = self.block_path(instrument, key)
+            columns = BarColumns(barcache.open_columns(location), location)
+            ret.append(columns.slice(lo, hi))
+        return ret
+
+    def read_columns(self, instrument, start = None, end = None):
+        """Same as read, concatenated into one BarColumns"""
+        parts = self.read(instrument, start, end)
+        return BarColumns(dict((name, np.concatenate([getattr(part, name) for part in parts]
+                                                     + [np.zeros(0, dtype=dtype)]))
+                               for name, dtype in COLUMNS))
+
+    def build_feed(self, instruments, from_year, to_year, feed = None):
+        """
+        Returns a barcache.Feed over the stored bars of instruments
+
+        Same arguments as yahoofinance.build_feed, without the download.
+        """
+        if feed is None:
+            feed = barcache.Feed()
+        for instrument in instruments:
+            parts = [part for part in self.read(instrument, from_year, to_year) if len(part)]
+            if not parts:
+                raise KeyError("No bars stored for %s in %d-%d" % (instrument, from_year, to_year))
+            for part in parts:
+                feed.addBarsFromColumns(instrument, part)
+        return feed
+
+    def build_organization_feed(self, organization, from_year, to_year):
+        """Returns a feed over every instrument held by an organization"""
+        return self.build_feed(list(organization.get_weights()), from_year, to_year)
+
+    def matrix(self, instruments, start = None, end = None):
+        """
+        Reads instruments into a vectorized.BarMatrix in one bulk read
+
+        Rows are the union of the instruments' dates; missing bars are NaN.
+        """
+        from vectorized import from_columns
+        return from_columns(instruments, [self.read_columns(instrument, start, end)
+                                          for instrument in instruments])
+
+
+def main():
+    """
+    Ingests CSV files into the store
+
+    Usage: python barstore.py INSTRUMENT FILE [FILE ...]
+    Without arguments the bundled dia and orcl CSVs are ingested.
+    """
+    store = BarStore()
+    if len(sys.argv) > 2:
+        for path in sys.argv[2:]:
+            store.ingest_csv(sys.argv[1], path)
+    else:
+        for year in (2009, 2010, 2011):
+            store.ingest_csv("dia", "dia-%d.csv" % year)
+        store.ingest_csv("orcl", "orcl-2000.csv")
+
+    for instrument in store.instruments():
+        first, last = store.date_range(instrument)
+        print instrument + ": " + str(first) + " to " + str(last)
+
+if __name__ == "__main__":
+    main()
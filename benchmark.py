@@ -0,0 +1,331 @@
+""" Scaling benchmarks for players, strats and the optimizers on synthetic data """
+import datetime
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import time
+
+import numpy as np
+
+import barcache
+from barcache import BarColumns
+from players import Analyst, Organization
+
+BASELINE = "benchmark_baseline.json"
+# fast benchmarks are repeated for this long and the best run is kept
+MIN_SECONDS = 0.5
+# throughput may drop, and peak memory grow, this much before it is reported
+TOLERANCE = 0.2
+
+# analysts x instruments x bars, and instruments in each analyst's book
+SCALES = {
+    "small": dict(analysts=50, instruments=100, bars=252, book=10),
+    "medium": dict(analysts=200, instruments=500, bars=1260, book=20),
+    "full": dict(analysts=1000, instruments=2000, bars=2520, book=50),
+}
+SEED = 1234
+
+
+def business_days(count, start = datetime.date(2000, 1, 3)):
+    """Returns count weekday ordinals from start"""
+    days = np.arange(start.toordinal(), start.toordinal() + count * 7 // 5 + 7)
+    # ordinal 1 (0001-01-01) is a Monday
+    days = days[(days - 1) % 7 < 5]
+    return days[:count]
+
+
+def synthetic_bars(instruments, bars, seed = SEED, traded = 1.0):
+    """
+    Returns reproducible random walk bars as {instrument: BarColumns}
+
+    With traded below one each instrument only has a bar on about that
+    share of the days, as in a wide universe of thinly traded names.
+    Volumes are large enough that the broker's volume limit never binds.
+    """
+    random = np.random.RandomState(seed)
+    dates = business_days(bars)
+    ret = dict()
+    for i in range(instruments):
+        days = dates if traded >= 1 else dates[random.uniform(size=bars) < traded]
+        count = len(days)
+        start = random.uniform(20, 200)
+        close = start * np.exp(np.cumsum(random.normal(0.0003, 0.015, count)))
+        open_ = close * np.exp(random.normal(0, 0.005, count))
+        spread = np.abs(random.normal(0, 0.01, count))
+        columns = {
+            "date": days,
+            "open": open_,
+            "high": np.maximum(open_, close) * (1 + spread),
+            "low": np.minimum(open_, close) * (1 - spread),
+            "close": close,
+            "volume": np.floor(random.uniform(1e6, 1e7, count)),
+            "adj_close": close,
+        }
+        ret["s%04d" % i] = BarColumns(columns)
+    return ret
+
+
+def synthetic_books(analysts, instruments, book, seed = SEED):
+    """Returns reproducible (name, confidence, {instrument: weight}) analyst specs"""
+    random = np.random.RandomState(seed + 1)
+    names = sorted("s%04d" % i for i in range(instruments))
+    ret = []
+    for a in range(analysts):
+        held = random.choice(len(names), min(book, len(names)), replace=False)
+        weights = random.dirichlet(np.ones(len(held))) * random.uniform(0.5, 1.0)
+        ret.append(("analyst %d" % a, random.uniform(0.05, 0.5),
+                    dict((names[h], float(w)) for h, w in zip(held, weights))))
+    return ret
+
+
+def build_analysts(specs):
+    analysts = []
+    for name, confidence, weights in specs:
+        analyst = Analyst(name, confidence)
+        analyst.assign_weights(weights)
+        analysts.append(analyst)
+    return analysts
+
+
+def build_organization(specs):
+    org = Organization()
+    for analyst in build_analysts(specs):
+        org.add_analyst(analyst, 'given')
+    return org
+
+
+def build_feed(columns, views = True):
+    feed = barcache.Feed(views=views)
+    for instrument in sorted(columns):
+        feed.addBarsFromColumns(instrument, columns[instrument])
+    return feed
+
+
+def bench_assign_weight(scale):
+    specs = synthetic_books(scale["analysts"], scale["instruments"], scale["book"])
+    analysts = [Analyst(name, confidence) for name, confidence, weights in specs]
+    start = time.time()
+    for analyst, (name, confidence, weights) in zip(analysts, specs):
+        for instrument, weight in weights.iteritems():
+            analyst.assign_weight(instrument, weight)
+    seconds = time.time() - start
+    check = sum(sum(a.weights.values()) for a in analysts)
+    return seconds, sum(len(s[2]) for s in specs), "ops", check
+
+
+def bench_add_analyst(scale):
+    analysts = build_analysts(synthetic_books(scale["analysts"], scale["instruments"], scale["book"]))
+    org = Organization()
+    start = time.time()
+    for analyst in analysts:
+        org.add_analyst(analyst, 'given')
+    seconds = time.time() - start
+    return seconds, len(analysts), "ops", sum(org.get_weights().values())
+
+
+def bench_get_weights(scale, calls = 200):
+    org = build_organization(synthetic_books(scale["analysts"], scale["instruments"], scale["book"]))
+    start = time.time()
+    for i in range(calls):
+        weights = org.get_weights()
+        total = sum(weights[instrument] for instrument in weights)
+    seconds = time.time() - start
+    return seconds, calls, "ops", total
+
+
+def bench_normalize_confidence(scale, calls = 2000):
+    org = build_organization(synthetic_books(scale["analysts"], scale["instruments"], scale["book"]))
+    name = org.names[0]
+    start = time.time()
+    for i in range(calls):
+        org.set_confidence(name, 0.5)
+        org.normalize_confidence()
+    seconds = time.time() - start
+    return seconds, calls, "ops", org.get_confidence(name)
+
+
+def bench_orgstrat(scale):
+    import strats
+    specs = synthetic_books(scale["analysts"], scale["instruments"], scale["book"])
+    feed = build_feed(synthetic_bars(scale["instruments"], scale["bars"]))
+    strat = strats.OrgStrat(feed, build_organization(specs), verbose=False)
+    start = time.time()
+    strat.run()
+    return time.time() - start, scale["bars"], "bars", strat.getResult()
+
+
+def bench_orgstrat_sparse(scale):
+    """OrgStrat over a universe ten times wider, each name trading on a tenth of the bars"""
+    import strats
+    universe = 10 * scale["instruments"]
+    specs = synthetic_books(scale["analysts"], universe, scale["book"])
+    feed = build_feed(synthetic_bars(universe, scale["bars"], traded=0.1))
+    strat = strats.OrgStrat(feed, build_organization(specs), verbose=False)
+    start = time.time()
+    strat.run()
+    return time.time() - start, scale["bars"], "bars", strat.getResult()
+
+
+def bench_feed(scale, views = True):
+    from pyalgotrade import strategy
+
+    class CloseReader(strategy.BacktestingStrategy):
+        def __init__(self, feed):
+            strategy.BacktestingStrategy.__init__(self, feed)
+            self.total = 0.0
+
+        def onBars(self, bars):
+            for instrument in bars.getInstruments():
+                self.total += bars[instrument].getClose()
+
+    strat = CloseReader(build_feed(synthetic_bars(scale["instruments"], scale["bars"]), views))
+    start = time.time()
+    strat.run()
+    return time.time() - start, scale["instruments"] * scale["bars"], "bars", strat.total
+
+
+def bench_feed_basic(scale):
+    return bench_feed(scale, False)
+
+
+def bench_vectorized(scale):
+    import vectorized
+    specs = synthetic_books(scale["analysts"], scale["instruments"], scale["book"])
+    feed = build_feed(synthetic_bars(scale["instruments"], scale["bars"]))
+    start = time.time()
+    result = vectorized.run(vectorized.load_matrix(feed), build_organization(specs))
+    return time.time() - start, scale["bars"], "bars", result.get_result()
+
+
+def bench_screen(scale):
+    import screening
+    import vectorized
+    columns = synthetic_bars(scale["instruments"], scale["bars"])
+    names = sorted(columns)
+    matrix = vectorized.from_columns(names, [columns[name] for name in names])
+    start = time.time()
+    results = screening.crossover(matrix, screening.PERIODS)
+    return time.time() - start, len(results), "pairs", float(results["result"][0])
+
+
+def bench_rsi2(scale):
+    import rsi2
+    feed = build_feed(dict(s0000=synthetic_bars(1, scale["bars"])["s0000"]))
+    strat = rsi2.RSI2(feed, "s0000", 150, 5, 2, 90, 10)
+    start = time.time()
+    strat.run()
+    return time.time() - start, scale["bars"], "bars", strat.getResult()
+
+
+def bench_rsi2_sweep(scale):
+    import rsi2
+    feed = build_feed(dict(s0000=synthetic_bars(1, scale["bars"])["s0000"]))
+    start = time.time()
+    results = rsi2.sweep(feed, "s0000", range(150, 201, 10), range(5, 16), range(2, 11),
+                         range(75, 96, 2), range(5, 26, 2))
+    return time.time() - start, len(results), "combos", float(results["result"][0])
+
+
+BENCHMARKS = (
+    ("assign_weight", bench_assign_weight),
+    ("add_analyst", bench_add_analyst),
+    ("get_weights", bench_get_weights),
+    ("normalize_confidence", bench_normalize_confidence),
+    ("feed", bench_feed),
+    ("feed_basic", bench_feed_basic),
+    ("orgstrat", bench_orgstrat),
+    ("orgstrat_sparse", bench_orgstrat_sparse),
+    ("vectorized", bench_vectorized),
+    ("screen", bench_screen),
+    ("rsi2", bench_rsi2),
+    ("rsi2_sweep", bench_rsi2_sweep),
+)
+
+
+def run_case(name, scale):
+    """Runs one benchmark; called in a fresh process so peak memory is its own"""
+    function = dict(BENCHMARKS)[name]
+    seconds, items, unit, check = function(SCALES[scale])
+    spent = seconds
+    while spent < MIN_SECONDS:
+        again = function(SCALES[scale])[0]
+        seconds = min(seconds, again)
+        spent += again
+    return {"seconds": seconds, "throughput": items / max(seconds, 1e-9), "unit": unit + "/s",
+            "check": check, "peak_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+
+
+def run(scale = "small", names = None):
+    """Runs benchmarks, each in its own process; returns {name: measurements}"""
+    ret = dict()
+    for name, function in BENCHMARKS:
+        if names is not None and name not in names:
+            continue
+        pool = multiprocessing.Pool(1, maxtasksperchild=1)
+        try:
+            ret[name] = pool.apply(run_case, (name, scale))
+        finally:
+            pool.terminate()
+    return ret
+
+
+def compare(results, baseline, tolerance = TOLERANCE):
+    """Returns a list of regression messages against baseline measurements"""
+    ret = []
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        new, old = results[name], baseline[name]
+        if new["throughput"] < old["throughput"] * (1 - tolerance):
+            ret.append("%s: throughput %.1f %s, baseline %.1f" % (name, new["throughput"], new["unit"],
+                                                                  old["throughput"]))
+        if new["peak_kb"] > old["peak_kb"] * (1 + tolerance):
+            ret.append("%s: peak memory %d kB, baseline %d kB" % (name, new["peak_kb"], old["peak_kb"]))
+        if not np.isclose(new["check"], old["check"], rtol=1e-9):
+            ret.append("%s: result %r, baseline %r" % (name, new["check"], old["check"]))
+    return ret
+
+
+def main():
+    """
+    Usage: python benchmark.py [--scale=small|medium|full] [--only=NAME,...]
+                               [--baseline=FILE] [--save]
+
+    Results are compared with the baseline stored for the same scale;
+    --save replaces it with this run.
+    """
+    options = dict(arg[2:].split("=", 1) for arg in sys.argv[1:] if "=" in arg)
+    scale = options.get("scale", "small")
+    names = options["only"].split(",") if "only" in options else None
+    path = options.get("baseline", BASELINE)
+
+    sizes = SCALES[scale]
+    print "Scale %s: %d analysts x %d instruments x %d bars" % (scale, sizes["analysts"],
+                                                               sizes["instruments"], sizes["bars"])
+    results = run(scale, names)
+    for name, function in BENCHMARKS:
+        if name in results:
+            r = results[name]
+            print "%-22s %9.3f s %14.1f %-9s peak %8d kB" % (name, r["seconds"], r["throughput"],
+                                                             r["unit"], r["peak_kb"])
+
+    baselines = dict()
+    if os.path.exists(path):
+        with open(path) as f:
+            baselines = json.load(f)
+    if scale in baselines:
+        regressions = compare(results, baselines[scale])
+        for line in regressions:
+            print "REGRESSION " + line
+        if not regressions:
+            print "No regression against " + path
+    if "--save" in sys.argv:
+        baselines.setdefault(scale, dict()).update(results)
+        with open(path, "w") as f:
+            json.dump(baselines, f, indent=1, sort_keys=True)
+        print "Baseline saved to " + path
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,357 @@
+""" Checkpoints of OrgStrat runs, to resume or extend a backtest without replaying it """
+import datetime
+import os
+import sys
+import time
+
+import numpy as np
+from pyalgotrade import bar
+from pyalgotrade.broker import backtesting
+
+# bumped when the layout of a checkpoint changes
+FORMAT = 3
+REPORT_FIELDS = ("bars", "idle", "rebalances", "instruments", "orders", "skipped", "position_reads")
+
+
+class Checkpointer(object):
+    """
+    Writes an OrgStrat's state to path every few bars and on the last bar,
+    before its trade; pass it to OrgStrat as checkpoint
+
+    Each checkpoint replaces the previous one atomically, so path always
+    holds the latest complete checkpoint even if the run is killed while
+    writing.
+
+    The broker's equity sums positions in the iteration order of its
+    positions dict, and it processes orders, which compete for cash, in the
+    iteration order of its active orders dict. The order of a dict depends
+    on every insert and delete it has seen, so OrgStrat runs on a
+    RecordingBroker from broker(), and restore replays its logs into the
+    resumed run's broker; both then fill orders and add up equity as an
+    uninterrupted run does.
+
+    Parameters
+    ----------
+    path : String
+    .npz file to write
+
+    every : int (default = 21)
+    Bars between checkpoints
+    """
+    def __init__(self, path, every = 21):
+        self.path = path
+        self.every = every
+        self.bars = 0
+        self.written = 0
+        self.seconds = 0.0
+
+    def broker(self, feed, cash = 1000000):
+        """The broker OrgStrat runs on when given a checkpointer"""
+        return RecordingBroker(cash, feed)
+
+    def after_bar(self, strat):
+        self.bars += 1
+        if self.bars % self.every == 0:
+            self.write(strat)
+
+    def write(self, strat, trade_pending = False):
+        start = time.time()
+        save(strat, self.path, trade_pending)
+        self.written += 1
+        self.seconds += time.time() - start
+
+
+class RecordingBroker(backtesting.Broker):
+    """
+    Backtesting broker logging what its active orders and positions dicts
+    saw, in order
+
+    order_log holds the id of every order registered and minus the id of
+    every order unregistered, position_log (instrument, opened) for every
+    position opened or closed. The broker behaves exactly as
+    backtesting.Broker otherwise.
+    """
+    def __init__(self, cash, barFeed, commission = None):
+        backtesting.Broker.__init__(self, cash, barFeed, commission)
+        self.order_log = []
+        self.position_log = []
+
+    def _registerOrder(self, order):
+        backtesting.Broker._registerOrder(self, order)
+        self.order_log.append(order.getId())
+
+    def _unregisterOrder(self, order):
+        backtesting.Broker._unregisterOrder(self, order)
+        self.order_log.append(-order.getId())
+
+    def commitOrderExecution(self, order, dateTime, fillInfo):
+        instrument = order.getInstrument()
+        held = instrument in self.getPositions()
+        backtesting.Broker.commitOrderExecution(self, order, dateTime, fillInfo)
+        if (instrument in self.getPositions()) != held:
+            self.position_log.append((instrument, not held))
+
+
+def replay_orders(strat, order_log, active):
+    """
+    Replays order_log into strat's fresh broker: orders are submitted and
+    cancelled in their original order, so they get their original ids and
+    the active orders dict iterates as the logged one did
+
+    active maps the id of every order still active to its instrument and
+    signed quantity; the orders cancelled along the way are placeholders.
+    """
+    broker = strat.getBroker()
+    placeholder = strat.organization.instruments[0]
+    submitted = dict()
+    for op in order_log:
+        if op > 0:
+            instr, quantity = active.get(op, (placeholder, 1))
+            order = strat.marketOrder(instr, quantity)
+            if order.getId() != op:
+                raise ValueError("Checkpoints restore into a broker that has not taken orders yet")
+            submitted[op] = order
+        else:
+            broker.cancelOrder(submitted.pop(-op))
+
+
+def replay_positions(broker, position_log, shares):
+    """Opens and closes positions as logged, then sets the held shares"""
+    positions = broker.getPositions()
+    for instr, opened in position_log:
+        if opened:
+            positions[instr] = 0
+        else:
+            del positions[instr]
+    if set(positions) != set(shares):
+        raise ValueError("Checkpoint positions do not match their log")
+    # assigned one by one, as update() may resize the dict and reorder it
+    for instr, held in shares.items():
+        positions[instr] = held
+    if isinstance(broker, RecordingBroker):
+        broker.position_log = list(position_log)
+
+
+def save(strat, path, trade_pending = False):
+    """
+    Writes everything OrgStrat carries from one bar to the next to path
+
+    That is the organization's confidences and aggregate weights, the
+    update rule's previous closes, the schedule's counter, the confidence
+    history, the rebalance counters, and the broker's cash, positions,
+    active orders, which fill on their instrument's next bar, and the logs
+    of its RecordingBroker. With trade_pending, the bar has not traded yet
+    and restore leaves its trade to the resumed run.
+    """
+    org = strat.organization
+    broker = strat.getBroker()
+    if not isinstance(broker, RecordingBroker):
+        raise ValueError("Only runs on a Checkpointer's RecordingBroker can be checkpointed")
+    n_analysts = len(org.names)
+    n_instruments = len(org.instruments)
+    positions = broker.getPositions()
+    orders = sorted(broker.getActiveOrders(), key=lambda order: order.getId())
+    history = strat.history
+    report = strat.rebalances
+
+    arrays = {
+        "format": FORMAT,
+        "date": strat.getFeed().getCurrentDateTime().toordinal(),
+        "first_pass": strat.first_pass,
+        "trade_pending": trade_pending,
+        "update": strat.rule.name,
+        "names": np.array(org.names),
+        "instruments": np.array(org.instruments),
+        "confidences": org.confidences[:n_analysts],
+        "aggregate": org.aggregate[:n_instruments],
+        "cumul_confidence": org.cumul_confidence,
+        "updates": org.updates,
+        "cash": broker.getCash(),
+        "position_instruments": np.array(list(positions)),
+        "position_shares": np.array([positions[instr] for instr in positions], dtype=float),
+        "order_log": np.array(broker.order_log, dtype=np.int64),
+        "position_log_instruments": np.array([instr for instr, opened in broker.position_log]),
+        "position_log_opened": np.array([opened for instr, opened in broker.position_log], dtype=bool),
+        "order_ids": np.array([order.getId() for order in orders], dtype=np.int64),
+        "order_instruments": np.array([order.getInstrument() for order in orders]),
+        "order_quantities": np.array([order.getQuantity() if order.isBuy() else -order.getQuantity()
+                                      for order in orders], dtype=float),
+        "report": np.array([getattr(report, field) for field in REPORT_FIELDS], dtype=np.int64),
+        "history_dates": history.dates[:history.size],
+        "history_equity": history.equity[:history.size],
+        "history_confidences": history.confidences[:history.size],
+        "history_weights": history.weights[:history.size],
+        "history_analysts": np.array(history.analysts),
+        "history_instruments": np.array(history.instruments),
+    }
+    for key, value in strat.rule.state().items():
+        arrays["rule_" + key] = value
+    for key, value in strat.schedule.state().items():
+        arrays["schedule_" + key] = value
+
+    # write next to the target and rename, so a crash never leaves half a checkpoint
+    temp = path + ".tmp"
+    with open(temp, "wb") as f:
+        np.savez(f, **arrays)
+    os.rename(temp, path)
+
+
+def prefixed(data, prefix):
+    return dict((key[len(prefix):], data[key]) for key in data.files if key.startswith(prefix))
+
+
+def strings(values):
+    return [str(value) for value in values]
+
+
+def restore(strat, path):
+    """
+    Loads a checkpoint into a freshly built OrgStrat before it runs
+
+    strat must be built like the checkpointed one: the same organization
+    (analysts and books), update rule and schedule, over a barcache.Feed
+    holding the same bars up to the checkpoint and any number of bars
+    after it. The feed is moved past the checkpointed bars, so strat.run()
+    continues with the next bar and ends where an uninterrupted run would.
+    Analyzers attached to strat only see the bars after the checkpoint.
+    The final checkpoint of a run is taken before its last bar trades, and
+    strat makes that trade here instead, knowing the next bar, so calendar
+    schedules decide it as an uninterrupted run would.
+
+    Returns the datetime of the last checkpointed bar.
+    """
+    data = np.load(path)
+    if int(data["format"]) != FORMAT:
+        raise ValueError("Unsupported checkpoint format %d" % int(data["format"]))
+    org = strat.organization
+    if strings(data["names"]) != org.names or strings(data["instruments"]) != org.instruments:
+        raise ValueError("Checkpoint was written for a different organization")
+    if str(data["update"]) != strat.rule.name:
+        raise ValueError("Checkpoint was written with the %s update rule" % data["update"])
+
+    org.confidences[:len(org.names)] = data["confidences"]
+    org.aggregate[:len(org.instruments)] = data["aggregate"]
+    org.cumul_confidence = float(data["cumul_confidence"])
+    org.updates = int(data["updates"])
+    strat.rule.restore(prefixed(data, "rule_"))
+    strat.schedule.restore(prefixed(data, "schedule_"))
+    strat.first_pass = bool(data["first_pass"])
+    for field, value in zip(REPORT_FIELDS, data["report"]):
+        setattr(strat.rebalances, field, int(value))
+
+    history = strat.history
+    history.dates = data["history_dates"]
+    history.size = len(history.dates)
+    history.equity = data["history_equity"]
+    history.confidences = data["history_confidences"]
+    history.weights = data["history_weights"]
+    history.analysts = strings(data["history_analysts"])
+    history.instruments = strings(data["history_instruments"])
+    history.version = None
+
+    when = datetime.datetime.fromordinal(int(data["date"]))
+    strat.getFeed().seek(when)
+    broker = strat.getBroker()
+    broker.setCash(float(data["cash"]))
+    replay_positions(broker, zip(strings(data["position_log_instruments"]), data["position_log_opened"]),
+                     dict((instr, int(shares)) for instr, shares in zip(strings(data["position_instruments"]),
+                                                                       data["position_shares"])))
+    replay_orders(strat, data["order_log"].tolist(),
+                  dict((int(order_id), (instr, int(quantity))) for order_id, instr, quantity in
+                       zip(data["order_ids"], strings(data["order_instruments"]), data["order_quantities"])))
+    if bool(data["trade_pending"]):
+        feed = strat.getFeed()
+        last = [(instr, feed.getLastBar(instr)) for instr in feed.getRegisteredInstruments()]
+        strat.trade(bar.Bars(dict((instr, last_bar) for instr, last_bar in last
+                                  if last_bar is not None and last_bar.getDateTime() == when)))
+    return when
+
+
+def resume_matches(columns, specs, path, every = 21, **kwargs):
+    """
+    Runs OrgStrat over columns uninterrupted without a checkpointer, then
+    over its first two thirds with checkpoints and resumed from the last one over all of it
+
+    Returns the uninterrupted and resumed strategies, the checkpointer of
+    the partial run and whether both runs ended identically. kwargs are
+    passed to OrgStrat.
+    """
+    import benchmark
+    import strats
+
+    # a plain run, on a broker that records nothing
+    strat = strats.OrgStrat(benchmark.build_feed(columns), benchmark.build_organization(specs), **kwargs)
+    strat.run()
+
+    dates = np.unique(np.concatenate([cols.date for cols in columns.values()]))
+    # stop two thirds of the way in, at a bar that is not a multiple of the interval
+    cut = dates[2 * len(dates) // 3]
+    partial = dict((instr, cols.slice(None, cut)) for instr, cols in columns.items())
+    checkpointer = Checkpointer(path, every)
+    first = strats.OrgStrat(benchmark.build_feed(partial), benchmark.build_organization(specs),
+                            checkpoint = checkpointer, **kwargs)
+    first.run()
+
+    resumed = strats.OrgStrat(benchmark.build_feed(columns), benchmark.build_organization(specs), **kwargs)
+    restore(resumed, path)
+    resumed.run()
+    same = resumed.getResult() == strat.getResult() and \
+        np.array_equal(resumed.history.confidences[:len(resumed.history)],
+                       strat.history.confidences[:len(strat.history)])
+    return strat, resumed, checkpointer, same
+
+
+def main():
+    """
+    Checks that a run resumed from a checkpoint ends like an uninterrupted
+    run, on benchmark.py's synthetic data, then on a sparse universe where
+    instruments miss bars, with every update rule
+
+    Options: --analysts=N --instruments=N --bars=N --every=N --traded=FRACTION
+    """
+    import benchmark
+    import strats
+    import updates
+
+    options = dict(arg[2:].split("=", 1) for arg in sys.argv[1:] if "=" in arg)
+    bars = int(options.get("bars", 756))
+    instruments = int(options.get("instruments", 50))
+    every = int(options.get("every", 21))
+    specs = benchmark.synthetic_books(int(options.get("analysts", 20)), instruments, 10)
+    path = "orgstrat_checkpoint.npz"
+
+    start = time.time()
+    strat, resumed, checkpointer, same = resume_matches(benchmark.synthetic_bars(instruments, bars), specs,
+                                                        path, every)
+    print "Uninterrupted run: %.2f, resumed: %.2f, in %.2f s" % (strat.getResult(), resumed.getResult(),
+                                                                time.time() - start)
+    print "Partial run: %d checkpoints in %.3f s, %d bytes" % (checkpointer.written, checkpointer.seconds,
+                                                               os.path.getsize(path))
+    print "Identical to the uninterrupted run: " + str(same)
+    failed = not same
+
+    sparse = benchmark.synthetic_bars(instruments, bars, traded = float(options.get("traded", 0.6)))
+    # checkpointing itself must not change how the broker fills orders
+    plain = strats.OrgStrat(benchmark.build_feed(sparse), benchmark.build_organization(specs))
+    plain.run()
+    checkpointed = strats.OrgStrat(benchmark.build_feed(sparse), benchmark.build_organization(specs),
+                                   checkpoint = Checkpointer(path, every))
+    checkpointed.run()
+    same = checkpointed.getResult() == plain.getResult()
+    print "Sparse, run with checkpoints: %.2f, without: %.2f, identical: %s" % (
+        checkpointed.getResult(), plain.getResult(), same)
+    failed = failed or not same
+
+    for update in sorted(updates.RULES):
+        for schedule in (None, "drift", "weekly", "month_end"):
+            strat, resumed, checkpointer, same = resume_matches(sparse, specs, path, every,
+                                                                update = update, schedule = schedule)
+            print "Sparse, %s, %s: %.2f resumed as %.2f, identical: %s" % (
+                update, schedule or "every", strat.getResult(), resumed.getResult(), same)
+            failed = failed or not same
+    os.remove(path)
+    if failed:
+        sys.exit("Resumed runs differ from uninterrupted ones")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,523 @@
+""" Optimizer spread over machines: a coordinator hands out parameter chunks to workers holding the bars """
+import collections
+import itertools
+import multiprocessing
+import os
+import socket
+import threading
+import time
+import traceback
+from multiprocessing.connection import Client, Listener
+
+import pyalgotrade.logger
+from pyalgotrade.optimizer.server import Results
+
+import barcache
+import pooloptimizer
+import resultstore
+
+PORT = 5890
+# Connections are authenticated with this key and then exchange pickles,
+# so anyone holding it can run code on the coordinator and the workers.
+# It is public, so it is only used on loopback addresses; see authkey_for.
+AUTHKEY = "gimg-optimizer"
+# seconds of work aimed for in each chunk; workers report results within it
+TARGET_SECONDS = 10.0
+# seconds between result batches from a worker
+BATCH_SECONDS = 1.0
+# a worker silent for this long is taken for dead; must exceed one backtest
+TIMEOUT = 60.0
+# seconds an idle worker waits before asking for work again
+IDLE_SECONDS = 0.5
+# seconds a worker keeps trying to reach a coordinator that is not up yet
+CONNECT_SECONDS = 60.0
+
+logger = pyalgotrade.logger.getLogger("clusteroptimizer")
+
+
+def load_streams(spec, data_dir = ".", cache_dir = barcache.CACHE_DIR):
+    """
+    (instrument, BarColumns) streams of [(instrument, CSV path)] spec,
+    read through the local bar cache, with paths relative to data_dir
+    """
+    return [(instrument, barcache.load_csv(os.path.join(data_dir, path), cache_dir))
+            for instrument, path in spec]
+
+
+class Chunk(object):
+    """
+    Parameters handed to one worker
+
+    Results arrive in order, so parameters[:done] are finished and the
+    worker is running parameters[done:end]. Stealing moves end back.
+    """
+    def __init__(self, chunk_id, parameters):
+        self.id = chunk_id
+        self.parameters = parameters
+        self.done = 0
+        self.end = len(parameters)
+        self.owner = None
+
+    def remaining(self):
+        return self.end - self.done
+
+
+class Coordinator(object):
+    """
+    Hands out chunks of strategyParameters to workers and collects results
+
+    A worker is sent the strategy, fixed arguments, metric and the feed's
+    spec, loads the bars from its own disk and answers with their content
+    hash, so a worker with different data is turned away instead of
+    skewing the results. It then asks for chunks and reports results in
+    batches every BATCH_SECONDS.
+
+    Chunks are drawn lazily from strategyParameters and sized from the
+    measured run times, so a grid of millions of combinations is never
+    held in memory. Once it is exhausted, a worker asking for work steals
+    the last half of the largest unfinished chunk: the owner learns its
+    shorter end with the reply to its next batch, and results it ran past
+    that end are dropped. The unfinished part of the chunk of a worker
+    that disconnects or stays silent for timeout seconds goes back to the
+    front of the queue. Every combination is counted exactly once.
+
+    Parameters
+    ----------
+    strategyClass, args, metric, store
+    Same as pooloptimizer.run
+
+    spec : list of (String, String)
+    (instrument, CSV path) pairs, as passed to barcache.Feed.addBarsFromCSV.
+    Paths are relative to the data directory of each process.
+
+    strategyParameters : iterable of tuples
+    Consumed lazily
+
+    callback : function (default = None)
+    Called as callback(parameters, result, best) for every result
+    """
+    def __init__(self, strategyClass, spec, strategyParameters, args = (), callback = None,
+                 metric = "equity", store = None, data_dir = ".", target_seconds = TARGET_SECONDS,
+                 batch_seconds = BATCH_SECONDS, timeout = TIMEOUT):
+        self.strategy_class = strategyClass
+        self.spec = list(spec)
+        self.args = tuple(args)
+        self.callback = callback
+        self.metric = metric
+        self.store = store
+        self.batch_seconds = batch_seconds
+        self.timeout = timeout
+        streams = load_streams(self.spec, data_dir)
+        self.feed_hash = resultstore.feed_hash(streams)
+        self.group = None
+        if store is not None:
+            self.group = resultstore.group_key(strategyClass, streams, args, metric)
+            store.refresh()
+
+        self.parameters = iter(strategyParameters)
+        self.exhausted = False
+        self.sizer = pooloptimizer.ChunkSizer(target_seconds)
+        # chunks given back by dead workers or split off by stealing, handed out first
+        self.queue = collections.deque()
+        self.active = dict()
+        self.chunk_ids = itertools.count()
+        self.condition = threading.Condition()
+        self.best = None
+        self.error = None
+        self.finished = False
+        self.workers = set()
+        self.evaluated = 0
+        self.reused = 0
+        self.stolen = 0
+        self.requeued = 0
+        self.discarded = 0
+
+    def handle(self, params, result):
+        if result is not None and result == result and (self.best is None or result > self.best.getResult()):
+            self.best = Results(params, result)
+        if self.callback is not None:
+            self.callback(params, result, self.best)
+
+    def check_finished(self):
+        if self.error is not None or (self.exhausted and not self.queue and not self.active):
+            self.finished = True
+            self.condition.notify_all()
+
+    def draw(self):
+        """Next chunk of parameters not in the store, or None once they run out"""
+        while not self.exhausted:
+            parameters = list(itertools.islice(self.parameters, self.sizer.next_size()))
+            if not parameters:
+                self.exhausted = True
+                break
+            if self.store is not None:
+                missing = []
+                for params in parameters:
+                    result = self.store.get(self.group, params)
+                    if result is None:
+                        missing.append(params)
+                    else:
+                        self.reused += 1
+                        self.handle(params, result)
+                parameters = missing
+            if parameters:
+                return Chunk(next(self.chunk_ids), parameters)
+        return None
+
+    def steal(self, worker):
+        """Splits off the last half of the unfinished chunk with the most work left"""
+        victim = max(self.active.values(), key=Chunk.remaining) if self.active else None
+        if victim is None or victim.remaining() < 2:
+            return None
+        split = victim.end - victim.remaining() // 2
+        ret = Chunk(next(self.chunk_ids), victim.parameters[split:victim.end])
+        victim.end = split
+        self.stolen += len(ret.parameters)
+        logger.info("%s stole %d parameters from %s", worker, len(ret.parameters), victim.owner)
+        return ret
+
+    def assign(self, worker):
+        """Returns the next chunk for worker, or None if it should wait or stop"""
+        with self.condition:
+            if self.finished:
+                return None
+            if self.queue:
+                chunk = self.queue.popleft()
+            else:
+                chunk = self.draw() or self.steal(worker)
+            if chunk is None:
+                self.check_finished()
+                return None
+            chunk.owner = worker
+            self.active[chunk.id] = chunk
+            return chunk
+
+    def report(self, chunk, results, seconds):
+        """Records a batch of results of chunk and returns its current end"""
+        with self.condition:
+            self.sizer.record(len(results), seconds)
+            accepted = results[:max(0, chunk.end - chunk.done)]
+            for params, result in accepted:
+                if tuple(params) != tuple(chunk.parameters[chunk.done]):
+                    raise ValueError("Results of chunk %d arrived out of order" % chunk.id)
+                chunk.done += 1
+                self.handle(params, result)
+            self.evaluated += len(accepted)
+            self.discarded += len(results) - len(accepted)
+            if self.store is not None:
+                self.store.add(self.group, accepted)
+            if chunk.done >= chunk.end:
+                del self.active[chunk.id]
+                self.check_finished()
+            return chunk.end
+
+    def release(self, chunk):
+        """Puts back the unfinished part of the chunk of a lost worker"""
+        with self.condition:
+            if self.active.pop(chunk.id, None) is None or chunk.remaining() <= 0:
+                return
+            self.queue.appendleft(Chunk(next(self.chunk_ids), chunk.parameters[chunk.done:chunk.end]))
+            self.requeued += chunk.remaining()
+            logger.warning("Requeued %d parameters of %s", chunk.remaining(), chunk.owner)
+
+    def fail(self, error):
+        with self.condition:
+            if self.error is None:
+                self.error = error
+            self.check_finished()
+
+    def serve_worker(self, conn):
+        name = "worker"
+        chunk = None
+        try:
+            conn.send(("job", self.strategy_class, self.args, self.metric, self.spec, self.batch_seconds))
+            while True:
+                if not conn.poll(self.timeout):
+                    logger.warning("%s silent for %d s", name, self.timeout)
+                    break
+                message = conn.recv()
+                kind = message[0]
+                if kind == "hello":
+                    name, digest = message[1:]
+                    if digest != self.feed_hash:
+                        logger.warning("Rejected %s: its bars differ from the coordinator's", name)
+                        conn.send(("reject", "bars differ from the coordinator's"))
+                        break
+                    with self.condition:
+                        self.workers.add(name)
+                    logger.info("%s joined", name)
+                    conn.send(("accepted",))
+                elif kind == "ready":
+                    if chunk is not None:
+                        self.release(chunk)
+                    chunk = self.assign(name)
+                    if chunk is not None:
+                        conn.send(("chunk", chunk.id, chunk.parameters))
+                    elif self.finished:
+                        conn.send(("stop",))
+                        break
+                    else:
+                        conn.send(("wait", IDLE_SECONDS))
+                elif kind == "results":
+                    conn.send(("end", chunk.id, self.report(chunk, message[1], message[2])))
+                elif kind == "error":
+                    self.fail(message[1])
+                    break
+        except (EOFError, IOError, OSError):
+            logger.warning("Lost %s", name)
+        except Exception:
+            self.fail(traceback.format_exc())
+        finally:
+            if chunk is not None:
+                self.release(chunk)
+            conn.close()
+
+    def accept(self, listener):
+        while not self.finished:
+            try:
+                conn = listener.accept()
+            except multiprocessing.AuthenticationError:
+                logger.warning("Refused a connection with the wrong authkey")
+                continue
+            except (EOFError, IOError, OSError):
+                # the listener was closed or the client went away during the handshake
+                if self.finished:
+                    return
+                continue
+            thread = threading.Thread(target=self.serve_worker, args=(conn,))
+            thread.daemon = True
+            thread.start()
+
+    def serve(self, listener):
+        """
+        Serves workers connecting to listener until every parameter has a
+        result, and returns the best as pyalgotrade Results
+        """
+        thread = threading.Thread(target=self.accept, args=(listener,))
+        thread.daemon = True
+        thread.start()
+        try:
+            with self.condition:
+                while not self.finished:
+                    # a timeout keeps the wait interruptible with Ctrl-C
+                    self.condition.wait(1)
+        finally:
+            self.finished = True
+            # the accept thread keeps the listening socket open until accept returns
+            try:
+                socket.create_connection(listener.address, 1).close()
+            except socket.error:
+                pass
+            thread.join(1)
+        if self.error is not None:
+            raise Exception("Strategy run failed in worker:\n" + self.error)
+        return self.best
+
+    def summary(self):
+        return ("%d workers evaluated %d parameters, %d reused from the store, %d stolen, %d requeued, "
+                "%d results dropped" % (len(self.workers), self.evaluated, self.reused, self.stolen,
+                                        self.requeued, self.discarded))
+
+
+def run(strategyClass, spec, strategyParameters, address = ("localhost", PORT), authkey = None,
+        args = (), callback = None, metric = "equity", store = None, data_dir = ".",
+        target_seconds = TARGET_SECONDS):
+    """
+    Runs a coordinator on address until workers started with work() have
+    evaluated every parameter tuple; see Coordinator
+
+    Bind to ("", PORT) with an authkey of your own to accept workers from
+    other machines. Returns pyalgotrade.optimizer.server.Results with the
+    best parameters.
+    """
+    authkey = authkey_for(address, authkey)
+    coordinator = Coordinator(strategyClass, spec, strategyParameters, args, callback, metric, store,
+                              data_dir, target_seconds)
+    listener = Listener(address, authkey=authkey)
+    logger.info("Coordinator listening on %s:%d", *listener.address)
+    try:
+        best = coordinator.serve(listener)
+    finally:
+        listener.close()
+    logger.info(coordinator.summary())
+    return best
+
+
+def parse_address(text):
+    """(host, port) of HOST:PORT, or of PORT on localhost"""
+    host, sep, port = text.rpartition(":")
+    return host or "localhost", int(port)
+
+
+def is_loopback(host):
+    """Whether host resolves to this machine's loopback interface"""
+    if not host:
+        # every interface
+        return False
+    try:
+        return socket.gethostbyname(host).startswith("127.")
+    except socket.error:
+        return False
+
+
+def authkey_for(address, authkey = None):
+    """
+    Returns authkey, or AUTHKEY when address is a loopback address
+
+    AUTHKEY is public, so a coordinator listening on, or a worker connecting
+    to, any other address needs a key of its own: ValueError otherwise.
+    """
+    if authkey:
+        return authkey
+    if not is_loopback(address[0]):
+        raise ValueError("%s is not a loopback address: an authkey shared by the coordinator and "
+                         "its workers is required" % (address[0] or "Binding every interface"))
+    return AUTHKEY
+
+
+def connect(address, authkey, seconds = CONNECT_SECONDS):
+    deadline = time.time() + seconds
+    while True:
+        try:
+            return Client(tuple(address), authkey=authkey)
+        except socket.error:
+            if time.time() >= deadline:
+                raise
+            time.sleep(IDLE_SECONDS)
+
+
+def work(address, authkey = None, data_dir = ".", name = None):
+    """
+    Evaluates chunks for the coordinator at address until it has no more
+
+    Bars are loaded from data_dir by the spec the coordinator sends. authkey
+    is required unless address is a loopback address, see authkey_for.
+    Returns the number of backtests run.
+    """
+    if name is None:
+        name = "%s-%d" % (socket.gethostname(), os.getpid())
+    conn = connect(address, authkey_for(address, authkey))
+    count = 0
+    try:
+        kind, strategy_class, args, metric, spec, batch_seconds = conn.recv()
+        streams = load_streams(spec, data_dir)
+        conn.send(("hello", name, resultstore.feed_hash(streams)))
+        reply = conn.recv()
+        if reply[0] == "reject":
+            raise Exception("Coordinator rejected %s: %s" % (name, reply[1]))
+        while True:
+            conn.send(("ready",))
+            reply = conn.recv()
+            if reply[0] == "stop":
+                break
+            if reply[0] == "wait":
+                time.sleep(reply[1])
+                continue
+            kind, chunk_id, parameters = reply
+            end = len(parameters)
+            i = 0
+            batch = []
+            start = time.time()
+            while i < end:
+                try:
+                    result = pooloptimizer.backtest(strategy_class, streams, args, metric, parameters[i])
+                except Exception:
+                    conn.send(("error", traceback.format_exc()))
+                    return count
+                batch.append((parameters[i], result))
+                i += 1
+                count += 1
+                if i >= end or time.time() - start >= batch_seconds:
+                    conn.send(("results", batch, time.time() - start))
+                    # the end moves back when the rest of the chunk is stolen
+                    end = conn.recv()[2]
+                    batch = []
+                    start = time.time()
+    except EOFError:
+        # the coordinator finished and went away
+        pass
+    finally:
+        conn.close()
+    return count
+
+
+def run_local(strategyClass, spec, strategyParameters, workerCount = None, args = (), callback = None,
+              metric = "equity", store = None, data_dir = ".", target_seconds = TARGET_SECONDS,
+              authkey = AUTHKEY):
+    """
+    Same as run, with workerCount worker processes on this machine talking
+    to the coordinator over localhost; defaults to the number of CPUs
+    """
+    if workerCount is None:
+        workerCount = multiprocessing.cpu_count()
+    coordinator = Coordinator(strategyClass, spec, strategyParameters, args, callback, metric, store,
+                              data_dir, target_seconds)
+    listener = Listener(("localhost", 0), authkey=authkey)
+    workers = [multiprocessing.Process(target=work, args=(listener.address, authkey, data_dir))
+               for i in range(workerCount)]
+    try:
+        for worker in workers:
+            worker.start()
+        best = coordinator.serve(listener)
+        for worker in workers:
+            worker.join()
+    finally:
+        listener.close()
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+    logger.info(coordinator.summary())
+    return best
+
+
+def main():
+    """
+    Tunes RSI2 on the dia bars with a coordinator and worker processes on
+    localhost, kills one worker partway through, and checks the results
+    against backtests run one by one
+
+    Options: --workers=N --combinations=N --kill=SECONDS
+    """
+    import sys
+    import rsi2
+    import tutorialOptimizer
+
+    options = dict(arg[2:].split("=", 1) for arg in sys.argv[1:] if "=" in arg)
+    count = int(options.get("combinations", 150))
+    grid = list(itertools.islice(tutorialOptimizer.parameters_generator(), count))
+    results = dict()
+
+    def collect(params, result, best):
+        results[params] = results.get(params, ()) + (result,)
+
+    coordinator = Coordinator(rsi2.RSI2, tutorialOptimizer.FEED_FILES, iter(grid), callback=collect,
+                              target_seconds=1.0)
+    listener = Listener(("localhost", 0), authkey=AUTHKEY)
+    workers = [multiprocessing.Process(target=work, args=(listener.address,))
+               for i in range(int(options.get("workers", 3)))]
+    for worker in workers:
+        worker.start()
+    # simulate a node failing partway through
+    killer = threading.Timer(float(options.get("kill", 3.0)), os.kill, (workers[0].pid, 9))
+    killer.start()
+    start = time.time()
+    best = coordinator.serve(listener)
+    seconds = time.time() - start
+    killer.cancel()
+    for worker in workers:
+        worker.join()
+    listener.close()
+    print coordinator.summary()
+    print "Best %s %s in %.1f s" % (best.getParameters(), best.getResult(), seconds)
+
+    streams = load_streams(tutorialOptimizer.FEED_FILES)
+    expected = dict((params, pooloptimizer.backtest(rsi2.RSI2, streams, (), "equity", params)) for params in grid)
+    once = sorted(results) == sorted(expected) and all(len(r) == 1 for r in results.values())
+    print "Every combination evaluated exactly once: " + str(once)
+    same = once and all(results[p][0] == expected[p] for p in expected)
+    print "Matches backtests run one by one: " + str(same)
+    if not same:
+        sys.exit("The cluster run differs from backtests run one by one")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,269 @@
+"""
+Command-line entry point: python gimg.py {backtest,optimize,worker,screen,status,plot} ...
+
+Only the standard library is imported up front. Each subcommand imports
+what it uses when it runs, so plotting (matplotlib) and network modules
+are never loaded by headless or offline commands, and a scripted batch
+pays only for the work it asks for.
+"""
+import argparse
+import json
+
+
+def load_organization(path):
+    """
+    Builds an Organization from a JSON file of [name, confidence,
+    {instrument: weight}] analysts, with their confidences given
+    """
+    from players import Analyst, Organization
+
+    with open(path) as f:
+        specs = json.load(f)
+    org = Organization()
+    for name, confidence, weights in specs:
+        analyst = Analyst(str(name), confidence)
+        analyst.assign_weights(dict((str(instr), weight) for instr, weight in weights.items()))
+        org.add_analyst(analyst, 'given')
+    return org
+
+
+def load_feed(organization, args):
+    """Bars from --csv INSTRUMENT=FILE options, or the bar store for --from to --to"""
+    import barcache
+    import barstore
+
+    if not args.csv:
+        return barstore.BarStore().build_organization_feed(organization, args.from_year, args.to_year)
+    feed = barcache.Feed()
+    for option in args.csv:
+        instrument, path = option.split("=", 1)
+        feed.addBarsFromCSV(instrument, path)
+    return feed
+
+
+def backtest(args):
+    import strats
+
+    org = strats.example_organization() if args.analysts is None else load_organization(args.analysts)
+    feed = load_feed(org, args)
+    checkpointer = None
+    if args.checkpoint is not None:
+        from checkpoint import Checkpointer
+        checkpointer = Checkpointer(args.checkpoint, args.every)
+    strats.backtest(org, feed, args.plot, args.profile, args.history, checkpointer, args.resume,
+                    args.image, period = args.period, update = args.update, gamma = args.gamma,
+                    schedule = args.schedule, min_trade = args.min_trade)
+
+
+def optimize(args):
+    store = None
+    if args.store is not None and args.method != "sweep":
+        import resultstore
+        store = resultstore.ResultStore(args.store)
+
+    if args.method == "genetic":
+        import strats_genetic
+        strats_genetic.search(args.generations, args.population, args.seed, args.workers, store)
+        return
+
+    import tutorialOptimizer
+    feed = tutorialOptimizer.load_feed()
+    if args.method == "sweep":
+        tutorialOptimizer.run_sweep(feed)
+    elif args.method == "pool":
+        tutorialOptimizer.run_pool(feed, args.workers, store)
+    elif args.method == "halving":
+        tutorialOptimizer.run_halving(feed, args.workers, args.metric, store)
+    elif args.method == "cluster":
+        import clusteroptimizer
+        address = None
+        if args.bind is not None:
+            address = clusteroptimizer.parse_address(args.bind)
+            check_authkey(address, args.authkey)
+        tutorialOptimizer.run_cluster(args.workers, address, store, args.authkey)
+    if store is not None:
+        tutorialOptimizer.print_store(store, feed, args.metric)
+
+
+def check_authkey(address, authkey):
+    """Exits, before any data is loaded, when address needs an --authkey"""
+    import clusteroptimizer
+
+    try:
+        clusteroptimizer.authkey_for(address, authkey)
+    except ValueError as e:
+        raise SystemExit(str(e))
+
+
+def worker(args):
+    import clusteroptimizer
+
+    address = clusteroptimizer.parse_address(args.address)
+    check_authkey(address, args.authkey)
+    clusteroptimizer.work(address, args.authkey, args.data)
+
+
+def screen(args):
+    import screening
+    import vectorized
+
+    if args.csv:
+        import barcache
+        instruments = []
+        columns = []
+        for option in args.csv:
+            instrument, path = option.split("=", 1)
+            instruments.append(instrument)
+            columns.append(barcache.load_csv(path))
+        matrix = vectorized.from_columns(instruments, columns)
+    else:
+        import barstore
+        store = barstore.BarStore()
+        matrix = store.matrix(store.instruments(), args.from_year, args.to_year)
+    results = screening.STRATEGIES[args.strategy](matrix, screening.parse_periods(args.periods))
+    print screening.report(results if args.pairs else screening.best(results), args.top)
+
+
+def status(args):
+    import barstore
+
+    store = barstore.BarStore()
+    instruments = store.instruments()
+    print "Bar store %s: %d instruments" % (store.root, len(instruments))
+    for instrument in instruments:
+        first, last = store.date_range(instrument)
+        print "  %-8s %s to %s" % (instrument, first, last)
+
+    if args.analysts is not None:
+        org = load_organization(args.analysts)
+        print "Organization: %d analysts, %d instruments" % (len(org.names), len(org.instruments))
+        org.print_confidence()
+
+    if args.history is not None:
+        from history import ConfidenceHistory
+        history = ConfidenceHistory.load(args.history)
+        dates = history.datetimes()
+        print "History %s: %d bars, %d analysts, %d instruments" % (
+            args.history, len(history), len(history.analysts), len(history.instruments))
+        if dates:
+            print "  %s to %s" % (dates[0].date(), dates[-1].date())
+            for name, confidence in sorted(history.at(dates[-1]).items(), key=lambda item: -item[1]):
+                print "  %-24s %.4f" % (name, confidence)
+
+    if args.checkpoint is not None:
+        import datetime
+        import numpy as np
+        data = np.load(args.checkpoint)
+        print "Checkpoint %s: after %s, %d analysts, cash %.2f, %d positions, %d pending orders" % (
+            args.checkpoint, datetime.date.fromordinal(int(data["date"])), len(data["names"]),
+            float(data["cash"]), len(data["position_instruments"]), len(data["order_ids"]))
+
+
+def plot(args):
+    import plotting
+    from history import ConfidenceHistory
+
+    history = ConfidenceHistory.load(args.history)
+    instruments = plotting.largest(history, args.instruments)
+    matrix = None
+    if instruments:
+        import vectorized
+        if args.csv:
+            matrix = vectorized.load_matrix(load_feed(None, args), instruments)
+        else:
+            import barstore
+            store = barstore.BarStore()
+            missing = [instr for instr in instruments if instr not in store.instruments()]
+            if missing:
+                print "No bars stored for %s, plotting without them" % ", ".join(missing)
+                instruments = [instr for instr in instruments if instr not in missing]
+            if instruments:
+                matrix = store.matrix(instruments)
+    history.plot(args.image, args.points, matrix, instruments)
+
+
+def parser():
+    ret = argparse.ArgumentParser(description="Backtests and tunes analyst organizations")
+    commands = ret.add_subparsers()
+
+    run = commands.add_parser("backtest", help="run OrgStrat and save its confidence history")
+    run.add_argument("--analysts", help="JSON file of [name, confidence, {instrument: weight}] "
+                                        "analysts; defaults to the example organization")
+    run.add_argument("--csv", action="append", metavar="INSTRUMENT=FILE",
+                     help="read bars from CSV files instead of the bar store")
+    run.add_argument("--from", dest="from_year", type=int, default=2014)
+    run.add_argument("--to", dest="to_year", type=int, default=2015)
+    run.add_argument("--update", default="geometric", help="confidence update rule, see updates.RULES")
+    run.add_argument("--gamma", type=float, default=0.5)
+    run.add_argument("--period", type=int, default=10)
+    run.add_argument("--schedule", help="weekly, month_end or drift:THRESHOLD")
+    run.add_argument("--min-trade", dest="min_trade", type=int, default=0)
+    run.add_argument("--history", default="orgstrat_history.npz")
+    run.add_argument("--profile", metavar="FILE", help="write a phase profile to FILE")
+    run.add_argument("--checkpoint", metavar="FILE", help="write checkpoints to FILE")
+    run.add_argument("--every", type=int, default=21, help="bars between checkpoints")
+    run.add_argument("--resume", metavar="FILE", help="continue from a checkpoint")
+    run.add_argument("--plot", action="store_true", help="plot the run (imports matplotlib)")
+    run.add_argument("--image", help="render the plot to an image file, without a display")
+    run.set_defaults(command=backtest)
+
+    opt = commands.add_parser("optimize", help="tune RSI2 on the dia bars, or OrgStrat with genetic")
+    opt.add_argument("--method", choices=("sweep", "pool", "halving", "cluster", "genetic"), default="sweep")
+    opt.add_argument("--workers", type=int, help="processes to run on; for cluster, local workers to start")
+    opt.add_argument("--bind", metavar="HOST:PORT",
+                     help="cluster: serve workers started with the worker command instead of local ones")
+    opt.add_argument("--authkey", help="cluster: key shared with the workers; required unless --bind "
+                                       "is a loopback address")
+    opt.add_argument("--metric", choices=("equity", "sharpe"), default="equity")
+    opt.add_argument("--generations", type=int, default=10)
+    opt.add_argument("--population", type=int, default=24)
+    opt.add_argument("--seed", type=int, default=0)
+    opt.add_argument("--store", default=".result_store",
+                     help="reuse and keep results in this file (pool, halving, cluster and genetic)")
+    opt.add_argument("--no-store", dest="store", action="store_const", const=None)
+    opt.set_defaults(command=optimize)
+
+    work = commands.add_parser("worker", help="evaluate chunks for an optimize --method cluster --bind run")
+    work.add_argument("address", metavar="HOST:PORT")
+    work.add_argument("--data", default=".", help="directory holding the coordinator's CSV files")
+    work.add_argument("--authkey", help="key shared with the coordinator; required unless it runs on "
+                                        "a loopback address")
+    work.set_defaults(command=worker)
+
+    scr = commands.add_parser("screen", help="rank instruments under an SMA strategy for a range of periods")
+    scr.add_argument("--strategy", choices=("momentum", "crossover"), default="crossover",
+                     help="momentumStrat or sma_crossover rules")
+    scr.add_argument("--periods", default="5:100:5", metavar="LO:HI[:STEP]", help="SMA periods to try")
+    scr.add_argument("--csv", action="append", metavar="INSTRUMENT=FILE",
+                     help="read bars from CSV files instead of the bar store")
+    scr.add_argument("--from", dest="from_year", type=int, help="first year read from the bar store")
+    scr.add_argument("--to", dest="to_year", type=int, help="last year read from the bar store")
+    scr.add_argument("--top", type=int, default=20, help="rows printed")
+    scr.add_argument("--pairs", action="store_true",
+                     help="rank every (instrument, period) pair instead of each instrument's best period")
+    scr.set_defaults(command=screen)
+
+    stat = commands.add_parser("status", help="summarize the bar store and saved runs")
+    stat.add_argument("--analysts", help="JSON file of analysts, as for backtest")
+    stat.add_argument("--history", help="saved confidence history")
+    stat.add_argument("--checkpoint", help="saved checkpoint")
+    stat.set_defaults(command=status)
+
+    draw = commands.add_parser("plot", help="plot a saved confidence history")
+    draw.add_argument("history", nargs="?", default="orgstrat_history.npz")
+    draw.add_argument("--image", help="write to an image file instead of a window")
+    draw.add_argument("--points", type=int, help="points kept per series")
+    draw.add_argument("--instruments", type=int, default=0,
+                      help="also plot the closes of this many of the largest holdings")
+    draw.add_argument("--csv", action="append", metavar="INSTRUMENT=FILE",
+                      help="read their bars from CSV files instead of the bar store")
+    draw.set_defaults(command=plot)
+    return ret
+
+
+def main(argv = None):
+    args = parser().parse_args(argv)
+    args.command(args)
+
+if __name__ == "__main__":
+    main()
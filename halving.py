@@ -0,0 +1,178 @@
+""" Successive-halving search: score every candidate on a short prefix of the feed, keep the best """
+import datetime
+import itertools
+import math
+import shutil
+import tempfile
+import zlib
+
+import numpy as np
+
+import pooloptimizer
+
+
+class HalvingRound(object):
+    """ Candidates scored on the first `bars` bars of the feed """
+    def __init__(self, bars, end, candidates, best):
+        self.bars = bars
+        self.end = end
+        self.candidates = candidates
+        self.best = best
+
+
+class HalvingResult(object):
+    """
+    Outcome of a successive-halving search
+
+    Cost is counted in bars processed (candidates x window length), which
+    is what the backtest time of an event-driven strategy scales with.
+    """
+    def __init__(self, best, rounds, total_bars, total_candidates):
+        self.best = best
+        self.rounds = rounds
+        self.cost = sum(r.bars * r.candidates for r in rounds)
+        self.exhaustive_cost = total_bars * total_candidates
+
+    def getParameters(self):
+        return self.best.getParameters()
+
+    def getResult(self):
+        return self.best.getResult()
+
+    def saved(self):
+        """Share of the exhaustive run's bars that were not processed"""
+        if self.exhaustive_cost == 0:
+            return 0.0
+        return 1.0 - float(self.cost) / self.exhaustive_cost
+
+    def report(self):
+        lines = []
+        for r in self.rounds:
+            lines.append("%8d candidates on %4d bars (to %s), best %s %s"
+                         % (r.candidates, r.bars, r.end.date(), r.best.getParameters(), r.best.getResult()))
+        lines.append("Processed %d bars instead of %d: %.1f%% of the compute saved"
+                     % (self.cost, self.exhaustive_cost, 100 * self.saved()))
+        return "\n".join(lines)
+
+
+def windows(total_bars, first_bars, growth, warmup = 0):
+    """
+    Returns the increasing prefix lengths, ending with the whole feed
+
+    Each prefix is warmup bars longer than first_bars times a power of
+    growth.
+    """
+    assert first_bars > 0 and growth > 1 and warmup >= 0
+    ret = []
+    bars = first_bars
+    while warmup + bars < total_bars:
+        ret.append(warmup + bars)
+        bars = int(math.ceil(bars * growth))
+    ret.append(total_bars)
+    return ret
+
+
+def rank(score):
+    """
+    Sort key putting the best results first
+
+    NaN (e.g. a Sharpe ratio without trades) and None rank last. Equal
+    results, such as those of candidates that never traded, are ordered by
+    a hash of their parameters rather than by their position in the grid.
+    """
+    result, params = score
+    if result is None or result != result:
+        result = -np.inf
+    return -result, zlib.crc32(repr(params))
+
+
+def run(strategyClass, barFeed, strategyParameters, first_bars = 252, keep = 0.25, growth = 2,
+        metric = "equity", workerCount = None, args = (), verbose = True, store = None, warmup = 0,
+        chunk_size = 100000):
+    """
+    Searches parameters by successive halving
+
+    Every candidate is backtested on the first warmup + first_bars bars.
+    The best keep fraction is backtested again on a window growth times
+    longer past the warm-up, and so on until the survivors have run over
+    the whole feed. Runs go through pooloptimizer, so all rounds share the
+    same memory-mapped bars.
+
+    Parameters
+    ----------
+    strategyClass, barFeed, workerCount, args, store
+    Same as pooloptimizer.run; stored results are keyed by window, so a
+    rerun only backtests the windows and candidates that changed
+
+    strategyParameters : iterable of tuples
+    Candidates, read chunk_size at a time
+
+    first_bars : int (default = 252)
+    Bars past the warm-up in the first window, about a year of daily bars
+
+    keep : float (default = 0.25)
+    Share of candidates surviving each round
+
+    growth : float (default = 2)
+    Window length multiplier between rounds
+
+    metric : String (default = "equity")
+    "equity" or "sharpe", see pooloptimizer.attach_metric
+
+    warmup : int (default = 0)
+    Bars the strategy needs before it can trade, such as its longest
+    indicator period; without them short windows rank most candidates
+    alike, as not having traded
+
+    chunk_size : int (default = 100000)
+    Candidates read at once in the first round. After each chunk it keeps
+    the best keep share of the candidates read so far, so memory holds a
+    chunk and the survivors; a candidate dropped early does not come back
+    if later chunks turn out weaker, which only matters near the cut.
+
+    Returns
+    -------
+    HalvingResult
+    """
+    assert 0 < keep < 1 and chunk_size > 0
+    directory = tempfile.mkdtemp(prefix="halving-")
+    try:
+        streams = pooloptimizer.share_feed(barFeed, directory)
+        dates = np.unique(np.concatenate([columns.date for instrument, columns in streams]))
+        rounds = []
+        parameters = iter(strategyParameters)
+        candidates = None
+        total_candidates = 0
+        for bars in windows(len(dates), first_bars, growth, warmup):
+            end = int(dates[bars - 1])
+            window = [(instrument, columns.slice(None, end)) for instrument, columns in streams]
+            # the first round reads the parameters in chunks, later ones rerun the survivors
+            chunks = iter(lambda: list(itertools.islice(parameters, chunk_size)), []) \
+                if candidates is None else [candidates]
+            survivors = []
+            best = None
+            count = 0
+            for chunk in chunks:
+                scores = []
+                record = lambda params, result, best: scores.append((result, params))
+                chunk_best = pooloptimizer.run_streams(strategyClass, window, chunk, workerCount, args,
+                                                       record, metric=metric, store=store)
+                if chunk_best is not None and (best is None or chunk_best.getResult() > best.getResult()):
+                    best = chunk_best
+                count += len(chunk)
+                keeping = max(1, int(math.ceil(count * keep)))
+                survivors = sorted(survivors + scores, key=rank)[:keeping]
+            if candidates is None:
+                total_candidates = count
+            if best is None:
+                raise Exception("No candidate produced a result on the first %d bars" % bars)
+            rounds.append(HalvingRound(bars, datetime.datetime.fromordinal(end), count, best))
+            if verbose:
+                print "%d candidates on %d bars, best %s %s" % (count, bars, best.getParameters(),
+                                                                best.getResult())
+            if bars == len(dates):
+                break
+            candidates = [params for result, params in survivors]
+        return HalvingResult(best, rounds, len(dates), total_candidates)
+    finally:
+        shutil.rmtree(directory, True)
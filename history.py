@@ -0,0 +1,158 @@
+""" Array-backed time series of analyst confidences and organization weights """
+import datetime
+import sys
+
+import numpy as np
+
+
+class ConfidenceHistory(object):
+    """
+    Confidences (bars x analysts), organization weights (bars x
+    instruments) and the strategy's equity recorded once per bar
+
+    Rows are preallocated and grown by doubling, so recording a bar is two
+    slice assignments. Analysts and instruments added to the organization
+    during a run get new columns, NaN before they joined.
+
+    Parameters
+    ----------
+    capacity : int (default = 256)
+    Rows allocated up front, e.g. the number of bars in the feed
+    """
+    def __init__(self, capacity = 256):
+        self.size = 0
+        self.dates = np.zeros(capacity, dtype=np.int64)
+        self.equity = np.zeros(capacity)
+        self.analysts = []
+        self.instruments = []
+        self.confidences = np.zeros((capacity, 0))
+        self.weights = np.zeros((capacity, 0))
+        self.version = None
+        self.slots = np.zeros(0, dtype=int)
+
+    def __len__(self):
+        return self.size
+
+    def reserve(self, rows, analysts, instruments):
+        """Grows the arrays to at least rows x analysts and rows x instruments"""
+        capacity = len(self.dates)
+        if rows > capacity:
+            capacity = max(rows, 2 * capacity)
+            self.equity = np.concatenate([self.equity, np.zeros(capacity - len(self.dates))])
+            self.dates = np.concatenate([self.dates, np.zeros(capacity - len(self.dates), dtype=np.int64)])
+        self.confidences = self.resized(self.confidences, capacity, analysts)
+        self.weights = self.resized(self.weights, capacity, instruments)
+
+    @staticmethod
+    def resized(values, rows, columns):
+        if values.shape == (rows, columns):
+            return values
+        ret = np.empty((rows, columns))
+        ret.fill(np.nan)
+        ret[:values.shape[0], :values.shape[1]] = values
+        return ret
+
+    def sync(self, organization):
+        """Adds columns for analysts and instruments the organization gained"""
+        known = set(self.analysts)
+        self.analysts.extend(name for name in organization.names if name not in known)
+        self.instruments.extend(organization.instruments[len(self.instruments):])
+        columns = dict((name, i) for i, name in enumerate(self.analysts))
+        self.slots = np.array([columns[name] for name in organization.names], dtype=int)
+        self.version = organization.books_version
+
+    def record(self, when, organization, equity = np.nan):
+        """Appends the organization's confidences and weights, and equity, at datetime when"""
+        if self.version != organization.books_version:
+            self.sync(organization)
+        row = self.size
+        if row == len(self.dates) or self.confidences.shape[1] != len(self.analysts) \
+                or self.weights.shape[1] != len(self.instruments):
+            self.reserve(row + 1, len(self.analysts), len(self.instruments))
+        self.dates[row] = when.toordinal()
+        self.equity[row] = equity
+        # new cells are NaN, so analysts that left the organization stay NaN
+        self.confidences[row, self.slots] = organization.confidences[:len(self.slots)]
+        self.weights[row] = organization.aggregate[:len(self.instruments)]
+        self.size += 1
+
+    def datetimes(self):
+        return [datetime.datetime.fromordinal(int(d)) for d in self.dates[:self.size]]
+
+    def rows(self, start = None, end = None):
+        """Returns the slice of rows dated within [start, end]"""
+        dates = self.dates[:self.size]
+        lo = 0 if start is None else int(np.searchsorted(dates, start.toordinal(), "left"))
+        hi = self.size if end is None else int(np.searchsorted(dates, end.toordinal(), "right"))
+        return slice(lo, hi)
+
+    def confidence(self, analyst = None, start = None, end = None):
+        """
+        Returns recorded confidences within [start, end]
+
+        A (bars x analysts) array, or the column of one analyst if given
+        """
+        rows = self.rows(start, end)
+        if analyst is None:
+            return self.confidences[rows]
+        return self.confidences[rows, self.analysts.index(analyst.upper())]
+
+    def weight(self, instrument = None, start = None, end = None):
+        """Returns recorded organization weights within [start, end], like confidence"""
+        rows = self.rows(start, end)
+        if instrument is None:
+            return self.weights[rows]
+        return self.weights[rows, self.instruments.index(instrument)]
+
+    def at(self, when):
+        """Returns {analyst: confidence} as of the last bar on or before when"""
+        row = int(np.searchsorted(self.dates[:self.size], when.toordinal(), "right")) - 1
+        if row < 0:
+            raise KeyError("No confidences recorded before " + str(when))
+        return dict((name, float(c)) for name, c in zip(self.analysts, self.confidences[row])
+                    if c == c)
+
+    def save(self, path):
+        """Writes every series to one .npz file"""
+        np.savez(path, dates=self.dates[:self.size], equity=self.equity[:self.size],
+                 confidences=self.confidences[:self.size],
+                 weights=self.weights[:self.size], analysts=np.array(self.analysts),
+                 instruments=np.array(self.instruments))
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        ret = cls(0)
+        ret.dates = data["dates"]
+        ret.size = len(ret.dates)
+        ret.equity = data["equity"]
+        ret.confidences = data["confidences"]
+        ret.weights = data["weights"]
+        ret.analysts = [str(name) for name in data["analysts"]]
+        ret.instruments = [str(name) for name in data["instruments"]]
+        return ret
+
+    def plot(self, path = None, points = None, matrix = None, instruments = ()):
+        """
+        Plots equity, confidences and weights over time, to a file if path
+        is given; see plotting.plot_history
+        """
+        import plotting
+        plotting.plot_history(self, path, points or plotting.POINTS, matrix, instruments)
+
+
+def main():
+    """
+    Plots a saved history without running the backtest again
+
+    Usage: python history.py HISTORY.npz [IMAGE]
+    """
+    if len(sys.argv) < 2:
+        sys.exit("Usage: python history.py HISTORY.npz [IMAGE]")
+    history = ConfidenceHistory.load(sys.argv[1])
+    print "%d bars, %d analysts, %d instruments" % (len(history), len(history.analysts),
+                                                   len(history.instruments))
+    history.plot(sys.argv[2] if len(sys.argv) > 2 else None)
+
+if __name__ == "__main__":
+    main()
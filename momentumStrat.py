@@ -1,5 +1,5 @@
 from pyalgotrade import strategy
-from pyalgotrade.barfeed import yahoofeed
+import barcache
 from pyalgotrade.technical import ma
 
 
@@ -46,7 +46,7 @@ class MyStrategy(strategy.BacktestingStrategy):
 
 def run_strategy(smaPeriod):
     # Load the yahoo feed from the CSV file
-    feed = yahoofeed.Feed()
+    feed = barcache.Feed()
     feed.addBarsFromCSV("orcl", "orcl-2000.csv")
 
     # Evaluate the strategy with the feed.
@@ -54,4 +54,5 @@ def run_strategy(smaPeriod):
     myStrategy.run()
     print "Final portfolio value: $%.2f" % myStrategy.getBroker().getEquity()
 
-run_strategy(15)
\ No newline at end of file
+if __name__ == "__main__":
+    run_strategy(15)
@@ -0,0 +1,211 @@
+""" Runs OrgStrat for many organizations at once over one decoded feed """
+import sys
+
+import numpy as np
+
+import updates
+import vectorized
+from vectorized import CASH, NOTIONAL, OrderBook, fill_pending, rebalance_mask
+
+
+class StackedBooks(object):
+    """
+    Analysts of K organizations stacked into one weight matrix
+
+    Row r of weights is an analyst of organization owner[r]; rows of an
+    organization are contiguous and start at starts[k]. Columns are the
+    union of the organizations' instruments.
+    """
+    def __init__(self, organizations):
+        self.instruments = []
+        seen = set()
+        for org in organizations:
+            for instr in org.get_weights():
+                if instr not in seen:
+                    seen.add(instr)
+                    self.instruments.append(instr)
+        columns = dict((instr, i) for i, instr in enumerate(self.instruments))
+
+        blocks = []
+        confidences = []
+        self.starts = []
+        self.sequences = []
+        for org in organizations:
+            if not org.names:
+                raise ValueError("Organization %s has no analysts" % org.name)
+            self.starts.append(sum(len(b) for b in blocks))
+            blocks.append(org.weight_matrix(self.instruments))
+            confidences.append(org.confidence_vector())
+            # order in which OrgStrat submits this organization's orders
+            self.sequences.append([columns[instr] for instr in org.get_weights()])
+        self.weights = np.vstack(blocks)
+        self.confidence = np.concatenate(confidences)
+        self.owner = np.concatenate([np.repeat(k, len(c)) for k, c in enumerate(confidences)])
+        self.starts = np.array(self.starts)
+
+    def normalized(self, confidence):
+        """Rescales each organization's confidences to sum to one"""
+        return confidence / np.add.reduceat(confidence, self.starts)[self.owner]
+
+    def org_weights(self, confidence):
+        """(K x instruments) organization weights"""
+        return np.add.reduceat(confidence[:, None] * self.weights, self.starts, axis=0)
+
+
+class MultiResult(object):
+    """ Per-organization output of a multi-organization run """
+    def __init__(self, labels, dates, instruments, equity, cash, shares, confidences):
+        self.labels = labels
+        self.dates = dates
+        self.instruments = instruments
+        self.equity = equity
+        self.cash = cash
+        self.shares = shares
+        self.confidences = confidences
+
+    def get_results(self):
+        """Final portfolio value of each organization"""
+        return dict(zip(self.labels, self.equity[:, -1]))
+
+    def report(self):
+        start = self.equity[:, 0]
+        lines = []
+        for k in np.argsort(-self.equity[:, -1]):
+            lines.append("%-24s %14.2f %8.2f%%" % (self.labels[k], self.equity[k, -1],
+                                                   100 * (self.equity[k, -1] / start[k] - 1)))
+        return "\n".join(lines)
+
+
+def run(matrix, organizations, labels = None, period = 10, update = "geometric", gamma = 0.5,
+        cash = CASH):
+    """
+    Runs OrgStrat for every organization over one BarMatrix
+
+    Each bar is decoded once. Confidences of all K organizations advance
+    together as one update over the stacked analyst rows, targets of all
+    books are one (K x instruments) operation, and each book's orders are
+    filled by the same broker model as vectorized.run, so the results are
+    directly comparable.
+
+    Parameters
+    ----------
+    matrix : vectorized.BarMatrix
+
+    organizations : list of Organization
+    They are not modified.
+
+    labels : list of String (default = None)
+    Names of the books in the results; defaults to the organizations' names
+
+    period, update, gamma
+    Same meaning as in OrgStrat
+    """
+    if labels is None:
+        labels = [org.name for org in organizations]
+    books = StackedBooks(organizations)
+    matrix = matrix.select(books.instruments)
+    n_bars = len(matrix)
+    n_books = len(organizations)
+
+    close = matrix.forward_filled(matrix.close)
+    adj_open = matrix.adj_open()
+    traded = ~np.isnan(matrix.close)
+    prices = np.nan_to_num(matrix.forward_filled(matrix.adj_close))
+    due = rebalance_mask(n_bars, period)
+
+    rule = updates.build(update, gamma)
+    confidence = books.normalized(books.confidence)
+    rule.bind(books.weights, confidence, close[0])
+
+    confidences = np.empty((n_bars, len(confidence)))
+    confidences[0] = confidence
+    holdings = np.zeros((n_books, len(books.instruments)))
+    pending = np.zeros((n_books, len(books.instruments)))
+    remaining = np.empty(n_books)
+    remaining.fill(float(cash))
+    equity = np.empty((n_books, n_bars))
+    cash_path = np.empty((n_books, n_bars))
+    order_books = [OrderBook() for k in range(n_books)]
+    for t in range(n_bars):
+        if t > 0:
+            confidence = books.normalized(rule.advance(confidence, close[t]))
+            confidences[t] = confidence
+        for k in range(n_books):
+            if order_books[k].active:
+                filled, remaining[k] = fill_pending(order_books[k], pending[k], traded[t], adj_open[t],
+                                                    matrix.volume[t], remaining[k])
+                holdings[k] += filled
+        equity[:, t] = remaining + np.dot(holdings, prices[t])
+        cash_path[:, t] = remaining
+        if due[t] and t + 1 < n_bars:
+            # instruments without a bar have a NaN close and are not traded
+            with np.errstate(invalid='ignore'):
+                orders = np.nan_to_num(np.trunc(NOTIONAL * books.org_weights(confidence) / matrix.close[t])
+                                       - holdings)
+            for k in range(n_books):
+                sent = [col for col in books.sequences[k] if orders[k, col] != 0]
+                order_books[k].submit(sent)
+                pending[k, sent] = orders[k, sent]
+
+    return MultiResult(labels, matrix.dates, books.instruments, equity, cash_path, holdings, confidences)
+
+
+def schemes(specs):
+    """The same benchmark analyst specs under the mean, given and reset confidence schemes"""
+    import benchmark
+    from players import Organization
+
+    organizations = []
+    for label, mode in (("mean", None), ("given", "given"), ("reset", "reset")):
+        org = Organization(label)
+        for analyst in benchmark.build_analysts(specs):
+            org.add_analyst(analyst, None if mode == "reset" else mode)
+        if mode == "reset":
+            org.reset_confidence()
+        organizations.append(org)
+    return organizations
+
+
+def main():
+    """
+    Compares confidence schemes for the same analysts on the bundled dia
+    bars, or on benchmark.py's synthetic data with --analysts=N, then
+    checks every scheme against the event-driven OrgStrat on a synthetic
+    universe with missing bars and exits non-zero on a mismatch
+    """
+    import time
+    import barcache
+    import benchmark
+    import strats
+
+    options = dict(arg[2:].split("=", 1) for arg in sys.argv[1:] if "=" in arg)
+    if "analysts" in options:
+        specs = benchmark.synthetic_books(int(options["analysts"]), 500, 20)
+        feed = benchmark.build_feed(benchmark.synthetic_bars(500, 2520))
+    else:
+        specs = [("Ivy Kang", 0.1, {"dia": 1.0}), ("Charlie Brown", 0.3, {"dia": 0.6})]
+        feed = barcache.Feed()
+        for year in (2009, 2010, 2011):
+            feed.addBarsFromCSV("dia", "dia-%d.csv" % year)
+
+    organizations = schemes(specs)
+    matrix = vectorized.load_matrix(feed)
+    start = time.time()
+    result = run(matrix, organizations)
+    print result.report()
+    print "%d books in %.2f s" % (len(organizations), time.time() - start)
+
+    specs = benchmark.synthetic_books(10, 30, 8)
+    columns = benchmark.synthetic_bars(30, 500, traded = 0.6)
+    result = run(vectorized.load_matrix(benchmark.build_feed(columns)), schemes(specs))
+    diff = 0.0
+    for k, org in enumerate(schemes(specs)):
+        strat = strats.OrgStrat(benchmark.build_feed(columns), org)
+        strat.run()
+        diff = max(diff, abs(strat.getResult() - result.equity[k, -1]))
+    print "Largest difference to OrgStrat on a sparse feed: %g" % diff
+    if diff > vectorized.TOLERANCE:
+        sys.exit("Stacked books differ from OrgStrat")
+
+if __name__ == "__main__":
+    main()
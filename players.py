@@ -2,18 +2,48 @@
 
 import pyalgotrade
 import numpy as np
+from collections import Mapping
 from time import gmtime, strftime
 
 class Analyst(object):
     def __init__(self, name, confidence = 0.1, group = 'EMORY_GIMG'):
         self.name = name.upper()
-        self.weights = dict()
+        self.reset_book()
         self.total = 0.0
         self.group = group
+        # organizations holding this analyst, notified of every change
+        self.organizations = []
         if (confidence > 1.0 or confidence < 0):
             self.confidence = 0.1
         else: self.confidence = confidence
 
+    @property
+    def confidence(self):
+        """Confidence as stored by the first organization holding the analyst"""
+        if self.organizations:
+            return self.organizations[0].get_confidence(self.name)
+        return self._confidence
+
+    @confidence.setter
+    def confidence(self, value):
+        self._confidence = value
+        for org in self.organizations:
+            org.set_confidence(self.name, value)
+
+    @property
+    def weights(self):
+        """Weights of the analyst's book, with the pending scale factor applied"""
+        if self._weights is None:
+            scale = self._scale
+            self._weights = dict((instr, raw * scale) for instr, raw in self._raw.iteritems())
+        return self._weights
+
+    def reset_book(self):
+        # weight of instr is self._raw[instr] * self._scale
+        self._raw = dict()
+        self._scale = 1.0
+        self._weights = dict()
+
     def assign_weight(self, instrument, weight):
         """
         Assigns weights to security. Overwrites as necessary
@@ -28,17 +58,64 @@ class Analyst(object):
         """
         if (weight > 1.0 or weight < 0.0):
             raise ValueError('Weight must be between 0.0 and 1.0')
-        if self.weights.has_key(instrument):
-            old_weight = self.weights[instrument]
-            for instr in self.weights:
-                self.weights[instr] *= (1 - weight) / (1 - old_weight)
+        self.set_weight(instrument, weight)
+        self.notify_weights()
+
+    def assign_weights(self, weights):
+        """
+        Assigns several weights at once, as if by successive assign_weight calls
+
+        Other holdings are rescaled through a single scale factor, so a book
+        of n names loads in O(n) rather than O(n^2).
+
+        Parameters
+        ----------
+        weights : dict or list of (instrument, weight) pairs
+        Weights are assigned in iteration order. Nothing is assigned if any
+        weight is outside 0.0 and 1.0.
+        """
+        if isinstance(weights, dict):
+            weights = weights.items()
+        weights = list(weights)
+        for instrument, weight in weights:
+            if (weight > 1.0 or weight < 0.0):
+                raise ValueError('Weight must be between 0.0 and 1.0')
+        for instrument, weight in weights:
+            self.set_weight(instrument, weight)
+        self.notify_weights()
+
+    def set_weight(self, instrument, weight):
+        """Assigns one weight, rescaling the others lazily"""
+        if self._raw.has_key(instrument):
+            factor = (1 - weight) / (1 - self._raw[instrument] * self._scale)
         else:
-            for instr in self.weights:
-                self.weights[instr] *= (1 - weight)  
+            factor = (1 - weight)
 
-        self.weights[instrument] = weight  
-        if len(self.weights) == 1: 
-            self.weights[instrument] = 1.0
+        if factor == 0.0:
+            for instr in self._raw:
+                self._raw[instr] = 0.0
+            self._scale = 1.0
+        else:
+            self._scale *= factor
+        if self._scale < 1e-100:
+            # fold the scale back in before it underflows
+            for instr in self._raw:
+                self._raw[instr] *= self._scale
+            self._scale = 1.0
+
+        self._raw[instrument] = weight / self._scale
+        if len(self._raw) == 1: 
+            self._raw[instrument] = 1.0 / self._scale
+        self._weights = None
+
+    def notify_weights(self):
+        """Pushes the current weights to every organization holding the analyst"""
+        for org in self.organizations:
+            org.update_analyst_weights(self)
+
+    def describe(self):
+        """Name, own confidence and book as JSON values, e.g. to key stored results"""
+        return [self.name, self._confidence, sorted(self.weights.items())]
 
     def get_instruments(self):
         instruments = []
@@ -63,8 +140,9 @@ class Analyst(object):
     
     def reset_weights(self):
         """ Resets weights """
-        self.weights = dict()
+        self.reset_book()
         self.total = 0.0
+        self.notify_weights()
 
     def debug_print_cumulative_weight(self):
         summ = 0.0
@@ -72,12 +150,119 @@ class Analyst(object):
             summ += self.weights[instr]
         print "TOTAL WEIGHTS FOR ANALYST: " + str(summ)
 
+class WeightView(Mapping):
+    """Read-only dict view over an Organization's aggregate weight vector"""
+    def __init__(self, organization):
+        self.organization = organization
+
+    def __getitem__(self, instrument):
+        org = self.organization
+        col = org.columns.get(instrument)
+        if col is None or org.holders[col] == 0:
+            raise KeyError(instrument)
+        return float(org.aggregate[col])
+
+    def __iter__(self):
+        org = self.organization
+        for col in np.flatnonzero(org.holders[:len(org.instruments)]):
+            yield org.instruments[col]
+
+    def __len__(self):
+        return int(np.count_nonzero(self.organization.holders[:len(self.organization.instruments)]))
+
+    def has_key(self, instrument):
+        return instrument in self
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+class BookMatrix(object):
+    """
+    Analyst books as a sparse (analysts x instruments) matrix
+
+    Nonzero weights are stored by column: the analysts and weights of
+    column j are rows[starts[j]:starts[j + 1]] and vals[starts[j]:starts[j + 1]].
+    Products cost O(nonzeros) instead of O(analysts x instruments), and
+    dot_columns visits only the columns given, so a bar on which few
+    instruments of a large universe trade rescores every analyst cheaply.
+    """
+    def __init__(self, rows, cols, vals, shape):
+        order = np.argsort(cols, kind="mergesort")
+        self.rows = rows[order]
+        self.cols = cols[order]
+        self.vals = vals[order]
+        self.shape = shape
+        self.starts = np.concatenate([[0], np.cumsum(np.bincount(cols, minlength=shape[1]))])
+        # W . 1, the score of every analyst when no price moves
+        self.totals = np.bincount(rows, weights=vals, minlength=shape[0])
+
+    def dot(self, vector):
+        """W . vector"""
+        return np.bincount(self.rows, weights=self.vals * vector[self.cols], minlength=self.shape[0])
+
+    def dot_columns(self, columns, values):
+        """W . r, for r equal to one except r[columns] = values"""
+        lengths = self.starts[columns + 1] - self.starts[columns]
+        index = np.repeat(self.starts[columns] - np.cumsum(lengths) + lengths, lengths) \
+            + np.arange(lengths.sum())
+        return self.totals + np.bincount(self.rows[index], minlength=self.shape[0],
+                                         weights=self.vals[index] * np.repeat(values - 1.0, lengths))
+
+    def rdot(self, vector):
+        """vector . W, over the analysts"""
+        return np.bincount(self.cols, weights=vector[self.rows] * self.vals, minlength=self.shape[1])
+
+    def dense(self):
+        matrix = np.zeros(self.shape)
+        matrix[self.rows, self.cols] = self.vals
+        return matrix
+
 class Organization(object):
+    """
+    Set of analysts whose weights are combined by confidence
+
+    Instruments are interned to column indices and each analyst's book is
+    kept as a sparse row (column indices, weights). Confidences live in a
+    vector indexed by analyst slot, and the aggregate weight vector
+    (confidences . weights) is updated incrementally whenever a confidence
+    or a book changes, so get_weights() is O(1).
+    """
+    # full recompute of the aggregate after this many incremental updates
+    REBUILD_EVERY = 4096
+
     def __init__(self, name = 'EMORY_GIMG'):
         self.name = name
         self.analysts = dict()
         self.cumul_confidence = 0.0
-        self.weights = dict()
+        # instrument interning
+        self.instruments = []
+        self.columns = dict()
+        self.aggregate = np.zeros(16)
+        self.holders = np.zeros(16, dtype=int)
+        # analyst slots
+        self.names = []
+        self.slots = dict()
+        self.confidences = np.zeros(16)
+        self.rows = dict()
+        self.updates = 0
+        # bumped whenever an analyst's book or the analyst set changes
+        self.books_version = 0
+        # book_matrix() as of books_version, for set_confidences
+        self.books = None
+        self.books_at = None
+        self.weights = WeightView(self)
+
+    def column(self, instrument):
+        """Returns column index of instrument, interning it if new"""
+        col = self.columns.get(instrument)
+        if col is None:
+            col = len(self.instruments)
+            self.instruments.append(instrument)
+            self.columns[instrument] = col
+            if col == len(self.aggregate):
+                self.aggregate = np.concatenate([self.aggregate, np.zeros(col)])
+                self.holders = np.concatenate([self.holders, np.zeros(col, dtype=int)])
+        return col
 
     def add_analyst(self, analyst, conf = None):
         """"
@@ -98,6 +283,17 @@ class Organization(object):
 
         if (self.analysts.has_key(analyst.name) == False):
             self.analysts[analyst.name] = analyst
+            confidence = analyst.confidence
+
+            slot = len(self.names)
+            if slot == len(self.confidences):
+                self.confidences = np.concatenate([self.confidences, np.zeros(slot)])
+            self.names.append(analyst.name)
+            self.slots[analyst.name] = slot
+            self.confidences[slot] = confidence
+            self.rows[analyst.name] = (np.zeros(0, dtype=int), np.zeros(0))
+            analyst.organizations.append(self)
+            self.update_analyst_weights(analyst)
 
             if (conf == None): 
                 if (len(self.analysts) > 1):
@@ -121,13 +317,131 @@ class Organization(object):
         """
         analyst_name = analyst_name.upper()
         if (self.analysts.has_key(analyst_name)):
-            self.cumul_confidence -= self.analysts[analyst_name].confidence
+            analyst = self.analysts[analyst_name]
+            analyst._confidence = self.get_confidence(analyst_name)
+            self.cumul_confidence -= analyst._confidence
+            self.set_confidence(analyst_name, 0.0)
+            cols, vals = self.rows.pop(analyst_name)
+            self.holders[cols] -= 1
+            self.aggregate[cols[self.holders[cols] == 0]] = 0.0
+
+            # move the last slot into the freed one
+            slot = self.slots.pop(analyst_name)
+            last = self.names.pop()
+            if last != analyst_name:
+                self.names[slot] = last
+                self.slots[last] = slot
+                self.confidences[slot] = self.confidences[len(self.names)]
+            self.confidences[len(self.names)] = 0.0
+            self.books_version += 1
+            analyst.organizations.remove(self)
             del self.analysts[analyst_name]
             print "Analyst " + analyst_name + " removed"
         else:
-            print "Analyst under name " + analyst.name + " does not exist"
+            print "Analyst under name " + analyst_name + " does not exist"
         self.normalize_confidence()
 
+    def get_confidence(self, analyst_name):
+        """Returns confidence of an analyst in this organization"""
+        return float(self.confidences[self.slots[analyst_name]])
+
+    def set_confidence(self, analyst_name, confidence):
+        """Sets confidence of an analyst, updating aggregate weights in place"""
+        slot = self.slots[analyst_name]
+        delta = confidence - self.confidences[slot]
+        self.confidences[slot] = confidence
+        if delta != 0.0:
+            cols, vals = self.rows[analyst_name]
+            self.aggregate[cols] += delta * vals
+            self.count_update()
+
+    def set_confidences(self, confidences):
+        """
+        Sets every confidence at once from a vector in self.names order,
+        adding the changes times the books to the aggregate weights
+        """
+        delta = confidences - self.confidences[:len(self.names)]
+        self.confidences[:len(self.names)] = confidences
+        if delta.any():
+            if self.books_at != self.books_version:
+                self.books = self.book_matrix()
+                self.books_at = self.books_version
+            self.aggregate[:len(self.instruments)] += self.books.rdot(delta)
+            self.count_update()
+
+    def update_analyst_weights(self, analyst):
+        """Replaces an analyst's row with its current weights"""
+        cols, vals = self.rows[analyst.name]
+        confidence = self.confidences[self.slots[analyst.name]]
+        self.aggregate[cols] -= confidence * vals
+        self.holders[cols] -= 1
+
+        instruments = list(analyst.weights)
+        cols = np.array([self.column(instr) for instr in instruments], dtype=int)
+        vals = np.array([analyst.weights[instr] for instr in instruments], dtype=float)
+        self.rows[analyst.name] = (cols, vals)
+        self.aggregate[cols] += confidence * vals
+        self.holders[cols] += 1
+        self.books_version += 1
+        self.count_update()
+
+    def count_update(self):
+        """Bounds floating point drift of the incremental aggregate"""
+        self.updates += 1
+        if self.updates >= self.REBUILD_EVERY:
+            self.rebuild()
+
+    def rebuild(self):
+        """Recomputes the aggregate weight vector from scratch"""
+        self.aggregate[:] = 0.0
+        for name in self.names:
+            cols, vals = self.rows[name]
+            self.aggregate[cols] += self.confidences[self.slots[name]] * vals
+        self.updates = 0
+
+    def confidence_vector(self):
+        """Returns confidences in self.names order"""
+        return self.confidences[:len(self.names)].copy()
+
+    def weight_matrix(self, instruments = None):
+        """
+        Returns the dense (analysts x instruments) weight matrix
+
+        Rows follow self.names. Columns follow instruments, which defaults
+        to every interned instrument.
+        """
+        if instruments is None:
+            instruments = self.instruments
+        index = np.empty(len(self.instruments), dtype=int)
+        index.fill(-1)
+        for i, instr in enumerate(instruments):
+            if instr in self.columns:
+                index[self.columns[instr]] = i
+        matrix = np.zeros((len(self.names), len(instruments)))
+        for row, name in enumerate(self.names):
+            cols, vals = self.rows[name]
+            cols = index[cols]
+            keep = cols >= 0
+            matrix[row, cols[keep]] = vals[keep]
+        return matrix
+
+    def book_matrix(self):
+        """
+        Returns the books as a BookMatrix, rows in self.names order and
+        columns in self.instruments order; its size follows the number of
+        weights held, not analysts x instruments
+        """
+        rows = [np.zeros(0, dtype=int)]
+        cols = [np.zeros(0, dtype=int)]
+        vals = [np.zeros(0)]
+        for row, name in enumerate(self.names):
+            row_cols, row_vals = self.rows[name]
+            rows.append(np.repeat(row, len(row_cols)))
+            cols.append(row_cols)
+            vals.append(row_vals)
+        return BookMatrix(np.concatenate(rows), np.concatenate(cols), np.concatenate(vals),
+                          (len(self.names), len(self.instruments)))
+
     def status(self):
         """Provides summary of organization """
         print "Begin status report for " + self.name
@@ -147,16 +461,14 @@ class Organization(object):
 
         for name in self.analysts:
             analyst = self.analysts[name]
-            print analyst.name + ": " + str(analyst.confidence)
+            print analyst.name + ": " + str(self.get_confidence(name))
         print "============================"
 
     def reset_confidence(self):
         """Establishes equality for all analyst confidences """
         if (len(self.analysts)== 0): return
-        for name in self.analysts:
-            analyst = self.analysts[name]
-            analyst.confidence = 1.0 / len(self.analysts)
-
+        self.confidences[:len(self.names)] = 1.0 / len(self.analysts)
+        self.rebuild()
 
     def normalize_confidence(self):
         """Normalizes confidence ratings across analyst set"""
@@ -164,9 +476,9 @@ class Organization(object):
             print "WARNING: ZERO cumulative confidence"
             return
         self.update_cumul_confidence()
-        for name in self.analysts:
-            analyst = self.analysts[name]
-            analyst.confidence /= self.cumul_confidence
+        if (self.cumul_confidence != 0.0):
+            self.confidences[:len(self.names)] /= self.cumul_confidence
+            self.aggregate /= self.cumul_confidence
         self.cumul_confidence = 1.0
         
     def update_cumul_confidence(self):
@@ -174,21 +486,10 @@ class Organization(object):
         if (self.cumul_confidence == 0.0 and len(self.analysts) > 0):
             print "WARNING: ZERO cumulative confidence"
             return
-        self.cumul_confidence = 0.0
-        for name in self.analysts:
-            analyst = self.analysts[name]
-            self.cumul_confidence += analyst.confidence
+        self.cumul_confidence = float(self.confidences[:len(self.names)].sum())
 
     def get_weights(self):
-        """Updates weights and returns organization's weightings"""
-        self.weights = dict()
-        for name in self.analysts:
-            analyst = self.analysts[name]
-            for instrument in analyst.weights:
-                if (self.weights.has_key(instrument)):
-                    self.weights[instrument] += analyst.weights[instrument] * analyst.confidence
-                else:
-                    self.weights[instrument] = analyst.weights[instrument] * analyst.confidence
+        """Returns organization's weightings as a dict view, kept up to date incrementally"""
         return self.weights
 
     def print_weights(self):
@@ -0,0 +1,177 @@
+""" Downsampled plots of saved runs, rendered without a display """
+import warnings
+
+import numpy as np
+
+# Points kept per series, about one per horizontal pixel of a default figure
+POINTS = 1000
+# Instrument subplots of a backtest plot, by largest final weight
+INSTRUMENTS = 4
+# Series beyond this many are drawn without a legend
+LEGEND_LIMIT = 12
+
+
+def lttb(x, y, points = POINTS):
+    """
+    Largest-triangle-three-buckets downsampling
+
+    Keeps the first and last points and, from each of points - 2 equal
+    buckets in between, the point forming the largest triangle with the
+    point kept from the previous bucket and the mean of the next bucket.
+    Peaks and troughs survive, so the plot keeps its shape.
+
+    Parameters
+    ----------
+    x : ndarray (n)
+    Increasing, shared by every series
+
+    y : ndarray (n) or (n x series)
+    NaN points are only kept when a whole bucket is NaN
+
+    Returns
+    -------
+    ndarray of int, (points) or (points x series) indices into x
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    column = y.ndim == 1
+    if column:
+        y = y[:, None]
+    n, series = y.shape
+    if points >= n or points < 3:
+        ret = np.repeat(np.arange(n)[:, None], series, axis=1)
+        return ret[:, 0] if column else ret
+
+    cols = np.arange(series)
+    edges = np.linspace(1, n - 1, points - 1).astype(int)
+    ret = np.empty((points, series), dtype=int)
+    ret[0] = 0
+    ret[-1] = n - 1
+    kept = np.zeros(series, dtype=int)
+    for i in range(points - 2):
+        lo, hi = edges[i], edges[i + 1]
+        next_hi = edges[i + 2] if i + 2 < len(edges) else n
+        mean_x = x[hi:next_hi].mean()
+        with warnings.catch_warnings():
+            # buckets where a series is all NaN have no mean
+            warnings.simplefilter("ignore", RuntimeWarning)
+            mean_y = np.nanmean(y[hi:next_hi], axis=0)
+        # all series advance together, one bucket at a time
+        ax, ay = x[kept], y[kept, cols]
+        with np.errstate(invalid='ignore'):
+            area = np.abs((ax - mean_x) * (y[lo:hi] - ay) - (ax - x[lo:hi, None]) * (mean_y - ay))
+        area[np.isnan(area)] = -1.0
+        kept = lo + np.argmax(area, axis=0)
+        ret[i + 1] = kept
+    return ret[:, 0] if column else ret
+
+
+def draw(axes, x, y, labels = None, points = POINTS):
+    """Plots every column of y against x on axes after downsampling them"""
+    if y.ndim == 1:
+        y = y[:, None]
+    index = lttb(x, y, points)
+    for j in range(y.shape[1]):
+        axes.plot(x[index[:, j]], y[index[:, j], j], label=None if labels is None else labels[j],
+                  linewidth=1)
+    if labels is not None and len(labels) <= LEGEND_LIMIT:
+        axes.legend(loc="best", fontsize="small")
+
+
+def largest(history, count):
+    """Instruments with the largest final organization weight"""
+    if count <= 0 or not len(history):
+        return []
+    last = np.nan_to_num(history.weights[len(history) - 1])
+    return [history.instruments[i] for i in np.argsort(-last)[:count]]
+
+
+def plot_history(history, path = None, points = POINTS, matrix = None, instruments = ()):
+    """
+    Plots a run's equity, confidences and weights, and optionally the
+    closes of some instruments, downsampled to points per series
+
+    With a path the figure goes straight to an image file through the Agg
+    backend, so no display is needed and pyplot never opens a window.
+
+    Parameters
+    ----------
+    history : history.ConfidenceHistory
+    e.g. ConfidenceHistory.load(path) of a finished run
+
+    path : String (default = None)
+    Image file; shows a window if None
+
+    matrix : vectorized.BarMatrix (default = None)
+    Bars of the instruments to plot
+
+    instruments : list of String (default = ())
+    One subplot each, from matrix
+    """
+    import matplotlib
+    if path is not None:
+        matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    from matplotlib import dates as mdates
+
+    size = len(history)
+    x = mdates.date2num(history.datetimes()) if size else np.zeros(0)
+    equity = history.equity[:size]
+    panels = [("Equity", x, equity, None)] if np.isfinite(equity).any() else []
+    panels.append(("Confidence", x, history.confidences[:size], history.analysts))
+    panels.append(("Weight", x, history.weights[:size], history.instruments))
+    for instr in instruments:
+        if matrix is not None and instr in matrix.columns:
+            panels.append((instr, mdates.date2num(matrix.dates), matrix.close[:, matrix.columns[instr]],
+                           None))
+
+    fig, axes = plt.subplots(len(panels), 1, sharex=True, squeeze=False,
+                             figsize=(10, 2.5 * len(panels)))
+    for ax, (label, x, values, labels) in zip(axes[:, 0], panels):
+        if len(x):
+            draw(ax, x, values, labels, points)
+        ax.set_ylabel(label)
+    axes[-1, 0].xaxis_date()
+    fig.autofmt_xdate()
+    if path is None:
+        plt.show()
+    else:
+        fig.savefig(path)
+        plt.close(fig)
+
+
+def main():
+    """
+    Times downsampling and rendering a long synthetic history
+
+    Options: --analysts=N --instruments=N --bars=N --points=N
+    """
+    import sys
+    import time
+    from history import ConfidenceHistory
+
+    options = dict(arg[2:].split("=", 1) for arg in sys.argv[1:] if "=" in arg)
+    bars = int(options.get("bars", 5040))
+    analysts = int(options.get("analysts", 200))
+    instruments = int(options.get("instruments", 500))
+    random = np.random.RandomState(0)
+    history = ConfidenceHistory(bars)
+    history.size = bars
+    history.dates[:] = 730120 + np.arange(bars)
+    history.analysts = ["analyst %d" % i for i in range(analysts)]
+    history.instruments = ["s%04d" % i for i in range(instruments)]
+    history.confidences = np.exp(np.cumsum(random.normal(0, 0.01, (bars, analysts)), axis=0))
+    history.confidences /= history.confidences.sum(axis=1)[:, None]
+    history.weights = np.abs(np.cumsum(random.normal(0, 0.001, (bars, instruments)), axis=0))
+    history.equity = 1e6 * np.exp(np.cumsum(random.normal(0.0003, 0.01, bars)))
+
+    start = time.time()
+    index = lttb(np.arange(bars), history.confidences, int(options.get("points", POINTS)))
+    print "Downsampled %d series of %d bars to %d points in %.3f s" % (analysts, bars, len(index),
+                                                                     time.time() - start)
+    start = time.time()
+    plot_history(history, "plotting_demo.png", int(options.get("points", POINTS)))
+    print "Rendered plotting_demo.png in %.2f s" % (time.time() - start)
+
+if __name__ == "__main__":
+    main()
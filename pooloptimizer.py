@@ -0,0 +1,268 @@
+""" Process-pool optimizer running strategies over memory-mapped bar data """
+import copy
+import itertools
+import multiprocessing
+import os
+import Queue
+import shutil
+import tempfile
+import time
+import traceback
+
+import numpy as np
+from pyalgotrade.optimizer.server import Results
+from pyalgotrade.stratanalyzer import sharpe
+
+import barcache
+from barcache import BarColumns, COLUMNS
+
+# seconds of work aimed for in each chunk of parameters
+TARGET_SECONDS = 1.0
+
+
+def feed_columns(feed):
+    """Reads every bar of a pyalgotrade BarFeed into per-instrument column dicts"""
+    rows = dict()
+    feed.reset()
+    while not feed.eof():
+        bars = feed.getNextBars()
+        for instrument in bars.getInstruments():
+            bar = bars[instrument]
+            rows.setdefault(instrument, []).append((
+                bar.getDateTime().toordinal(), bar.getOpen(), bar.getHigh(), bar.getLow(),
+                bar.getClose(), bar.getVolume(), bar.getAdjClose()))
+    feed.reset()
+
+    ret = dict()
+    for instrument in rows:
+        values = zip(*rows[instrument])
+        ret[instrument] = dict((name, np.array(values[i], dtype=dtype))
+                               for i, (name, dtype) in enumerate(COLUMNS))
+    return ret
+
+
+def share_feed(feed, directory):
+    """
+    Returns (instrument, BarColumns) streams backed by files workers can map
+
+    barcache.Feed streams that already live in the cache are reused as
+    they are. Any other feed is written once under directory.
+    """
+    if isinstance(feed, barcache.Feed) and all(c.location is not None for i, c in feed.streams):
+        return list(feed.streams)
+
+    ret = []
+    for instrument, columns in sorted(feed_columns(feed).items()):
+        location = os.path.join(directory, instrument)
+        barcache.write_columns(location, columns)
+        ret.append((instrument, BarColumns(barcache.open_columns(location), location)))
+    return ret
+
+
+def attach_metric(strat, metric):
+    """
+    Returns a function reading the metric of strat after it has run
+
+    Metrics are "equity" (strat.getResult()) and "sharpe" (annualized
+    Sharpe ratio with a zero risk free rate).
+    """
+    if metric == "equity":
+        return strat.getResult
+    if metric == "sharpe":
+        analyzer = sharpe.SharpeRatio()
+        strat.attachAnalyzer(analyzer)
+        return lambda: analyzer.getSharpeRatio(0)
+    raise ValueError("Unknown metric " + str(metric))
+
+
+# Worker process state, set once by init_worker
+worker_state = dict()
+
+
+def init_worker(strategy_class, streams, args, metric = "equity"):
+    worker_state["strategy_class"] = strategy_class
+    worker_state["streams"] = streams
+    worker_state["args"] = args
+    worker_state["metric"] = metric
+
+
+def build_feed(streams):
+    feed = barcache.Feed()
+    for instrument, columns in streams:
+        feed.addBarsFromColumns(instrument, columns)
+    return feed
+
+
+def backtest(strategy_class, streams, args, metric, parameters):
+    """Runs one strategy over a fresh feed of streams and returns its metric"""
+    feed = build_feed(streams)
+    # fixed arguments such as an Organization are mutated by a run
+    args = copy.deepcopy(args)
+    strat = strategy_class(feed, *(tuple(args) + tuple(parameters)))
+    result = attach_metric(strat, metric)
+    strat.run()
+    return result()
+
+
+def run_chunk(chunk):
+    """
+    Backtests a chunk of parameter tuples
+
+    Returns (results, elapsed seconds, None), or (None, None, traceback)
+    if a run failed, since Pool.apply_async drops exceptions on Python 2.
+    """
+    start = time.time()
+    results = []
+    try:
+        for parameters in chunk:
+            results.append((parameters, backtest(worker_state["strategy_class"], worker_state["streams"],
+                                                 worker_state["args"], worker_state["metric"], parameters)))
+    except Exception:
+        return None, None, traceback.format_exc()
+    return results, time.time() - start, None
+
+
+class ChunkSizer(object):
+    """ Sizes chunks so each takes about target_seconds to run """
+    def __init__(self, target_seconds = TARGET_SECONDS, max_size = 10000):
+        self.target_seconds = target_seconds
+        self.max_size = max_size
+        self.tasks = 0
+        self.seconds = 0.0
+
+    def record(self, tasks, seconds):
+        self.tasks += tasks
+        self.seconds += seconds
+
+    def next_size(self):
+        if self.tasks == 0 or self.seconds == 0.0:
+            # start small until timings are known
+            return 1
+        per_task = self.seconds / self.tasks
+        return int(max(1, min(self.max_size, self.target_seconds / per_task)))
+
+
+def run(strategyClass, barFeed, strategyParameters, workerCount = None, args = (), callback = None,
+        target_seconds = TARGET_SECONDS, metric = "equity", store = None):
+    """
+    Runs a strategy for every parameter tuple on a process pool
+
+    Bar data is shared with the workers through memory-mapped column files
+    instead of being pickled to each of them, and parameters are sent in
+    chunks sized from measured run times.
+
+    Parameters
+    ----------
+    strategyClass : class
+    Strategy built as strategyClass(feed, *(args + parameters)), e.g. RSI2,
+    SMACrossOver or OrgStrat
+
+    barFeed : pyalgotrade BarFeed
+
+    strategyParameters : iterable of tuples
+    Consumed lazily
+
+    workerCount : int (default = None)
+    Number of processes; defaults to the number of CPUs
+
+    args : tuple (default = ())
+    Fixed leading arguments, e.g. (organization,) for OrgStrat. Each run
+    gets its own copy.
+
+    callback : function (default = None)
+    Called as callback(parameters, result, best) for every result, where
+    best is the Results so far
+
+    metric : String (default = "equity")
+    Result to maximize, see attach_metric
+
+    store : resultstore.ResultStore (default = None)
+    Results already stored for the same strategy, arguments, bars and
+    metric are reused instead of backtested again, and new results are
+    added to it. Fixed arguments must be JSON values or have describe().
+
+    Returns
+    -------
+    pyalgotrade.optimizer.server.Results with the best parameters
+    """
+    directory = tempfile.mkdtemp(prefix="pooloptimizer-")
+    try:
+        streams = share_feed(barFeed, directory)
+        return run_streams(strategyClass, streams, strategyParameters, workerCount, args, callback,
+                           target_seconds, metric, store)
+    finally:
+        shutil.rmtree(directory, True)
+
+
+def run_streams(strategyClass, streams, strategyParameters, workerCount = None, args = (), callback = None,
+                target_seconds = TARGET_SECONDS, metric = "equity", store = None):
+    """Same as run, over (instrument, BarColumns) streams from share_feed"""
+    if workerCount is None:
+        workerCount = multiprocessing.cpu_count()
+    assert workerCount > 0
+
+    group = None
+    if store is not None:
+        import resultstore
+        group = resultstore.group_key(strategyClass, streams, args, metric)
+        store.refresh()
+    best = [None]
+
+    def handle(params, result):
+        if result is not None and result == result and (best[0] is None or result > best[0].getResult()):
+            best[0] = Results(params, result)
+        if callback is not None:
+            callback(params, result, best[0])
+
+    pool = None
+    try:
+        pool = multiprocessing.Pool(workerCount, init_worker, (strategyClass, streams, tuple(args), metric))
+        done = Queue.Queue()
+        sizer = ChunkSizer(target_seconds)
+        parameters = iter(strategyParameters)
+        pending = 0
+        exhausted = False
+        while True:
+            # keep every worker busy with one chunk queued behind it
+            while not exhausted and pending < 2 * workerCount:
+                chunk = list(itertools.islice(parameters, sizer.next_size()))
+                if not chunk:
+                    exhausted = True
+                    break
+                if store is not None:
+                    missing = []
+                    for params in chunk:
+                        result = store.get(group, params)
+                        if result is None:
+                            missing.append(params)
+                        else:
+                            handle(params, result)
+                    chunk = missing
+                    if not chunk:
+                        continue
+                pool.apply_async(run_chunk, (chunk,), callback=done.put)
+                pending += 1
+            if pending == 0:
+                break
+
+            # a timeout keeps the wait interruptible with Ctrl-C
+            while True:
+                try:
+                    results, seconds, error = done.get(timeout=1)
+                    break
+                except Queue.Empty:
+                    pass
+            if error is not None:
+                raise Exception("Strategy run failed in worker:\n" + error)
+            pending -= 1
+            sizer.record(len(results), seconds)
+            if store is not None:
+                store.add(group, results)
+            for params, result in results:
+                handle(params, result)
+        pool.close()
+        pool.join()
+        return best[0]
+    finally:
+        if pool is not None:
+            pool.terminate()
@@ -0,0 +1,145 @@
+""" Opt-in per-phase timers and counters for OrgStrat runs """
+import json
+import logging
+import sys
+import time
+
+
+class CountingStream(object):
+    """ File-like wrapper counting the bytes written through it """
+    def __init__(self, stream, profiler, counter):
+        self.stream = stream
+        self.profiler = profiler
+        self.counter = counter
+
+    def write(self, text):
+        self.profiler.count(self.counter, len(text))
+        self.stream.write(text)
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+class CountingHandler(logging.Handler):
+    """ Logging handler counting the bytes of formatted records """
+    def __init__(self, profiler):
+        logging.Handler.__init__(self)
+        self.profiler = profiler
+
+    def emit(self, record):
+        self.profiler.count("log_records")
+        self.profiler.count("log_bytes", len(self.format(record)) + 1)
+
+
+class Profiler(object):
+    """
+    Wall-clock timers and counters for the phases of an OrgStrat run
+
+    attach() replaces the strategy's phase methods (onBars,
+    update_confidence, record_history, rebalance, report) and the hot calls
+    under them (broker getPositions, marketOrder) with timed wrappers on
+    the instances only. A run without a profiler executes the plain
+    methods, so instrumentation costs nothing when it is off.
+
+    Parameters
+    ----------
+    path : String (default = None)
+    File the JSON summary is written to when the run finishes
+    """
+    PHASES = ("onBars", "update_confidence", "record_history", "rebalance", "report")
+
+    def __init__(self, path = None):
+        self.path = path
+        self.timers = dict()
+        self.counters = dict()
+        self.patched = []
+        self.handler = None
+        self.started = None
+        self.finished = None
+
+    def count(self, name, amount = 1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def timed(self, name, function):
+        """Returns function wrapped to accumulate calls and seconds under name"""
+        timer = self.timers.setdefault(name, [0, 0.0])
+        clock = time.time
+
+        def wrapper(*args, **kwargs):
+            start = clock()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                timer[0] += 1
+                timer[1] += clock() - start
+        return wrapper
+
+    def patch(self, obj, name, wrapper):
+        setattr(obj, name, wrapper)
+        self.patched.append((obj, name))
+
+    def attach(self, strat):
+        """Instruments strat; called by OrgStrat when given a profiler"""
+        for phase in self.PHASES:
+            self.patch(strat, phase, self.timed(phase, getattr(strat, phase)))
+
+        broker = strat.getBroker()
+        self.patch(broker, "getPositions", self.timed("getPositions", broker.getPositions))
+
+        market_order = self.timed("marketOrder", strat.marketOrder)
+
+        def counted_order(instrument, quantity, *args, **kwargs):
+            self.count("orders")
+            self.count("shares_ordered", abs(quantity))
+            return market_order(instrument, quantity, *args, **kwargs)
+        self.patch(strat, "marketOrder", counted_order)
+
+        report = strat.report
+
+        def counted_report(*args, **kwargs):
+            stdout = sys.stdout
+            sys.stdout = CountingStream(stdout, self, "stdout_bytes")
+            try:
+                return report(*args, **kwargs)
+            finally:
+                sys.stdout = stdout
+        self.patch(strat, "report", counted_report)
+
+        self.handler = CountingHandler(self)
+        logging.getLogger().addHandler(self.handler)
+        self.started = time.time()
+
+    def finish(self):
+        """Removes the instrumentation and writes the summary if a path was given"""
+        self.finished = time.time()
+        for obj, name in reversed(self.patched):
+            # the wrappers are instance attributes shadowing the class methods
+            if name in obj.__dict__:
+                del obj.__dict__[name]
+        self.patched = []
+        if self.handler is not None:
+            logging.getLogger().removeHandler(self.handler)
+            self.handler = None
+        if self.path is not None:
+            with open(self.path, "w") as f:
+                json.dump(self.summary(), f, indent=1, sort_keys=True)
+
+    def summary(self):
+        """Returns timers and counters as a JSON-serializable dict"""
+        end = time.time() if self.finished is None else self.finished
+        phases = dict()
+        for name, (calls, seconds) in self.timers.items():
+            phases[name] = {"calls": calls, "seconds": seconds,
+                            "mean_us": 1e6 * seconds / calls if calls else 0.0}
+        return {"wall_seconds": 0.0 if self.started is None else end - self.started,
+                "phases": phases, "counters": dict(self.counters)}
+
+    def print_summary(self):
+        summary = self.summary()
+        print "Profile over %.3f s" % summary["wall_seconds"]
+        for name in sorted(summary["phases"], key=lambda n: -summary["phases"][n]["seconds"]):
+            phase = summary["phases"][name]
+            print "%-18s %8d calls %10.4f s %10.1f us/call" % (name, phase["calls"], phase["seconds"],
+                                                              phase["mean_us"])
+        for name in sorted(summary["counters"]):
+            print "%-18s %d" % (name, summary["counters"][name])
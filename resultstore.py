@@ -0,0 +1,134 @@
+""" Append-only on-disk store of optimizer results, shared by every run that uses it """
+import fcntl
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from barcache import COLUMNS
+
+STORE_PATH = ".result_store"
+
+
+def feed_hash(streams):
+    """Content hash of (instrument, BarColumns) streams, e.g. from pooloptimizer.share_feed"""
+    digest = hashlib.sha1()
+    for instrument, columns in sorted(streams, key=lambda stream: (stream[0], stream[1].date[:1].tolist())):
+        digest.update(instrument.encode("utf-8"))
+        for name, dtype in COLUMNS:
+            digest.update(np.ascontiguousarray(getattr(columns, name), dtype=dtype).tostring())
+    return digest.hexdigest()
+
+
+def describe(value):
+    """JSON encoder fallback for fixed strategy arguments, e.g. Analyst.describe"""
+    if hasattr(value, "describe"):
+        return value.describe()
+    raise TypeError("%r has no describe() to key stored results by" % (value,))
+
+
+def group_key(strategyClass, streams, args = (), metric = "equity"):
+    """
+    Identifies the results of one strategy, fixed arguments, feed and
+    metric; results within a group are keyed by their parameters
+    """
+    fixed = json.dumps(list(args), sort_keys=True, default=describe)
+    return "%s.%s:%s:%s:%s" % (strategyClass.__module__, strategyClass.__name__,
+                               hashlib.sha1(fixed.encode("utf-8")).hexdigest()[:16],
+                               feed_hash(streams)[:16], metric)
+
+
+def parse_params(text):
+    """Parameter tuple from its JSON list, with strings back as str"""
+    return tuple(value.encode("utf-8") if isinstance(value, unicode) else value
+                 for value in json.loads(text))
+
+
+class ResultStore(object):
+    """
+    Optimizer results in one append-only file of tab-separated lines
+
+    Each line is group, JSON parameters and result. The index (a dict per
+    group) is built by reading the file once and extended by reading only
+    what other processes appended since, so lookups and top-N queries
+    never rescan it. Writers append whole batches with a single write
+    under an exclusive lock, so any number of processes can add results to
+    the same file; a line cut short by a crash, or any other line that does
+    not parse, is ignored.
+
+    Parameters
+    ----------
+    path : String (default = STORE_PATH)
+    """
+    def __init__(self, path = STORE_PATH):
+        self.path = path
+        self.offset = 0
+        self.groups = dict()
+        self.hits = 0
+        self.misses = 0
+        self.refresh()
+
+    def __len__(self):
+        return sum(len(results) for results in self.groups.values())
+
+    def refresh(self):
+        """Indexes lines appended since the last refresh"""
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "rb") as f:
+            f.seek(self.offset)
+            data = f.read()
+        end = data.rfind(b"\n") + 1
+        for line in data[:end].splitlines():
+            # a line cut short and continued by a later append does not parse
+            try:
+                group, params, result = line.decode("utf-8").split("\t")
+                params, result = parse_params(params), float(result)
+            except ValueError:
+                continue
+            self.groups.setdefault(group, dict())[params] = result
+        self.offset += end
+
+    def get(self, group, params):
+        """Returns the stored result of params, or None"""
+        ret = self.groups.get(group, dict()).get(tuple(params))
+        if ret is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return ret
+
+    def add(self, group, results):
+        """Appends (params, result) pairs of group"""
+        if not results:
+            return
+        lines = []
+        stored = self.groups.setdefault(group, dict())
+        for params, result in results:
+            result = float("nan") if result is None else float(result)
+            lines.append("%s\t%s\t%r\n" % (group, json.dumps(list(params)), result))
+            stored[tuple(params)] = result
+        data = "".join(lines).encode("utf-8")
+        fd = os.open(self.path, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            # end a line cut short by a crash, so the batch starts on its own line
+            if os.fstat(fd).st_size > 0:
+                os.lseek(fd, -1, os.SEEK_END)
+                if os.read(fd, 1) != b"\n":
+                    data = b"\n" + data
+            while data:
+                data = data[os.write(fd, data):]
+        finally:
+            os.close(fd)
+
+    def top(self, group, count = 10):
+        """Returns the count best (result, params) of group, NaN results excluded"""
+        self.refresh()
+        stored = self.groups.get(group, dict())
+        params = list(stored)
+        results = np.array([stored[p] for p in params])
+        results[np.isnan(results)] = -np.inf
+        best = np.argsort(-results, kind="mergesort")[:count]
+        return [(results[i], params[i]) for i in best if results[i] > -np.inf]
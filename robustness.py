@@ -0,0 +1,272 @@
+""" Confidence intervals for analyst scores and confidences over resampled price paths """
+import sys
+
+import numpy as np
+
+import updates
+
+# Bars per year, to annualize scores
+YEAR = 252
+METHODS = ("block", "shuffle")
+
+
+def relatives(matrix):
+    """
+    (bars - 1 x instruments) close-to-close price relatives of a BarMatrix
+
+    Missing bars carry the last close forward, so their relative is one.
+    """
+    close = matrix.forward_filled(matrix.close)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        ret = close[1:] / close[:-1]
+    ret[~np.isfinite(ret)] = 1.0
+    return ret
+
+
+def resample(n_rows, paths, method = "block", block = 20, random = None):
+    """
+    Returns (paths x n_rows) row indices of resampled return series
+
+    "block" is the moving block bootstrap: each path joins blocks of block
+    consecutive rows starting at random rows, drawn with replacement.
+    "shuffle" cuts the series into consecutive blocks of block rows and
+    puts them in a random order, so every row is used exactly once.
+    Blocks keep the short-range dependence of the returns within them.
+    Scores and final geometric confidences do not depend on the order of
+    the returns, so only the block bootstrap spreads them; shuffling tests
+    the path-dependent rules and the confidences along the way.
+    """
+    if random is None:
+        random = np.random.RandomState()
+    block = max(1, min(block, n_rows))
+    count = -(-n_rows // block)
+    if method == "block":
+        starts = random.randint(0, n_rows - block + 1, (paths, count))
+        index = (starts[:, :, None] + np.arange(block)).reshape(paths, count * block)
+        return index[:, :n_rows]
+    if method == "shuffle":
+        order = np.argsort(random.rand(paths, count), axis=1)
+        index = (order[:, :, None] * block + np.arange(block)).reshape(paths, count * block)
+        # the last block may be short; every row keeps exactly n_rows valid indices
+        return index[index < n_rows].reshape(paths, n_rows)
+    raise ValueError("Unknown resampling method " + str(method))
+
+
+def closes(relatives):
+    """Rebuilds (... x bars x instruments) closes starting at one from price relatives"""
+    shape = relatives.shape[:-2] + (1, relatives.shape[-1])
+    return np.concatenate([np.ones(shape), np.cumprod(relatives, axis=-2)], axis=-2)
+
+
+def scores(relatives, weights):
+    """
+    Annualized mean log of every analyst's per-bar score
+
+    The per-bar score is the weighted sum of the book's price relatives
+    between two consecutive bars.
+    """
+    with np.errstate(divide='ignore'):
+        return YEAR * np.log(np.dot(relatives, weights.T)).mean(axis=-2)
+
+
+class Robustness(object):
+    """
+    Analyst scores and confidences on the realized and resampled paths
+
+    Attributes
+    ----------
+    scores, confidences : ndarray (paths x analysts)
+    Annualized score and final confidence on each resampled path
+
+    bands : ndarray (paths x checkpoints x analysts)
+    Confidences on the checkpoint bars of each resampled path
+
+    realized_scores, realized_confidences : ndarray (analysts)
+    The same on the price path of the feed
+    """
+    def __init__(self, analysts, dates, method, block, scores, confidences, checkpoints, bands,
+                 realized_scores, realized_confidences):
+        self.analysts = analysts
+        self.dates = dates
+        self.method = method
+        self.block = block
+        self.scores = scores
+        self.confidences = confidences
+        self.checkpoints = checkpoints
+        self.bands = bands
+        self.realized_scores = realized_scores
+        self.realized_confidences = realized_confidences
+
+    @property
+    def paths(self):
+        return len(self.scores)
+
+    @staticmethod
+    def interval(values, level = 0.95):
+        """(lower, median, upper) percentiles along the first axis"""
+        tail = 50 * (1 - level)
+        return tuple(np.percentile(values, [tail, 50, 100 - tail], axis=0))
+
+    def score_interval(self, level = 0.95):
+        return self.interval(self.scores, level)
+
+    def confidence_interval(self, level = 0.95):
+        return self.interval(self.confidences, level)
+
+    def band(self, level = 0.95):
+        """(lower, median, upper) confidences, each (checkpoints x analysts)"""
+        return self.interval(self.bands, level)
+
+    def p_positive(self):
+        """Share of paths on which each analyst's score is positive"""
+        return (self.scores > 0).mean(axis=0)
+
+    def p_top(self):
+        """Share of paths on which each analyst ends with the highest confidence"""
+        best = np.argmax(self.confidences, axis=1)
+        return np.bincount(best, minlength=len(self.analysts)) / float(self.paths)
+
+    def report(self, level = 0.95):
+        lower, median, upper = self.score_interval(level)
+        c_lower, c_median, c_upper = self.confidence_interval(level)
+        p_positive = self.p_positive()
+        p_top = self.p_top()
+        lines = ["%d %s paths, blocks of %d bars, %d%% intervals" % (self.paths, self.method, self.block,
+                                                                     round(100 * level)),
+                 "%-24s %8s %20s %8s %22s %6s %6s" % ("Analyst", "Score", "Score interval", "Conf",
+                                                      "Confidence interval", "P>0", "P top")]
+        for i in np.argsort(-self.realized_confidences):
+            lines.append("%-24s %8.4f [%8.4f, %8.4f] %8.4f [%9.4f, %9.4f] %6.2f %6.2f" % (
+                self.analysts[i], self.realized_scores[i], lower[i], upper[i],
+                self.realized_confidences[i], c_lower[i], c_upper[i], p_positive[i], p_top[i]))
+        return "\n".join(lines)
+
+
+def run(matrix, organization, paths = 1000, method = "block", block = 20, update = "geometric",
+        gamma = 0.5, seed = None, checkpoints = 10, chunk = 100):
+    """
+    Resamples the feed's returns and recomputes analyst scores and the
+    confidences OrgStrat would reach on every path
+
+    Paths are processed chunk at a time as (chunk x bars x instruments)
+    arrays, through the same update rules as vectorized.run.
+
+    Parameters
+    ----------
+    matrix : vectorized.BarMatrix
+
+    organization : Organization
+    It is not modified.
+
+    paths : int (default = 1000)
+    Number of resampled paths
+
+    method : String (default = "block")
+    "block" or "shuffle", see resample
+
+    block : int (default = 20)
+    Block length in bars
+
+    update, gamma
+    Same meaning as in OrgStrat
+
+    seed : int (default = None)
+    Seed of the resampling, for reproducible intervals
+
+    checkpoints : int (default = 10)
+    Number of evenly spaced bars whose confidences are kept for every path
+
+    chunk : int (default = 100)
+    Paths per batch; bounds memory to about chunk x bars x instruments floats
+    """
+    instruments = list(organization.get_weights())
+    matrix = matrix.select(instruments)
+    weights = organization.weight_matrix(instruments)
+    confidence = organization.confidence_vector()
+    rule = updates.build(update, gamma)
+    random = np.random.RandomState(seed)
+
+    rel = relatives(matrix)
+    marks = np.unique(np.linspace(0, len(rel), checkpoints).astype(int))
+    realized = rule.path(closes(rel), weights, confidence)
+
+    all_scores = np.empty((paths, len(confidence)))
+    final = np.empty((paths, len(confidence)))
+    bands = np.empty((paths, len(marks), len(confidence)))
+    for start in range(0, paths, chunk):
+        end = min(start + chunk, paths)
+        sample = rel[resample(len(rel), end - start, method, block, random)]
+        all_scores[start:end] = scores(sample, weights)
+        path = rule.path(closes(sample), weights, confidence)
+        final[start:end] = path[:, -1]
+        bands[start:end] = path[:, marks]
+
+    return Robustness(list(organization.names), [matrix.dates[m] for m in marks], method, block,
+                      all_scores, final, marks, bands, scores(rel, weights), realized[-1])
+
+
+def main():
+    """
+    Reports intervals for the two-analyst dia example, or for an
+    organization of benchmark.py's synthetic data with --analysts=N, then
+    checks the realized confidences against OrgStrat under every update
+    rule, with and without missing bars, and exits non-zero on a mismatch
+
+    Options: --paths=N --method=block|shuffle --block=N --update=RULE
+    --instruments=N --bars=N
+    """
+    import time
+    import benchmark
+    import vectorized
+
+    options = dict(arg[2:].split("=", 1) for arg in sys.argv[1:] if "=" in arg)
+    if "analysts" in options:
+        instruments = int(options.get("instruments", 50))
+        specs = benchmark.synthetic_books(int(options["analysts"]), instruments, 10)
+        organization = benchmark.build_organization(specs)
+        feed = benchmark.build_feed(benchmark.synthetic_bars(instruments, int(options.get("bars", 756))))
+    else:
+        from players import Analyst, Organization
+        import barcache
+        al1 = Analyst('Ivy Kang')
+        al1.assign_weight('dia', 1.0)
+        al2 = Analyst('Charlie Brown', 0.3)
+        al2.assign_weight('dia', 0.6)
+        organization = Organization()
+        organization.add_analyst(al1)
+        organization.add_analyst(al2, 'given')
+        feed = barcache.Feed()
+        for year in (2009, 2010, 2011):
+            feed.addBarsFromCSV("dia", "dia-%d.csv" % year)
+
+    matrix = vectorized.load_matrix(feed)
+    start = time.time()
+    result = run(matrix, organization, int(options.get("paths", 1000)), options.get("method", "block"),
+                 int(options.get("block", 20)), options.get("update", "geometric"), seed=benchmark.SEED)
+    seconds = time.time() - start
+    print result.report()
+    print "%d paths of %d bars in %.2f s" % (result.paths, len(matrix), seconds)
+
+    # realized confidences against OrgStrat's, and shuffled scores against the realized ones,
+    # which do not depend on the order of the returns
+    import strats
+    specs = benchmark.synthetic_books(10, 30, 8)
+    diff = 0.0
+    for traded in (1.0, 0.6):
+        columns = benchmark.synthetic_bars(30, 500, traded = traded)
+        matrix = vectorized.load_matrix(benchmark.build_feed(columns))
+        for update in sorted(updates.RULES):
+            result = run(matrix, benchmark.build_organization(specs), 20, "shuffle", update = update,
+                         seed = benchmark.SEED)
+            strat = strats.OrgStrat(benchmark.build_feed(columns), benchmark.build_organization(specs),
+                                    update = update)
+            strat.run()
+            confidences = strat.organization.confidence_vector()
+            diff = max(diff, np.abs(confidences - result.realized_confidences).max(),
+                       np.abs(result.scores - result.realized_scores).max())
+    print "Largest difference to OrgStrat's confidences and to shuffled scores: %g" % diff
+    if diff > vectorized.TOLERANCE:
+        sys.exit("Realized confidences or scores are inconsistent")
+
+if __name__ == "__main__":
+    main()
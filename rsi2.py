@@ -1,3 +1,4 @@
+import numpy as np
 from pyalgotrade import strategy
 from pyalgotrade.technical import ma
 from pyalgotrade.technical import rsi
@@ -79,4 +80,194 @@ class RSI2(strategy.BacktestingStrategy):
         return bar.getPrice() < self.__entrySMA[-1] and self.__rsi[-1] >= self.__overBoughtThreshold
 
     def exitShortSignal(self):
-        return cross.cross_below(self.__priceDS, self.__exitSMA) and not self.__shortPos.exitActive()
\ No newline at end of file
+        return cross.cross_below(self.__priceDS, self.__exitSMA) and not self.__shortPos.exitActive()
+
+def sma_series(prices, periods):
+    """
+    Returns (len(periods) x bars) SMA values, NaN where ma.SMA is None
+
+    Follows ma.SMA's running update so values match the event-driven
+    indicator bit for bit; all periods advance together.
+    """
+    periods = np.asarray(periods)
+    ret = np.empty((len(periods), len(prices)))
+    ret.fill(np.nan)
+    sizes = periods.astype(float)
+    value = np.zeros(len(periods))
+    for k, period in enumerate(periods):
+        if period <= len(prices):
+            value[k] = prices[:period].mean()
+            ret[k, period - 1] = value[k]
+    for t in xrange(int(periods.min()), len(prices)):
+        active = periods <= t
+        first = prices[t - periods[active]]
+        value[active] = value[active] + prices[t] / sizes[active] - first / sizes[active]
+        ret[active, t] = value[active]
+    return ret
+
+
+def rsi_series(prices, periods):
+    """Returns (len(periods) x bars) RSI values, NaN where rsi.RSI is None"""
+    periods = np.asarray(periods)
+    ret = np.empty((len(periods), len(prices)))
+    ret.fill(np.nan)
+    change = np.diff(prices)
+    gains = np.where(change < 0, 0.0, change)
+    losses = np.where(change < 0, -change, 0.0)
+    sizes = periods.astype(float)
+    avg_gain = np.zeros(len(periods))
+    avg_loss = np.zeros(len(periods))
+    for k, period in enumerate(periods):
+        if period < len(prices):
+            gain = 0
+            loss = 0
+            for i in xrange(period):
+                gain += gains[i]
+                loss += losses[i]
+            avg_gain[k] = gain / float(period)
+            avg_loss[k] = loss / float(period)
+    for t in xrange(int(periods.min()), len(prices)):
+        active = periods <= t
+        smooth = active & (periods < t)
+        avg_gain[smooth] = (avg_gain[smooth] * (sizes[smooth] - 1) + gains[t - 1]) / sizes[smooth]
+        avg_loss[smooth] = (avg_loss[smooth] * (sizes[smooth] - 1) + losses[t - 1]) / sizes[smooth]
+        with np.errstate(divide='ignore'):
+            value = 100 - 100 / (1 + avg_gain / avg_loss)
+        ret[active, t] = np.where(avg_loss == 0, 100, value)[active]
+    return ret
+
+
+def crossings(prices, series):
+    """Returns cross_above and cross_below of prices over each row of series, per bar"""
+    diff = prices - series
+    above = np.zeros(diff.shape, dtype=bool)
+    below = np.zeros(diff.shape, dtype=bool)
+    above[:, 1:] = (diff[:, :-1] < 0) & (diff[:, 1:] > 0)
+    below[:, 1:] = (diff[:, :-1] > 0) & (diff[:, 1:] < 0)
+    return above, below
+
+
+class SweepState(object):
+    """ RSI2 positions and broker cash for a batch of parameter combinations """
+    def __init__(self, size, cash):
+        self.side = np.zeros(size, dtype=np.int8)
+        self.quantity = np.zeros(size)
+        self.held = np.zeros(size)
+        self.entry_pending = np.zeros(size, dtype=bool)
+        self.exit_pending = np.zeros(size, dtype=bool)
+        self.cash = np.empty(size)
+        self.cash.fill(cash)
+
+    def fill(self, open_):
+        """Fills pending good-till-canceled market orders at the bar's open"""
+        cost = self.side * self.quantity * open_
+        filled = self.entry_pending & (self.cash - cost >= 0)
+        self.held[filled] = (self.side * self.quantity)[filled]
+        self.cash[filled] -= cost[filled]
+        self.entry_pending[filled] = False
+
+        proceeds = self.held * open_
+        filled = self.exit_pending & (self.cash + proceeds >= 0)
+        self.cash[filled] += proceeds[filled]
+        self.held[filled] = 0
+        self.side[filled] = 0
+        self.exit_pending[filled] = False
+
+    def exit(self, signal):
+        """exitMarket: cancels a pending entry or submits the exit order"""
+        cancel = signal & self.entry_pending
+        self.side[cancel] = 0
+        self.entry_pending[cancel] = False
+        self.exit_pending |= signal & ~cancel & ~self.exit_pending
+
+    def enter(self, signal, side, price):
+        quantity = np.trunc(self.cash * 0.9 / price)
+        signal = signal & (quantity > 0)
+        self.side[signal] = side
+        self.quantity[signal] = quantity[signal]
+        self.entry_pending |= signal
+
+
+def sweep(feed, instrument, entrySMA, exitSMA, rsiPeriod, overBoughtThreshold, overSoldThreshold,
+          cash = 1000000, chunk = 250000):
+    """
+    Backtests every RSI2 parameter combination at once
+
+    Each distinct SMA and RSI series is computed once for the feed. The
+    grid is then run bar by bar as arrays of positions and cash, one
+    entry per combination, following RSI2's rules and the broker's fills
+    (next bar's open, cash checked). The volume limit is not applied.
+
+    Parameters
+    ----------
+    feed : pyalgotrade BarFeed or vectorized.BarMatrix
+    Bars of the instrument; adjusted prices are used as RSI2 does
+
+    entrySMA, exitSMA, rsiPeriod, overBoughtThreshold, overSoldThreshold : lists
+    Values of each parameter; every combination is evaluated
+
+    chunk : int (default = 250000)
+    Combinations simulated together, bounds memory use
+
+    Returns
+    -------
+    Structured array with one row per combination, best result first
+    """
+    import vectorized
+    if isinstance(feed, vectorized.BarMatrix):
+        matrix = feed.select([instrument])
+    else:
+        matrix = vectorized.load_matrix(feed, [instrument])
+    prices = matrix.adj_close[:, 0]
+    opens = matrix.adj_open()[:, 0]
+
+    entrySMA = np.asarray(list(entrySMA))
+    exitSMA = np.asarray(list(exitSMA))
+    rsiPeriod = np.asarray(list(rsiPeriod))
+    entry_series = sma_series(prices, entrySMA)
+    exit_series = sma_series(prices, exitSMA)
+    rsi_values = rsi_series(prices, rsiPeriod)
+    with np.errstate(invalid='ignore'):
+        above_entry = prices > entry_series
+        below_entry = prices < entry_series
+        cross_above, cross_below = crossings(prices, exit_series)
+    # bar-major copies so each bar's lookups read one contiguous row
+    above_entry, below_entry, cross_above, cross_below, rsi_values = [
+        np.ascontiguousarray(a.T) for a in (above_entry, below_entry, cross_above, cross_below, rsi_values)]
+    valid_entry = ~np.isnan(entry_series.T)
+    valid_exit = ~np.isnan(exit_series.T)
+    valid_rsi = ~np.isnan(rsi_values)
+
+    grid = np.meshgrid(np.arange(len(entrySMA)), np.arange(len(exitSMA)), np.arange(len(rsiPeriod)),
+                       np.asarray(list(overBoughtThreshold)), np.asarray(list(overSoldThreshold)),
+                       indexing='ij')
+    grid = [axis.ravel() for axis in grid]
+    results = np.zeros(len(grid[0]), dtype=[('entrySMA', int), ('exitSMA', int), ('rsiPeriod', int),
+                                              ('overBoughtThreshold', float),
+                                              ('overSoldThreshold', float), ('result', float)])
+    results['entrySMA'] = entrySMA[grid[0]]
+    results['exitSMA'] = exitSMA[grid[1]]
+    results['rsiPeriod'] = rsiPeriod[grid[2]]
+    results['overBoughtThreshold'] = grid[3]
+    results['overSoldThreshold'] = grid[4]
+
+    first = int(min(entrySMA.min(), exitSMA.min(), rsiPeriod.min() + 1)) - 1
+    for lo in xrange(0, len(results), chunk):
+        e, x, r, ob, os = [axis[lo:lo + chunk] for axis in grid]
+        state = SweepState(len(e), cash)
+        for t in xrange(first, len(prices)):
+            state.fill(opens[t])
+            valid = valid_entry[t][e] & valid_exit[t][x] & valid_rsi[t][r]
+            if not valid.any():
+                continue
+            rsi_now = rsi_values[t][r]
+            flat = valid & (state.side == 0)
+            state.exit(valid & (state.side == 1) & cross_above[t][x])
+            state.exit(valid & (state.side == -1) & cross_below[t][x])
+            go_long = flat & above_entry[t][e] & (rsi_now <= os)
+            go_short = flat & ~go_long & below_entry[t][e] & (rsi_now >= ob)
+            state.enter(go_long, 1, prices[t])
+            state.enter(go_short, -1, prices[t])
+        results['result'][lo:lo + chunk] = state.cash + state.held * prices[-1]
+
+    return np.sort(results, order='result')[::-1]
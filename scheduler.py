@@ -0,0 +1,181 @@
+""" Rebalance schedules for OrgStrat and the bookkeeping of what they saved """
+import numpy as np
+
+# Notional OrgStrat spreads over the organization's weights
+NOTIONAL = 1000000
+
+
+class Schedule(object):
+    """ Decides on each bar whether OrgStrat rebalances """
+    def due(self, strat, bars):
+        raise NotImplementedError()
+
+    def state(self):
+        """Returns what the schedule carries between bars, for checkpoint.py"""
+        return dict()
+
+    def restore(self, state):
+        pass
+
+
+class EveryBars(Schedule):
+    """ Trades once every period + 1 bars, OrgStrat's default schedule """
+    def __init__(self, period):
+        self.period = period
+        self.counter = 0
+
+    def due(self, strat, bars):
+        if self.counter < self.period:
+            self.counter += 1
+            return False
+        self.counter = 0
+        return True
+
+    def state(self):
+        return {"counter": self.counter}
+
+    def restore(self, state):
+        self.counter = int(state["counter"])
+
+
+class Calendar(Schedule):
+    """
+    Trades on the last bar of each calendar period
+
+    The next bar's datetime is peeked from the feed, so the last bar of a
+    week or month is known without waiting for the next one.
+    """
+    def key(self, when):
+        raise NotImplementedError()
+
+    def due(self, strat, bars):
+        upcoming = strat.getFeed().peekDateTime()
+        return upcoming is None or self.key(upcoming) != self.key(bars.getDateTime())
+
+
+class Weekly(Calendar):
+    def key(self, when):
+        return when.isocalendar()[:2]
+
+
+class MonthEnd(Calendar):
+    def key(self, when):
+        return (when.year, when.month)
+
+
+class Drift(Schedule):
+    """
+    Trades when holdings have drifted from the organization's target weights
+
+    Drift is the largest absolute difference, over held instruments that
+    have a close, between an instrument's share of NOTIONAL at its last
+    close and its target weight.
+    """
+    def __init__(self, threshold = 0.05):
+        self.threshold = threshold
+
+    def due(self, strat, bars):
+        cols, weights = target_weights(strat.organization)
+        instruments = strat.organization.instruments
+        positions = strat.getBroker().getPositions()
+        strat.rebalances.position_reads += 1
+        shares = np.array([positions.get(instruments[col], 0) for col in cols], dtype=float)
+        prices = closes(strat.rule, cols)[0]
+        priced = np.isfinite(prices)
+        if not priced.any():
+            return False
+        drift = np.abs(shares[priced] * prices[priced] / NOTIONAL - weights[priced])
+        return np.max(drift) > self.threshold
+
+
+# schedules that need no argument, by name
+SCHEDULES = {
+    "weekly": Weekly,
+    "month_end": MonthEnd,
+}
+
+
+def build(schedule, period = 10):
+    """
+    Returns a Schedule
+
+    schedule is a Schedule, a name from SCHEDULES, "drift:THRESHOLD", or
+    None for a trade every period + 1 bars.
+    """
+    if isinstance(schedule, Schedule):
+        return schedule
+    if schedule is None:
+        return EveryBars(period)
+    if schedule in SCHEDULES:
+        return SCHEDULES[schedule]()
+    if str(schedule).startswith("drift"):
+        parts = schedule.split(":")
+        return Drift(float(parts[1])) if len(parts) > 1 else Drift()
+    raise ValueError("Unknown schedule " + str(schedule))
+
+
+def target_weights(organization):
+    """Returns the columns of held instruments, in get_weights() order, and their weights"""
+    cols = np.flatnonzero(organization.holders[:len(organization.instruments)])
+    return cols, organization.aggregate[cols]
+
+
+def closes(rule, cols):
+    """
+    Returns the closes of an organization's columns, carried forward over
+    missing bars by the update rule, and whether each had a bar on the
+    current one; instruments that never traded yet are NaN
+    """
+    traded = np.zeros(len(rule.last), dtype=bool)
+    traded[rule.changed] = True
+    return rule.last[cols], traded[cols]
+
+
+def order_diffs(weights, prices, shares, min_trade = 0):
+    """
+    Returns the share deltas reaching target holdings, and which to send
+
+    Targets are whole shares of NOTIONAL * weight at the close, truncated as
+    int() does. Deltas smaller than min_trade shares, and zero deltas, are
+    not sent.
+    """
+    deltas = np.trunc(NOTIONAL * weights / prices) - shares
+    return deltas, np.abs(deltas) >= max(1, min_trade)
+
+
+class RebalanceReport(object):
+    """
+    Counts bars, rebalances and orders of a run
+
+    The baseline for broker calls avoided is the loop OrgStrat used to run
+    on every rebalance: one getShares and one marketOrder per held
+    instrument, zero deltas included.
+    """
+    def __init__(self):
+        self.bars = 0
+        self.idle = 0
+        self.rebalances = 0
+        self.instruments = 0
+        self.orders = 0
+        self.skipped = 0
+        self.position_reads = 0
+
+    def broker_calls(self):
+        return self.position_reads + self.orders
+
+    def legacy_broker_calls(self):
+        return 2 * self.instruments
+
+    def avoided(self):
+        return self.legacy_broker_calls() - self.broker_calls()
+
+    def summary(self):
+        return {"bars": self.bars, "idle_bars": self.idle, "rebalances": self.rebalances,
+                "orders": self.orders, "orders_skipped": self.skipped,
+                "broker_calls": self.broker_calls(), "broker_calls_avoided": self.avoided()}
+
+    def print_summary(self):
+        print "%d bars, %d rebalances, %d idle bars skipped" % (self.bars, self.rebalances, self.idle)
+        print "%d orders sent, %d zero or below minimum skipped" % (self.orders, self.skipped)
+        print "%d broker calls instead of %d: %d avoided" % (self.broker_calls(),
+                                                           self.legacy_broker_calls(), self.avoided())
@@ -0,0 +1,251 @@
+""" Universe-wide SMA screens: momentumStrat and sma_crossover for every (instrument, period) pair at once """
+import sys
+import time
+
+import numpy as np
+
+import vectorized
+
+# SMA periods screened by default
+PERIODS = range(5, 101, 5)
+
+
+def parse_periods(text):
+    """Periods from LO:HI[:STEP], HI included"""
+    parts = [int(part) for part in text.split(":")]
+    return range(parts[0], parts[1] + 1, parts[2] if len(parts) > 2 else 1)
+
+
+def own_bars(matrix):
+    """
+    Returns adjusted closes and opens with each instrument's bars moved to
+    the top of its column, in date order, and each instrument's bar count
+
+    A single-instrument strategy only sees its own bars, so after this row
+    t of every column is that instrument's t-th bar; rows past the count
+    are NaN.
+    """
+    present = ~np.isnan(matrix.close)
+    rows = np.argsort(~present, axis=0, kind="mergesort")
+    cols = np.arange(len(matrix.instruments))
+    return matrix.adj_close[rows, cols], matrix.adj_open()[rows, cols], present.sum(axis=0)
+
+
+class WindowSums(object):
+    """
+    Cumulative sums of every column, giving the SMA of any period on any
+    bar from one subtraction
+
+    The sums are of each value's distance to the column's first one, so
+    they stay small and long histories lose little precision to the
+    running total.
+    """
+    def __init__(self, prices):
+        self.base = prices[0]
+        self.sums = np.zeros((len(prices) + 1, prices.shape[1]))
+        np.cumsum(np.nan_to_num(prices - self.base), axis=0, out=self.sums[1:])
+
+    def sma(self, t, periods):
+        """(periods x columns) averages of rows t - period + 1 to t, NaN before row period - 1"""
+        start = t + 1 - periods
+        ret = self.base + (self.sums[t + 1] - self.sums[np.maximum(start, 0)]) / periods[:, None]
+        ret[start < 0] = np.nan
+        return ret
+
+
+class ScreenState(object):
+    """
+    Long positions and cash of a (periods x instruments) grid of
+    single-instrument strategies
+
+    Entries and exits are good-till-canceled market orders filled at the
+    next bar's open, an entry only with enough cash, and exiting a
+    position whose entry has not filled cancels it, as the broker and
+    pyalgotrade positions do. The volume limit is not applied.
+    """
+    def __init__(self, shape, cash):
+        # a position exists; its entry may still be pending
+        self.open = np.zeros(shape, dtype=bool)
+        self.quantity = np.zeros(shape)
+        self.held = np.zeros(shape)
+        self.entry_pending = np.zeros(shape, dtype=bool)
+        self.exit_pending = np.zeros(shape, dtype=bool)
+        self.cash = np.empty(shape)
+        self.cash.fill(cash)
+        self.trades = np.zeros(shape, dtype=int)
+
+    def fill(self, price, active):
+        """Fills pending orders at the bar's open, for instruments that have a bar"""
+        cost = self.quantity * price
+        with np.errstate(invalid='ignore'):
+            filled = self.entry_pending & active & (self.cash - cost >= 0)
+        self.held[filled] = self.quantity[filled]
+        self.cash[filled] -= cost[filled]
+        self.entry_pending[filled] = False
+        self.trades += filled
+
+        filled = self.exit_pending & active
+        self.cash[filled] += (self.held * price)[filled]
+        self.held[filled] = 0
+        self.open[filled] = False
+        self.exit_pending[filled] = False
+
+    def exit(self, signal):
+        """exitMarket on positions without an active exit"""
+        signal = signal & self.open & ~self.exit_pending
+        cancel = signal & self.entry_pending
+        self.open[cancel] = False
+        self.entry_pending[cancel] = False
+        self.exit_pending |= signal & ~cancel
+
+    def enter(self, signal, quantity):
+        """enterLong of quantity shares"""
+        signal = signal & (quantity > 0)
+        self.open |= signal
+        self.entry_pending |= signal
+        self.quantity[signal] = quantity[signal]
+
+
+def screen(matrix, periods, signals, cash):
+    """
+    Runs one single-instrument SMA strategy for every (period, instrument)
+    pair at once, bar by bar over each instrument's own bars
+
+    signals(state, price, sma, previous) returns the entry signal, exit
+    signal and entry quantities of the bar, previous being price - sma on
+    the instrument's previous bar.
+
+    Returns
+    -------
+    Structured array with one row per pair, best result first
+    """
+    close, open_, counts = own_bars(matrix)
+    periods = np.asarray(list(periods))
+    sums = WindowSums(close)
+    state = ScreenState((len(periods), len(counts)), cash)
+    previous = np.empty(state.cash.shape)
+    previous.fill(np.nan)
+    for t in xrange(int(periods.min()) - 1, int(counts.max())):
+        active = t < counts
+        state.fill(open_[t], active)
+        sma = sums.sma(t, periods)
+        sma[:, ~active] = np.nan
+        enter, leave, quantity = signals(state, close[t], sma, previous)
+        flat = ~state.open
+        state.exit(leave)
+        state.enter(enter & flat, quantity)
+        previous = close[t] - sma
+
+    last = close[np.maximum(counts - 1, 0), np.arange(len(counts))]
+    instruments = np.array(matrix.instruments)
+    results = np.zeros(state.cash.size, dtype=[('instrument', instruments.dtype), ('period', int),
+                                               ('result', float), ('return', float), ('trades', int)])
+    results['instrument'] = np.tile(instruments, len(periods))
+    results['period'] = np.repeat(periods, len(counts))
+    results['result'] = (state.cash + state.held * last).ravel()
+    results['return'] = results['result'] / cash - 1
+    results['trades'] = state.trades.ravel()
+    return np.sort(results, order='result')[::-1]
+
+
+def momentum(matrix, periods = PERIODS, cash = 1000, quantity = 10):
+    """
+    momentumStrat.MyStrategy for every instrument and period: long
+    quantity shares while the adjusted close is above its SMA
+    """
+    def signals(state, price, sma, previous):
+        with np.errstate(invalid='ignore'):
+            return price > sma, price < sma, np.broadcast_to(float(quantity), sma.shape)
+    return screen(matrix, periods, signals, cash)
+
+
+def crossover(matrix, periods = PERIODS, cash = 1000000):
+    """
+    sma_crossover.SMACrossOver for every instrument and period: goes long
+    with 90% of cash when the adjusted close crosses above its SMA and
+    exits when it crosses below
+    """
+    def signals(state, price, sma, previous):
+        diff = price - sma
+        with np.errstate(invalid='ignore'):
+            enter = (previous < 0) & (diff > 0)
+            leave = (previous > 0) & (diff < 0)
+            quantity = np.trunc(state.cash * 0.9 / price)
+        return enter, leave, np.nan_to_num(quantity)
+    return screen(matrix, periods, signals, cash)
+
+
+STRATEGIES = {
+    "momentum": momentum,
+    "crossover": crossover,
+}
+
+
+def best(results):
+    """Each instrument's best period, best instrument first"""
+    first = np.unique(results['instrument'], return_index=True)[1]
+    return results[np.sort(first)]
+
+
+def report(rows, count = 20):
+    lines = ["%-10s %6s %14s %9s %6s" % ("Instrument", "Period", "Final equity", "Return", "Trades")]
+    for row in rows[:count]:
+        lines.append("%-10s %6d %14.2f %8.2f%% %6d" % (row['instrument'], row['period'], row['result'],
+                                                       100 * row['return'], row['trades']))
+    return "\n".join(lines)
+
+
+def main():
+    """
+    Screens benchmark.py's synthetic universe, where instruments miss bars,
+    with both strategies, and checks a few pairs against the event-driven
+    strategies
+
+    Options: --instruments=N --bars=N --periods=LO:HI[:STEP] --check=N --traded=FRACTION
+    """
+    import logging
+    import barcache
+    import benchmark
+    import momentumStrat
+    import sma_crossover
+
+    options = dict(arg[2:].split("=", 1) for arg in sys.argv[1:] if "=" in arg)
+    instruments = int(options.get("instruments", 500))
+    bars = int(options.get("bars", 2520))
+    periods = parse_periods(options.get("periods", "5:100:5"))
+    columns = benchmark.synthetic_bars(instruments, bars, traded = float(options.get("traded", 0.6)))
+    names = sorted(columns)
+    matrix = vectorized.from_columns(names, [columns[name] for name in names])
+
+    screens = dict()
+    for name in sorted(STRATEGIES):
+        start = time.time()
+        screens[name] = STRATEGIES[name](matrix, periods)
+        print "%s: %d instruments x %d periods in %.2f s" % (name, instruments, len(periods),
+                                                            time.time() - start)
+        print report(best(screens[name]), 10)
+
+    events = {"momentum": momentumStrat.MyStrategy, "crossover": sma_crossover.SMACrossOver}
+    random = np.random.RandomState(0)
+    worst = 0.0
+    for name in sorted(STRATEGIES):
+        rows = screens[name][random.choice(len(screens[name]), int(options.get("check", 5)), replace=False)]
+        diff = 0.0
+        for row in rows:
+            feed = barcache.Feed()
+            feed.addBarsFromColumns(row['instrument'], columns[row['instrument']])
+            strat = events[name](feed, row['instrument'], int(row['period']))
+            # momentumStrat logs every fill and the broker every order it can't afford; both
+            # loggers are reset to DEBUG by every new strategy
+            strat.getLogger().setLevel(logging.WARNING)
+            strat.getBroker().getLogger().setLevel(logging.WARNING)
+            strat.run()
+            diff = max(diff, abs(strat.getBroker().getEquity() - row['result']))
+        print "%s: largest difference to the event-driven strategy over %d pairs: %g" % (name, len(rows),
+                                                                                      diff)
+        worst = max(worst, diff)
+    if worst > vectorized.TOLERANCE:
+        sys.exit("The screens differ from the event-driven strategies by %g" % worst)
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,16 @@
 """ Adjusts weights of analysts according to past performance, with parameters for learning """
-import pyalgotrade
+import sys
+
 import numpy as np
-from pyalgotrade.barfeed import yahoofeed
-from pyalgotrade.tools import yahoofinance
-from time import gmtime, strftime
-from datetime import timedelta
 
 from players import Analyst, Organization
+from history import ConfidenceHistory
+import barstore
+import profiling
+import scheduler
+import updates
 
 from pyalgotrade import strategy
-from pyalgotrade import plotter
-from pyalgotrade.technical import vwap
-from pyalgotrade.stratanalyzer import sharpe
 
 
 class HoldStratA(strategy.BacktestingStrategy):
@@ -26,8 +25,11 @@ class HoldStratA(strategy.BacktestingStrategy):
         if (self.first_pass == False): return
         weights = self.analyst.weights
         for instr in self.instruments:
-            price = bars[instr].getClose()
-            quantity = int(1000000 * weights[instr] / price)
+            # nothing to size an order from before an instrument's first bar
+            bar = bars.getBar(instr)
+            if bar is None:
+                continue
+            quantity = int(1000000 * weights[instr] / bar.getClose())
             self.marketOrder(instr, quantity)
         self.first_pass = False
 
@@ -43,101 +45,114 @@ class HoldStratB(strategy.BacktestingStrategy):
         weights = self.organization.get_weights()
 
         for instr in weights:
-            price = bars[instr].getClose()
-            quantity = int(1000000 * weights[instr] / price)
+            bar = bars.getBar(instr)
+            if bar is None:
+                continue
+            quantity = int(1000000 * weights[instr] / bar.getClose())
             self.marketOrder(instr, quantity)
         self.first_pass = False
 
 class OrgStrat(strategy.BacktestingStrategy):
-    def __init__(self, feed, organization, period = 10, update = "geometric"):
-        strategy.BacktestingStrategy.__init__(self, feed)
+    def __init__(self, feed, organization, period = 10, update = "geometric", gamma = 0.5,
+                 verbose = False, profiler = None, schedule = None, min_trade = 0, checkpoint = None):
+        if checkpoint is None:
+            strategy.BacktestingStrategy.__init__(self, feed)
+        else:
+            # a broker logging what restore needs to rebuild it
+            strategy.BacktestingStrategy.__init__(self, feed, checkpoint.broker(feed))
         self.first_pass = True
         self.organization = organization
         self.setUseAdjustedValues(True)
         self.update = update
+        # confidence update rule, see updates.RULES; gamma is its learning rate
+        self.rule = updates.build(update, gamma)
+        self.verbose = verbose
         self.first_pass = True
-        self.last_bars = None
-        self.skip = skipper(period)
+        # when to rebalance, see scheduler.build; by default every period + 1 bars
+        self.schedule = scheduler.build(schedule, period)
+        # smallest order sent, in shares
+        self.min_trade = min_trade
+        self.rebalances = scheduler.RebalanceReport()
+        # confidences and weights on every bar; verbose also prints them on rebalances
+        self.history = ConfidenceHistory()
+        # optional profiling.Profiler timing the phases below
+        self.profiler = profiler
+        if profiler is not None:
+            profiler.attach(self)
+        # optional checkpoint.Checkpointer saving the run's state every few bars
+        self.checkpoint = checkpoint
 
     def onBars(self, bars):
+        # Weight update code
+        self.update_confidence(bars)
+        self.record_history(bars)
+        self.rebalances.bars += 1
+        if self.checkpoint is not None and self.getFeed().eof():
+            # orders of the last bar never fill here; a run extending this
+            # one trades the bar itself, once it knows the next bar
+            self.checkpoint.write(self, trade_pending = True)
+            self.trade(bars)
+            return
+        self.trade(bars)
+        if self.checkpoint is not None:
+            self.checkpoint.after_bar(self)
+
+    def trade(self, bars):
         if self.first_pass:
             self.first_pass = False
-            self.last_bars = bars
             return
-        
-        # Weight update code
-        if self.update == "geometric":
-            self.geometric_update()
-        self.last_bars = bars
-
-        weights = self.organization.get_weights()
-        broker = self.getBroker()
 
-        #Run according to skip model
-        if self.skip.next_run() == False:
+        # Run according to schedule; idle bars compute nothing else
+        if not self.schedule.due(self, bars):
+            self.rebalances.idle += 1
             return
 
-        for instr in weights:
-            price = bars[instr].getClose()
-            notion = int(1000000 * weights[instr] / price)
-            current_holdings = broker.getShares(instr)
-            order = notion - current_holdings
-            self.marketOrder(instr, order)
+        self.rebalance(bars)
 
         # 1 day lookback
-        print bars.getDateTime()
-        self.organization.print_confidence()
+        if self.verbose:
+            self.report(bars)
 
+    def update_confidence(self, bars):
+        self.rule.update(self.organization, bars)
 
-    def geometric_update(self):
+    def record_history(self, bars):
+        self.history.record(bars.getDateTime(), self.organization, self.getBroker().getEquity())
+
+    def rebalance(self, bars):
         """
-        Updates confidence in each analyst based on performance at the last epoch 
+        Orders the difference between target and current holdings
+
+        Instruments without a bar on this one are left alone: their price is
+        stale and an order would wait at the broker for their next bar.
         """
-        # learning factor
-        gamma = 0.5
-        delta = timedelta(days = -1)
-        feed = self.getFeed()
-        for name in self.organization.analysts:
-            # evalute analyst performance in last epoch
-
-            feed = self.getFeed()
-            analyst = self.organization.analysts[name]
-            bars_now = feed.getCurrentBars()
-            bars_past = self.last_bars
-
-            analyst.confidence *=  eval_analyst_performance(analyst, bars_now, bars_past)
-            # adjust confidence in analyst
-        self.organization.normalize_confidence()
-
-def eval_analyst_performance(analyst, bars_now, bars_past):
-    """Evaluates analyst's performance in a given interval"""
-    weights = analyst.weights
-    score = 0.0
-    for instr in weights:
-        old_price = bars_past.getBar(instr).getClose()
-        new_price = bars_now.getBar(instr).getClose()
-        change = new_price / old_price
-        score += change * weights[instr]
-
-    return score
-
-class skipper(object):
-    """ Helper class for only trading once every period """
-    def __init__(self, period):
-        self.period = period
-        self.counter = 0
-
-    def next_run(self):
-        if self.counter < self.period:
-            self.counter += 1
-            return False
-        else:
-            self.counter = 0
-            return True
+        cols, weights = scheduler.target_weights(self.organization)
+        instruments = self.organization.instruments
+        positions = self.getBroker().getPositions()
+        prices, traded = scheduler.closes(self.rule, cols)
+        cols, weights, prices = cols[traded], weights[traded], prices[traded]
+        shares = np.array([positions.get(instruments[col], 0) for col in cols], dtype=float)
+        deltas, send = scheduler.order_diffs(weights, prices, shares, self.min_trade)
+
+        report = self.rebalances
+        report.rebalances += 1
+        report.instruments += len(traded)
+        report.position_reads += 1
+        report.orders += int(send.sum())
+        report.skipped += len(traded) - int(send.sum())
+        for i in np.flatnonzero(send):
+            self.marketOrder(instruments[cols[i]], int(deltas[i]))
+
+    def report(self, bars):
+        print bars.getDateTime()
+        self.organization.print_confidence()
 
+    def onFinish(self, bars):
+        if self.profiler is not None:
+            self.profiler.finish()
 
 
-def main(plot):
+def example_organization():
     al1 = Analyst('Ivy Kang')
     al1.assign_weight('cmg', 0.673)
     al1.assign_weight('aapl', 0.215)
@@ -152,22 +167,76 @@ def main(plot):
     org = Organization()
     org.add_analyst(al1)
     org.add_analyst(al2)
+    return org
+
+
+def backtest(organization, feed, plot = False, profile = None, history = "orgstrat_history.npz",
+             checkpoint = None, resume = None, image = None, **kwargs):
+    """
+    Runs OrgStrat over feed and prints its summary
+
+    Plots are drawn after the run from the recorded history, downsampled
+    by plotting.plot_history; matplotlib is only imported when plotting.
+
+    Parameters
+    ----------
+    plot : bool (default = False)
+    Shows equity, confidences, weights and the largest holdings in a window
+    profile : String (default = None)
+    File the profiling.Profiler summary is written to; no profiling if None
+
+    history : String (default = "orgstrat_history.npz")
+    File the confidence history is saved to; plot it again with
+    python history.py FILE
+
+    checkpoint : checkpoint.Checkpointer (default = None)
 
-    # Download the bars.
-    feed = yahoofinance.build_feed(org.get_weights().keys(), 2014, 2015, ".instr_data")
+    resume : String (default = None)
+    Checkpoint to continue from, see checkpoint.restore
 
-    strat = OrgStrat(feed, org)
+    image : String (default = None)
+    Renders the plot to this image file instead, without a display
+
+    Other keyword arguments are passed to OrgStrat.
+    """
+    from pyalgotrade.stratanalyzer import sharpe
+
+    profiler = None if profile is None else profiling.Profiler(profile)
+    strat = OrgStrat(feed, organization, profiler = profiler, checkpoint = checkpoint, **kwargs)
+    if resume is not None:
+        from checkpoint import restore
+        print "Resuming after " + str(restore(strat, resume))
     sharpeRatioAnalyzer = sharpe.SharpeRatio()
     strat.attachAnalyzer(sharpeRatioAnalyzer)
 
-    if plot:
-        plt = plotter.StrategyPlotter(strat, True, False, True)
-
     strat.run()
+    strat.rebalances.print_summary()
+    if profiler is not None:
+        profiler.print_summary()
+    if history is not None:
+        strat.history.save(history)
+    print "Final portfolio value: $%.2f" % strat.getResult()
+    print "Sharpe ratio: %.4f" % sharpeRatioAnalyzer.getSharpeRatio(0)
+    print "Final confidences: " + str(strat.history.at(feed.getCurrentDateTime()))
+
+    if plot or image is not None:
+        import plotting
+        import vectorized
+        instruments = plotting.largest(strat.history, plotting.INSTRUMENTS)
+        strat.history.plot(image, matrix = vectorized.load_matrix(feed, instruments),
+                           instruments = instruments)
+    return strat
+
 
-    if plot:
-        plt.plot()
+def main(plot):
+    org = example_organization()
+
+    # Load the bars from the local store, see barstore.BarStore.ingest_yahoo
+    feed = barstore.BarStore().build_organization_feed(org, 2014, 2015)
+
+    # --profile times each phase and writes the summary to orgstrat_profile.json
+    profile = "orgstrat_profile.json" if "--profile" in sys.argv else None
+    backtest(org, feed, plot, profile)
 
 if __name__ == "__main__":
     main(True)
-
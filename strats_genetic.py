@@ -1,130 +1,202 @@
 """ Adjusts weights of analysts according to past performance, with parameters for learning """
-import pyalgotrade
+import copy
+import random
+import sys
+
 import numpy as np
-from pyalgotrade.barfeed import yahoofeed
-from pyalgotrade.tools import yahoofinance
-from time import gmtime, strftime
-from datetime import timedelta
 
 from players import Analyst, Organization
-
-from pyalgotrade import strategy
-from pyalgotrade import plotter
-from pyalgotrade.technical import vwap
-from pyalgotrade.stratanalyzer import sharpe
-
-
-class OrgStrat(strategy.BacktestingStrategy):
-    def __init__(self, feed, organization, period = 10, update = "geometric"):
-        strategy.BacktestingStrategy.__init__(self, feed)
-        self.first_pass = True
-        self.organization = organization
-        self.setUseAdjustedValues(True)
-        self.update = update
-        self.first_pass = True
-        self.last_bars = None
-        self.skip = skipper(period)
-
-    def onBars(self, bars):
-        if self.first_pass:
-            self.first_pass = False
-            self.last_bars = bars
-            return
-        
-        # Weight update code
-        if self.update == "geometric":
-            self.geometric_update()
-        self.last_bars = bars
-
-        weights = self.organization.get_weights()
-        broker = self.getBroker()
-
-        #Run according to skip model
-        if self.skip.next_run() == False:
-            return
-
-        for instr in weights:
-            price = bars[instr].getClose()
-            notion = int(1000000 * weights[instr] / price)
-            current_holdings = broker.getShares(instr)
-            order = notion - current_holdings
-            self.marketOrder(instr, order)
-
-        # 1 day lookback
-        print bars.getDateTime()
-        self.organization.print_confidence()
-
-
-    def geometric_update(self):
-        """Updates confidence in each analyst based on performance at the last epoch """
-        # learning factor
-        gamma = 0.5
-        delta = timedelta(days = -1)
-        feed = self.getFeed()
-        for name in self.organization.analysts:
-            # evalute analyst performance in last epoch
-
-            feed = self.getFeed()
-            analyst = self.organization.analysts[name]
-            bars_now = feed.getCurrentBars()
-            bars_past = self.last_bars
-
-            analyst.confidence *=  eval_analyst_performance(analyst, bars_now, bars_past)
-            # adjust confidence in analyst
-        self.organization.normalize_confidence()
-
-def eval_analyst_performance(analyst, bars_now, bars_past):
-    """Evaluates analyst's performance in a given interval"""
-    weights = analyst.weights
-    score = 0.0
-    for instr in weights:
-        old_price = bars_past.getBar(instr).getClose()
-        new_price = bars_now.getBar(instr).getClose()
-        change = new_price / old_price
-        score += change * weights[instr]
-
-    return score
-
-class skipper(object):
-    """ Helper class for only trading once every period """
-    def __init__(self, period):
-        self.period = period
-        self.counter = 0
-
-    def next_run(self):
-        if self.counter < self.period:
-            self.counter += 1
-            return False
-        else:
-            self.counter = 0
-            return True
-
-
-
-def main(plot):
+import barcache
+import barstore
+import pooloptimizer
+import updates
+from strats import OrgStrat, example_organization
+
+
+# Values each gene of a genome (gamma, period, update, confidence) can take
+GENES = (
+    ("gamma", (0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 4.0, 8.0)),
+    ("period", tuple(range(0, 31))),
+    ("update", tuple(sorted(updates.RULES))),
+    ("confidence", (None, "given", "equal")),
+)
+
+
+class GeneticOrgStrat(OrgStrat):
+    """
+    OrgStrat built from a genome, for use with pooloptimizer
+
+    The organization is assembled from analysts according to the genome's
+    initial confidence mode: None and 'given' are Organization.add_analyst
+    modes, 'equal' gives every analyst the same confidence.
+    """
+    def __init__(self, feed, analysts, gamma, period, update, confidence):
+        org = Organization()
+        for analyst in analysts:
+            # runs get copies, which may still reference a template organization
+            del analyst.organizations[:]
+            org.add_analyst(analyst, confidence)
+        if confidence == "equal":
+            org.reset_confidence()
+        OrgStrat.__init__(self, feed, org, period, update, gamma, False)
+
+
+def canonical(genome):
+    """Drops gamma where the update rule ignores it, so such genomes share a cache entry"""
+    gamma, period, update, confidence = genome
+    if not updates.RULES[update].uses_gamma:
+        gamma = None
+    return (gamma, period, update, confidence)
+
+
+class GeneticSearch(object):
+    """
+    Genetic search over OrgStrat hyperparameters
+
+    Each generation keeps the elite, then fills the population with
+    children of tournament-selected parents by uniform crossover, each gene
+    resampled with probability mutation. Fitness is computed on a process
+    pool and cached by genome, so an individual seen before is never
+    backtested again. The same seed gives the same search.
+
+    Parameters
+    ----------
+    feed : pyalgotrade BarFeed
+    Bars of every instrument the analysts hold
+
+    analysts : list of Analyst
+    Analysts of the organization; their own confidences are the 'given' ones
+
+    population : int (default = 24)
+
+    seed : int (default = None)
+
+    metric : String (default = "equity")
+    "equity" or "sharpe", see pooloptimizer.attach_metric
+
+    cache : dict (default = None)
+    Fitness by canonical genome, shared between searches if given
+
+    store : resultstore.ResultStore (default = None)
+    On-disk results shared between runs, see pooloptimizer.run
+    """
+    def __init__(self, feed, analysts, population = 24, mutation = 0.2, elite = 2, tournament = 3,
+                 seed = None, metric = "equity", workerCount = None, cache = None, store = None):
+        self.feed = feed
+        self.analysts = list(analysts)
+        self.population = population
+        self.mutation = mutation
+        self.elite = elite
+        self.tournament = tournament
+        self.random = random.Random(seed)
+        self.metric = metric
+        self.workerCount = workerCount
+        self.cache = dict() if cache is None else cache
+        self.store = store
+        self.evaluations = 0
+        self.history = []
+
+    def random_genome(self):
+        return tuple(self.random.choice(values) for name, values in GENES)
+
+    def crossover(self, a, b):
+        return tuple(x if self.random.random() < 0.5 else y for x, y in zip(a, b))
+
+    def mutate(self, genome):
+        return tuple(self.random.choice(values) if self.random.random() < self.mutation else gene
+                     for gene, (name, values) in zip(genome, GENES))
+
+    def select(self, ranked):
+        """Tournament selection over (fitness, genome) pairs"""
+        return max(self.random.sample(ranked, min(self.tournament, len(ranked))))[1]
+
+    def evaluate(self, genomes):
+        """Returns fitness of each genome, backtesting only the uncached ones"""
+        missing = sorted(set(canonical(g) for g in genomes) - set(self.cache))
+        if missing:
+            def record(params, result, best):
+                # NaN (e.g. a Sharpe ratio without trades) ranks last
+                self.cache[params] = result if result == result else -np.inf
+            misses = 0 if self.store is None else self.store.misses
+            pooloptimizer.run(GeneticOrgStrat, self.feed, missing, self.workerCount,
+                              args=(self.analysts,), callback=record, metric=self.metric,
+                              store=self.store)
+            # genomes found in the store were not backtested
+            self.evaluations += len(missing) if self.store is None else self.store.misses - misses
+        return [self.cache[canonical(g)] for g in genomes]
+
+    def run(self, generations = 10, verbose = True):
+        """Evolves the population; returns the best (fitness, genome)"""
+        genomes = [self.random_genome() for i in range(self.population)]
+        for generation in range(generations):
+            ranked = sorted(zip(self.evaluate(genomes), genomes), reverse=True)
+            fitness, best = ranked[0]
+            self.history.append((fitness, canonical(best)))
+            if verbose:
+                print "Generation %d: best %s %s, %d backtests so far" % (
+                    generation, canonical(best), fitness, self.evaluations)
+            if generation == generations - 1:
+                break
+            genomes = [genome for fitness, genome in ranked[:self.elite]]
+            while len(genomes) < self.population:
+                child = self.crossover(self.select(ranked), self.select(ranked))
+                genomes.append(self.mutate(child))
+        return max(self.history)
+
+
+def search(generations = 10, population = 24, seed = 0, workerCount = None, store = None):
+    """Tunes OrgStrat on the bundled dia bars with two analysts"""
     al1 = Analyst('Ivy Kang')
-    al1.assign_weight('cmg', 0.673)
-    al1.assign_weight('aapl', 0.215)
+    al1.assign_weight('dia', 1.0)
+    al2 = Analyst('Charlie Brown', 0.3)
+    al2.assign_weight('dia', 0.6)
+
+    feed = barcache.Feed()
+    for year in (2009, 2010, 2011):
+        feed.addBarsFromCSV("dia", "dia-%d.csv" % year)
+
+    ga = GeneticSearch(feed, [al1, al2], population, seed=seed, workerCount=workerCount, store=store)
+    fitness, genome = ga.run(generations)
+    print "Best genome (gamma, period, update, confidence): %s %s" % (genome, fitness)
+    print "%d backtests for %d individuals" % (ga.evaluations, generations * population)
+
+
+def check(generations = 3, population = 8, seed = 0, workerCount = None):
+    """
+    Searches an organization of benchmark.py's synthetic data, whose
+    instruments miss bars, then backtests every genome it evaluated again
+    in this process; exits non-zero when a fitness differs by more than
+    vectorized.TOLERANCE
+    """
+    import benchmark
+    import vectorized
+
+    specs = benchmark.synthetic_books(6, 20, 6)
+    columns = benchmark.synthetic_bars(20, 300, traded = 0.6)
+    ga = GeneticSearch(benchmark.build_feed(columns), benchmark.build_analysts(specs), population,
+                       seed=seed, workerCount=workerCount)
+    ga.run(generations)
+    diff = 0.0
+    for genome, fitness in sorted(ga.cache.items()):
+        # orders go out in the books' dict order, which a copy can change; workers run on copies
+        analysts = copy.deepcopy(benchmark.build_analysts(specs))
+        strat = GeneticOrgStrat(benchmark.build_feed(columns), analysts, *genome)
+        strat.run()
+        diff = max(diff, abs(strat.getResult() - fitness))
+    print "Largest difference between %d searched and direct backtests: %g" % (len(ga.cache), diff)
+    if diff > vectorized.TOLERANCE:
+        sys.exit("Search fitness differs from direct backtests")
 
-    al2 = Analyst('Charlie Brown')
-    al2.assign_weight('cmg', 0.420)
-    al2.assign_weight('orcl', 0.130)
-    al2.assign_weight('bk', 0.32)
-    al2.assign_weight('bk', 0.40)
-    al2.assign_weight('cmg', 0.30)
 
-    org = Organization()
-    org.add_analyst(al1)
-    org.add_analyst(al2)
+def main(plot):
+    org = example_organization()
 
-    # Download the bars.
-    feed = yahoofinance.build_feed(org.get_weights().keys(), 2014, 2015, ".instr_data")
+    # Load the bars from the local store, see barstore.BarStore.ingest_yahoo
+    feed = barstore.BarStore().build_organization_feed(org, 2014, 2015)
 
     strat = OrgStrat(feed, org)
-    sharpeRatioAnalyzer = sharpe.SharpeRatio()
-    strat.attachAnalyzer(sharpeRatioAnalyzer)
-
     if plot:
+        from pyalgotrade import plotter
         plt = plotter.StrategyPlotter(strat, True, False, True)
 
     strat.run()
@@ -133,5 +205,10 @@ def main(plot):
         plt.plot()
 
 if __name__ == "__main__":
-    main(True)
+    if "--search" in sys.argv:
+        search()
+    elif "--check" in sys.argv:
+        check()
+    else:
+        main(True)
 
@@ -1,25 +1,143 @@
 import itertools
-from pyalgotrade.optimizer import local
-from pyalgotrade.barfeed import yahoofeed
+import shutil
+import sys
+import tempfile
+import barcache
+import clusteroptimizer
+import halving
+import pooloptimizer
+import resultstore
 import rsi2
 
 
-def parameters_generator():
-    instrument = ["dia"]
+def parameter_ranges():
     entrySMA = range(150, 251)
     exitSMA = range(5, 16)
     rsiPeriod = range(2, 11)
     overBoughtThreshold = range(75, 96)
     overSoldThreshold = range(5, 26)
-    return itertools.product(instrument, entrySMA, exitSMA, rsiPeriod, overBoughtThreshold, overSoldThreshold)
+    return entrySMA, exitSMA, rsiPeriod, overBoughtThreshold, overSoldThreshold
 
 
-# The if __name__ == '__main__' part is necessary if running on Windows.
-if __name__ == '__main__':
+def parameters_generator():
+    instrument = ["dia"]
+    return itertools.product(instrument, *parameter_ranges())
+
+
+# Bars of the tutorial, which every cluster worker reads from its own copy.
+FEED_FILES = [("dia", "dia-2009.csv"), ("dia", "dia-2010.csv"), ("dia", "dia-2011.csv")]
+
+
+def load_feed():
     # Load the feed from the CSV files.
-    feed = yahoofeed.Feed()
-    feed.addBarsFromCSV("dia", "dia-2009.csv")
-    feed.addBarsFromCSV("dia", "dia-2010.csv")
-    feed.addBarsFromCSV("dia", "dia-2011.csv")
+    feed = barcache.Feed()
+    for instrument, path in FEED_FILES:
+        feed.addBarsFromCSV(instrument, path)
+    return feed
+
+
+def run_sweep(feed, top=10):
+    # Evaluate the whole grid at once with shared indicators.
+    results = rsi2.sweep(feed, "dia", *parameter_ranges())
+    print "Evaluated %d combinations" % len(results)
+    for row in results[:top]:
+        print row
+
+
+def run_pool(feed, workerCount=None, store=None):
+    # One event-driven backtest per combination, on a process pool sharing the bars.
+    def report(parameters, result, best):
+        if best is not None and best.getParameters() == parameters:
+            print "Best so far: %s %s" % (parameters, result)
+    best = pooloptimizer.run(rsi2.RSI2, feed, parameters_generator(), workerCount, callback=report,
+                             store=store)
+    print "Best: %s %s" % (best.getParameters(), best.getResult())
+
 
-    local.run(rsi2.RSI2, feed, parameters_generator())
\ No newline at end of file
+def run_halving(feed, workerCount=None, metric="equity", store=None):
+    # Score every combination on a year of bars past the longest entry SMA, then keep the best quarter
+    # for twice as many bars.
+    result = halving.run(rsi2.RSI2, feed, parameters_generator(), metric=metric, workerCount=workerCount,
+                         store=store, warmup=max(parameter_ranges()[0]))
+    print result.report()
+    print "Best: %s %s" % (result.getParameters(), result.getResult())
+
+
+def run_cluster(workerCount=None, address=None, store=None, authkey=None):
+    # A coordinator handing chunks of the grid to workers that read the CSV files from their own disk.
+    # Without an address the workers are started here; otherwise start them with --worker=HOST:PORT.
+    def report(parameters, result, best):
+        if best is not None and best.getParameters() == parameters:
+            print "Best so far: %s %s" % (parameters, result)
+    if address is None:
+        best = clusteroptimizer.run_local(rsi2.RSI2, FEED_FILES, parameters_generator(), workerCount,
+                                          callback=report, store=store,
+                                          authkey=authkey or clusteroptimizer.AUTHKEY)
+    else:
+        best = clusteroptimizer.run(rsi2.RSI2, FEED_FILES, parameters_generator(), address, authkey,
+                                    callback=report, store=store)
+    print "Best: %s %s" % (best.getParameters(), best.getResult())
+
+
+def print_store(store, feed, metric="equity", top=10):
+    # Stored results of RSI2 over the whole feed, from this and earlier runs.
+    directory = tempfile.mkdtemp(prefix="tutorialOptimizer-")
+    try:
+        group = resultstore.group_key(rsi2.RSI2, pooloptimizer.share_feed(feed, directory), metric=metric)
+    finally:
+        shutil.rmtree(directory, True)
+    print "%d results reused from %s, %d backtested" % (store.hits, store.path, store.misses)
+    for result, parameters in store.top(group, top):
+        print "%s %s" % (parameters, result)
+
+
+def option(name, default=None):
+    for arg in sys.argv:
+        if arg.startswith("--%s=" % name):
+            return arg.split("=")[1]
+    return default
+
+
+def worker_count():
+    workers = option("workers")
+    return None if workers is None else int(workers)
+
+
+def result_store():
+    # Results are kept in .result_store unless --no-store is given.
+    if "--no-store" in sys.argv:
+        return None
+    return resultstore.ResultStore(option("store", resultstore.STORE_PATH))
+
+
+# The if __name__ == '__main__' part is necessary if running on Windows.
+if __name__ == '__main__':
+    if option("worker") is not None:
+        # Serve a coordinator started with --cluster --bind=HOST:PORT, reading the CSV files from --data.
+        clusteroptimizer.work(clusteroptimizer.parse_address(option("worker")),
+                              option("authkey"), option("data", "."))
+        sys.exit()
+    feed = load_feed()
+    if "--event" in sys.argv:
+        # One event-driven backtest per combination.
+        from pyalgotrade.optimizer import local
+        local.run(rsi2.RSI2, feed, parameters_generator(), worker_count())
+    elif "--pool" in sys.argv:
+        store = result_store()
+        run_pool(feed, worker_count(), store)
+        if store is not None:
+            print_store(store, feed)
+    elif "--cluster" in sys.argv:
+        store = result_store()
+        bind = option("bind")
+        run_cluster(worker_count(), None if bind is None else clusteroptimizer.parse_address(bind), store,
+                    option("authkey"))
+        if store is not None:
+            print_store(store, feed)
+    elif "--halving" in sys.argv:
+        store = result_store()
+        run_halving(feed, worker_count(), option("metric", "equity"), store)
+        if store is not None:
+            print_store(store, feed, option("metric", "equity"))
+    else:
+        run_sweep(feed)
@@ -1,10 +1,10 @@
 from pyalgotrade import plotter
-from pyalgotrade.barfeed import yahoofeed
+import barcache
 from pyalgotrade.stratanalyzer import returns
 import sma_crossover
 
 # Load the yahoo feed from the CSV file
-feed = yahoofeed.Feed()
+feed = barcache.Feed()
 feed.addBarsFromCSV("orcl", "orcl-2000.csv")
 
 # Evaluate the strategy with the feed's bars.
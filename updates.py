@@ -0,0 +1,276 @@
+""" Confidence update rules for OrgStrat, scoring every analyst with one matrix-vector product """
+import collections
+
+import numpy as np
+
+# update rule classes by name, filled by register
+RULES = dict()
+
+
+def register(name):
+    """Class decorator adding an UpdateRule subclass to RULES under name"""
+    def decorate(cls):
+        cls.name = name
+        RULES[name] = cls
+        return cls
+    return decorate
+
+
+def build(update, gamma = 0.5, window = 20):
+    """Returns the rule registered as update, or update itself if it already is a rule"""
+    if isinstance(update, UpdateRule):
+        return update
+    if update not in RULES:
+        raise ValueError("Unknown update rule " + str(update))
+    return RULES[update](gamma, window)
+
+
+class UpdateRule(object):
+    """
+    Updates an organization's confidences once per bar
+
+    Analyst scores are computed for all analysts at once as W . r, where W
+    is the (analysts x instruments) weight matrix and r the vector of price
+    relatives. W is a players.BookMatrix, cached until an analyst's book
+    changes. Closes are carried forward over missing bars, so instruments
+    without a bar have a relative of one and each bar only visits the
+    columns of the instruments that traded on it.
+
+    Subclasses implement step, for one bar, and path, for every bar of a
+    (bars x instruments) close matrix at once as used by vectorized.run.
+
+    Parameters
+    ----------
+    gamma : float (default = 0.5)
+    Learning rate, for rules that have one
+
+    window : int (default = 20)
+    Lookback in bars, for rules that have one
+    """
+    name = None
+    # whether gamma changes the rule's output
+    uses_gamma = False
+
+    def __init__(self, gamma = 0.5, window = 20):
+        self.gamma = gamma
+        self.window = window
+        self.version = None
+        self.instruments = []
+        self.columns = dict()
+        self.weights = None
+        self.last = None
+        # columns that had a bar on the last call to closes, None when unknown
+        self.changed = None
+
+    def prepare(self, organization):
+        if self.version != organization.books_version:
+            self.instruments = list(organization.instruments)
+            self.columns = dict(organization.columns)
+            self.weights = organization.book_matrix()
+            self.version = organization.books_version
+            if self.last is not None and len(self.last) != len(self.instruments):
+                # new instruments have no previous close yet
+                self.last = np.concatenate([self.last, np.ones(len(self.instruments) - len(self.last))
+                                            * np.nan])
+
+    def closes(self, bars):
+        """
+        Close vector in self.instruments order, carrying the last close over
+        missing bars; instruments without a close yet are NaN. Only the bars
+        present are read, and their columns are kept in self.changed.
+        """
+        if self.last is None:
+            close = np.empty(len(self.instruments))
+            close.fill(np.nan)
+        else:
+            close = self.last.copy()
+        changed = []
+        for instr in bars.getInstruments():
+            col = self.columns.get(instr)
+            if col is not None:
+                close[col] = bars[instr].getClose()
+                changed.append(col)
+        self.changed = np.sort(np.array(changed, dtype=int))
+        return close
+
+    def update(self, organization, bars):
+        """Applies the rule for bars; the first bar only records closes"""
+        self.prepare(organization)
+        close = self.closes(bars)
+        if self.last is None:
+            self.start(organization.confidence_vector(), close)
+        else:
+            organization.set_confidences(self.step(organization.confidence_vector(), close))
+            organization.normalize_confidence()
+        self.last = close
+
+    def scores(self, close):
+        """W . (close / self.last), visiting only the changed columns when they are known"""
+        if self.changed is None:
+            return self.weights.dot(relatives(close, self.last))
+        cols = self.changed
+        return self.weights.dot_columns(cols, relatives(close[cols], self.last[cols]))
+
+    def bind(self, weights, confidence, close):
+        """
+        Prepares the rule to advance confidences over an explicit weight
+        matrix, such as the stacked books of several organizations
+        """
+        self.weights = weights
+        self.last = close
+        self.changed = None
+        self.start(confidence, close)
+
+    def advance(self, confidence, close):
+        """Returns the unnormalized confidences after a bar closing at close"""
+        ret = self.step(confidence, close)
+        self.last = close
+        return ret
+
+    def start(self, confidence, close):
+        pass
+
+    def step(self, confidence, close):
+        raise NotImplementedError()
+
+    def state(self):
+        """
+        Returns the arrays the rule carries between bars, for checkpoint.py;
+        changed tells a trade restored from a checkpoint which instruments
+        had a bar
+        """
+        if self.last is None:
+            return dict()
+        ret = {"last": self.last}
+        if self.changed is not None:
+            ret["changed"] = self.changed
+        return ret
+
+    def restore(self, state):
+        self.last = state.get("last")
+        self.changed = state.get("changed")
+
+    def path(self, close, weights, confidence):
+        """
+        Returns normalized confidences on every bar
+
+        Parameters
+        ----------
+        close : ndarray (bars x instruments)
+        Carried forward over missing bars, NaN before an instrument's first
+        bar. Leading dimensions, e.g. resampled paths, are kept
+
+        weights : ndarray (analysts x instruments)
+
+        confidence : ndarray (analysts)
+        Confidences on the first bar
+        """
+        raise NotImplementedError()
+
+
+def relatives(close, base):
+    """close / base, with one where either price is missing"""
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ret = np.asarray(close / base)
+    ret[~np.isfinite(ret)] = 1.0
+    return ret
+
+
+def normalized(log_conf):
+    """Turns per-bar log confidences into rows summing to one"""
+    log_conf = log_conf - np.max(log_conf, axis=-1)[..., None]
+    path = np.exp(log_conf)
+    return path / path.sum(axis=-1)[..., None]
+
+
+def with_initial(confidence, log_scores):
+    """Prepends log(confidence) as the first bar of (... x bars - 1 x analysts) log scores"""
+    with np.errstate(divide='ignore'):
+        first = np.log(confidence)
+    first = np.broadcast_to(first, log_scores.shape[:-2] + (1, len(confidence)))
+    return np.concatenate([first, log_scores], axis=-2)
+
+
+@register("geometric")
+class Geometric(UpdateRule):
+    """ Confidence is multiplied by the weighted price relative of the analyst's book """
+    def step(self, confidence, close):
+        return confidence * self.scores(close)
+
+    def path(self, close, weights, confidence):
+        # running products are summed in log space so long histories cannot underflow
+        scores = np.dot(relatives(close[..., 1:, :], close[..., :-1, :]), weights.T)
+        with np.errstate(divide='ignore'):
+            log_conf = with_initial(confidence, np.log(scores))
+        return normalized(np.cumsum(log_conf, axis=-2))
+
+
+@register("exponential")
+class Exponential(UpdateRule):
+    """
+    Multiplicative weights (exponentiated gradient): confidence is scaled by
+    exp(gamma * (score - 1)), so gamma sets how fast it follows returns
+    """
+    uses_gamma = True
+
+    def step(self, confidence, close):
+        return confidence * np.exp(self.gamma * (self.scores(close) - 1.0))
+
+    def path(self, close, weights, confidence):
+        scores = np.dot(relatives(close[..., 1:, :], close[..., :-1, :]), weights.T)
+        log_conf = with_initial(confidence, self.gamma * (scores - 1.0))
+        return normalized(np.cumsum(log_conf, axis=-2))
+
+
+@register("windowed")
+class Windowed(UpdateRule):
+    """
+    Confidence is the starting confidence scaled by exp(gamma * (score - 1)),
+    scoring the analyst's book over the last window bars only
+    """
+    uses_gamma = True
+
+    def start(self, confidence, close):
+        self.initial = confidence
+        self.history = collections.deque([close], self.window + 1)
+
+    def step(self, confidence, close):
+        self.history.append(close)
+        scores = self.weights.dot(relatives(close, self.history[0]))
+        return self.initial * np.exp(self.gamma * (scores - 1.0))
+
+    def state(self):
+        ret = UpdateRule.state(self)
+        if self.last is not None:
+            ret["initial"] = self.initial
+            ret["history"] = np.array(self.history)
+        return ret
+
+    def restore(self, state):
+        UpdateRule.restore(self, state)
+        if self.last is not None:
+            self.initial = state["initial"]
+            self.history = collections.deque(state["history"], self.window + 1)
+
+    def path(self, close, weights, confidence):
+        past = close[..., np.maximum(np.arange(close.shape[-2]) - self.window, 0), :]
+        scores = np.dot(relatives(close[..., 1:, :], past[..., 1:, :]), weights.T)
+        log_conf = with_initial(confidence, self.gamma * (scores - 1.0))
+        # unlike the running rules, each bar starts again from the initial confidence
+        log_conf[..., 1:, :] += log_conf[..., :1, :]
+        return normalized(log_conf)
+
+
+@register("static")
+class Static(UpdateRule):
+    """ Confidences never change """
+    def update(self, organization, bars):
+        # closes are still tracked, OrgStrat prices its orders from them
+        self.prepare(organization)
+        self.last = self.closes(bars)
+
+    def step(self, confidence, close):
+        return confidence
+
+    def path(self, close, weights, confidence):
+        return np.tile(confidence / confidence.sum(), close.shape[:-1] + (1,))
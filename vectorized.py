@@ -0,0 +1,362 @@
+""" Array-based backtest engine producing the same results as strats.OrgStrat """
+import datetime
+import sys
+
+import numpy as np
+
+from players import Analyst, Organization
+import updates
+
+# Notional traded by OrgStrat on every rebalance
+NOTIONAL = 1000000
+# Default cash of pyalgotrade.strategy.BacktestingStrategy
+CASH = 1000000
+# Share of a bar's volume the default pyalgotrade fill strategy may take
+VOLUME_LIMIT = 0.25
+# Largest equity difference the self-checks accept against event-driven strategies
+TOLERANCE = 1e-6
+
+
+class BarMatrix(object):
+    """
+    Feed loaded into (bars x instruments) arrays
+
+    Missing bars are stored as NaN. Adjusted open is derived the same way
+    pyalgotrade does it: adj_close * open / close.
+    """
+    def __init__(self, dates, instruments, open_, close, adj_close, volume):
+        self.dates = list(dates)
+        self.instruments = list(instruments)
+        self.open = open_
+        self.close = close
+        self.adj_close = adj_close
+        self.volume = volume
+        self.columns = dict((instr, i) for i, instr in enumerate(self.instruments))
+
+    def __len__(self):
+        return len(self.dates)
+
+    def adj_open(self):
+        return self.adj_close * self.open / self.close
+
+    def select(self, instruments):
+        """Returns a BarMatrix restricted to (and ordered by) instruments"""
+        cols = [self.columns[instr] for instr in instruments]
+        return BarMatrix(self.dates, instruments, self.open[:, cols],
+                         self.close[:, cols], self.adj_close[:, cols],
+                         self.volume[:, cols])
+
+    def forward_filled(self, values):
+        """Carries the last known value over missing (NaN) bars"""
+        values = values.copy()
+        index = np.where(np.isnan(values), 0, np.arange(len(values))[:, None])
+        np.maximum.accumulate(index, axis=0, out=index)
+        return values[index, np.arange(values.shape[1])]
+
+
+def load_matrix(feed, instruments=None):
+    """
+    Reads every bar of a pyalgotrade BarFeed into a BarMatrix
+
+    The feed is reset afterwards so it can still be handed to a strategy.
+
+    Parameters
+    ----------
+    feed : pyalgotrade.barfeed.membf.BarFeed
+    Feed to read, e.g. a yahoofeed.Feed
+
+    instruments : list (default = None)
+    Column order. Defaults to every instrument registered with the feed.
+    """
+    if instruments is None:
+        instruments = sorted(feed.getRegisteredInstruments())
+    columns = dict((instr, i) for i, instr in enumerate(instruments))
+
+    dates = []
+    rows = []
+    feed.reset()
+    while not feed.eof():
+        bars = feed.getNextBars()
+        row = np.empty((4, len(instruments)))
+        row.fill(np.nan)
+        for instr in bars.getInstruments():
+            if instr not in columns:
+                continue
+            bar = bars[instr]
+            col = columns[instr]
+            row[0, col] = bar.getOpen()
+            row[1, col] = bar.getClose()
+            row[2, col] = bar.getAdjClose()
+            row[3, col] = bar.getVolume()
+        dates.append(bars.getDateTime())
+        rows.append(row)
+    feed.reset()
+
+    data = np.array(rows).reshape(len(rows), 4, len(instruments))
+    return BarMatrix(dates, instruments, data[:, 0], data[:, 1], data[:, 2], data[:, 3])
+
+
+def from_columns(instruments, columns):
+    """
+    Builds a BarMatrix from one barcache.BarColumns per instrument
+
+    Rows are the union of the instruments' dates; missing bars are NaN.
+    """
+    dates = np.unique(np.concatenate([c.date for c in columns]))
+    shape = (len(dates), len(instruments))
+    data = dict((name, np.empty(shape)) for name in ("open", "close", "adj_close", "volume"))
+    for name in data:
+        data[name].fill(np.nan)
+    for col, c in enumerate(columns):
+        rows = np.searchsorted(dates, c.date)
+        for name in data:
+            data[name][rows, col] = getattr(c, name)
+    return BarMatrix([datetime.datetime.fromordinal(int(d)) for d in dates], instruments,
+                     data["open"], data["close"], data["adj_close"], data["volume"])
+
+
+def confidence_path(close, weights, confidence, update = "geometric", gamma = 0.5):
+    """
+    Computes analyst confidences on every bar under an update rule
+
+    Under the default geometric rule each analyst's confidence is
+    multiplied by the weighted price relative of its book and renormalized,
+    as OrgStrat does. See updates.RULES for the other rules.
+
+    Parameters
+    ----------
+    close : ndarray (bars x instruments)
+    Unadjusted closes, carried forward over missing bars as by
+    BarMatrix.forward_filled
+
+    weights : ndarray (analysts x instruments)
+
+    confidence : ndarray (analysts)
+    Confidences on the first bar
+
+    update : String or updates.UpdateRule (default = "geometric")
+
+    gamma : float (default = 0.5)
+    Learning rate of the rule
+    """
+    return updates.build(update, gamma).path(close, weights, confidence)
+
+
+def rebalance_mask(n_bars, period):
+    """Marks the bars on which scheduler.EveryBars(period) lets OrgStrat trade"""
+    index = np.arange(n_bars)
+    return (index > 0) & (index % (period + 1) == 0)
+
+
+class VectorResult(object):
+    """ Per-bar output of a vectorized OrgStrat run """
+    def __init__(self, matrix, analysts, confidences, weights, orders, shares, cash, equity):
+        self.dates = matrix.dates
+        self.instruments = matrix.instruments
+        self.analysts = analysts
+        self.confidences = confidences
+        self.weights = weights
+        self.orders = orders
+        self.shares = shares
+        self.cash = cash
+        self.equity = equity
+
+    def get_result(self):
+        """Final portfolio value, as returned by strategy.getResult()"""
+        return self.equity[-1]
+
+
+def fill_orders(orders, price, volume, cash, sequence, volume_limit=VOLUME_LIMIT):
+    """
+    Fills one bar's market orders the way the backtesting broker does
+
+    Orders are capped at volume_limit of the bar's volume and processed in
+    the given column sequence; an order that would leave negative cash is
+    dropped. Returns the filled share deltas and the remaining cash.
+    """
+    size = np.minimum(np.abs(orders), np.floor(np.nan_to_num(volume) * volume_limit))
+    filled = np.where(np.isnan(price), 0, np.sign(orders) * size)
+    cost = np.nan_to_num(filled * price)
+    if len(sequence) == 0 or cash - np.cumsum(cost[sequence]).max() >= 0:
+        return filled, cash - cost.sum()
+
+    for col in sequence:
+        if cost[col] <= 0 or cash - cost[col] >= 0:
+            cash -= cost[col]
+        else:
+            filled[col] = 0
+    return filled, cash
+
+
+class OrderBook(object):
+    """
+    Tracks broker order ids to reproduce the broker's processing order
+
+    The backtesting broker keeps active orders in a dict keyed by order id
+    and processes them in that dict's iteration order, which is not always
+    submission order. Replaying the same inserts and deletes on a real dict
+    gives the same sequence.
+    """
+    def __init__(self):
+        self.active = dict()
+        self.next_id = 1
+
+    def submit(self, columns):
+        for col in columns:
+            self.active[self.next_id] = col
+            self.next_id += 1
+
+    def process(self, traded = None):
+        """
+        Returns columns in processing order; every daily order expires after
+        the first bar of its instrument, so with a traded mask the orders of
+        instruments without a bar stay active
+        """
+        sequence = []
+        for order_id in list(self.active):
+            col = self.active[order_id]
+            if traded is None or traded[col]:
+                sequence.append(col)
+                del self.active[order_id]
+        return sequence
+
+
+def fill_pending(book, pending, traded, price, volume, cash):
+    """
+    Fills the orders of book whose instrument has a bar, as fill_orders
+    does; pending holds every active order's shares by column and keeps
+    those of the orders still waiting
+    """
+    sequence = book.process(traded)
+    orders = np.zeros(len(pending))
+    orders[sequence] = pending[sequence]
+    pending[sequence] = 0
+    return fill_orders(orders, price, volume, cash, sequence)
+
+
+def run(matrix, organization, period=10, cash=CASH, update="geometric", gamma=0.5):
+    """
+    Runs OrgStrat over a BarMatrix as batched array operations
+
+    Confidences and organization weights are computed for every bar at
+    once, from closes carried forward over missing bars. Orders are sized
+    from the unadjusted close on rebalance bars, for the instruments that
+    have a bar there, and filled at the adjusted open of each instrument's
+    next bar, which is what OrgStrat does through the broker.
+
+    Parameters
+    ----------
+    matrix : BarMatrix
+
+    organization : Organization
+    Analysts and their starting confidences. It is not modified.
+
+    period, update, gamma
+    Same meaning as in OrgStrat
+    """
+    instruments = list(organization.get_weights())
+    matrix = matrix.select(instruments)
+    names = list(organization.names)
+    weights = organization.weight_matrix(instruments)
+    confidence = organization.confidence_vector()
+
+    n_bars = len(matrix)
+    close = matrix.forward_filled(matrix.close)
+    confidences = confidence_path(close, weights, confidence, update, gamma)
+    org_weights = np.dot(confidences, weights)
+
+    adj_open = matrix.adj_open()
+    traded = ~np.isnan(matrix.close)
+    due = rebalance_mask(n_bars, period)
+    orders = np.zeros((n_bars, len(instruments)))
+    deltas = np.zeros((n_bars, len(instruments)))
+    cash_flow = np.zeros(n_bars)
+    holdings = np.zeros(len(instruments))
+    pending = np.zeros(len(instruments))
+    remaining = float(cash)
+    book = OrderBook()
+    for t in range(1, n_bars):
+        if book.active:
+            filled, after = fill_pending(book, pending, traded[t], adj_open[t], matrix.volume[t],
+                                         remaining)
+            deltas[t] = filled
+            cash_flow[t] = after - remaining
+            holdings += filled
+            remaining = after
+        if not due[t]:
+            continue
+        # instruments without a bar have a NaN close and are not traded
+        with np.errstate(invalid='ignore'):
+            orders[t] = np.nan_to_num(np.trunc(NOTIONAL * org_weights[t] / matrix.close[t]) - holdings)
+        if t + 1 < n_bars:
+            sent = np.flatnonzero(orders[t])
+            book.submit(sent)
+            pending[sent] = orders[t, sent]
+
+    shares = np.cumsum(deltas, axis=0)
+    cash_path = cash + np.cumsum(cash_flow)
+    prices = np.nan_to_num(matrix.forward_filled(matrix.adj_close))
+    equity = cash_path + (shares * prices).sum(axis=1)
+    return VectorResult(matrix, names, confidences, org_weights, orders, shares, cash_path, equity)
+
+
+def main():
+    """
+    Checks the vectorized engine against the event-driven OrgStrat under
+    every update rule, on the dia bars and on benchmark.py's synthetic
+    universe with and without missing bars; exits non-zero when equity on
+    any bar differs by more than TOLERANCE
+    """
+    from pyalgotrade.barfeed import yahoofeed
+    import benchmark
+    import strats
+
+    class RecordingOrgStrat(strats.OrgStrat):
+        def __init__(self, feed, organization, update):
+            strats.OrgStrat.__init__(self, feed, organization, update = update)
+            self.equity = []
+
+        def onBars(self, bars):
+            strats.OrgStrat.onBars(self, bars)
+            self.equity.append(self.getBroker().getEquity())
+
+    def dia_feed():
+        feed = yahoofeed.Feed()
+        for year in (2009, 2010, 2011):
+            feed.addBarsFromCSV("dia", "dia-%d.csv" % year)
+        return feed
+
+    def dia_org():
+        al1 = Analyst('Ivy Kang')
+        al1.assign_weight('dia', 1.0)
+        al2 = Analyst('Charlie Brown', 0.3)
+        al2.assign_weight('dia', 0.6)
+        org = Organization()
+        org.add_analyst(al1)
+        org.add_analyst(al2, 'given')
+        return org
+
+    specs = benchmark.synthetic_books(10, 30, 8)
+    dense = benchmark.synthetic_bars(30, 500)
+    sparse = benchmark.synthetic_bars(30, 500, traded = 0.6)
+    cases = (
+        ("dia", dia_feed, dia_org),
+        ("synthetic", lambda: benchmark.build_feed(dense), lambda: benchmark.build_organization(specs)),
+        ("sparse", lambda: benchmark.build_feed(sparse), lambda: benchmark.build_organization(specs)),
+    )
+    worst = 0.0
+    for label, build_feed, build_org in cases:
+        matrix = load_matrix(build_feed())
+        for update in sorted(updates.RULES):
+            result = run(matrix, build_org(), update = update)
+            strat = RecordingOrgStrat(build_feed(), build_org(), update)
+            strat.run()
+            diff = np.abs(np.array(strat.equity) - result.equity).max()
+            worst = max(worst, diff)
+            print "%-10s %-12s event-driven %.2f, vectorized %.2f, max equity difference %g" % (
+                label, update, strat.getResult(), result.get_result(), diff)
+    if worst > TOLERANCE:
+        sys.exit("The vectorized engine differs from OrgStrat by %g" % worst)
+
+if __name__ == "__main__":
+    main()